@@ -4,6 +4,7 @@ SET FOREIGN_KEY_CHECKS = 0;
 
 TRUNCATE taxon_presence_alpha_hull;
 TRUNCATE taxon_presence_alpha_hull_subdiv;
+TRUNCATE t2_site_taxon_presence;
 TRUNCATE aggregated_by_year;
 TRUNCATE aggregated_by_month;
 
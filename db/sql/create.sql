@@ -1797,6 +1797,70 @@ CREATE TABLE IF NOT EXISTS `time_series_import` (
 ENGINE = InnoDB;
 
 
+-- -----------------------------------------------------
+-- Table `processing_journal`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `processing_journal` ;
+
+CREATE TABLE IF NOT EXISTS `processing_journal` (
+  `step` VARCHAR(64) NOT NULL,
+  `task_key` VARCHAR(255) NOT NULL,
+  `completed` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`step`, `task_key`))
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `processing_fingerprint`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `processing_fingerprint` ;
+
+CREATE TABLE IF NOT EXISTS `processing_fingerprint` (
+  `source_id` INT NOT NULL,
+  `data_fingerprint` CHAR(40) NOT NULL,
+  `metadata_fingerprint` CHAR(40) NOT NULL,
+  PRIMARY KEY (`source_id`))
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `processing_fingerprint_taxon`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `processing_fingerprint_taxon` ;
+
+CREATE TABLE IF NOT EXISTS `processing_fingerprint_taxon` (
+  `source_id` INT NOT NULL,
+  `taxon_id` CHAR(8) NOT NULL,
+  PRIMARY KEY (`source_id`, `taxon_id`))
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `region_lookup_cache`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `region_lookup_cache` ;
+
+CREATE TABLE IF NOT EXISTS `region_lookup_cache` (
+  `region_version` CHAR(40) NOT NULL,
+  `x_key` BIGINT NOT NULL,
+  `y_key` BIGINT NOT NULL,
+  `region_id` INT NULL,
+  PRIMARY KEY (`region_version`, `x_key`, `y_key`))
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `t2_site_taxon_presence`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `t2_site_taxon_presence` ;
+
+CREATE TABLE IF NOT EXISTS `t2_site_taxon_presence` (
+  `site_id` INT NOT NULL,
+  `taxon_id` CHAR(8) NOT NULL,
+  PRIMARY KEY (`taxon_id`, `site_id`))
+ENGINE = InnoDB;
+
+
 -- -----------------------------------------------------
 -- procedure update_t1_survey_region
 -- -----------------------------------------------------
@@ -0,0 +1,98 @@
+from sqlalchemy import text
+from tests.util import import_test_data
+from tsx.db import get_session
+from tsx.processing.incremental import Snapshot, find_changes
+from tsx.processing.journal import Journal
+from tsx.util import sql_list_placeholder, sql_list_argument
+
+def test_find_changes(fresh_database, db_name):
+    import_test_data(db_name, 'unit')
+    import_test_data(db_name, 'source')
+    import_test_data(db_name, 'taxon_level')
+    import_test_data(db_name, 'taxon')
+    import_test_data(db_name, 't1_site')
+    import_test_data(db_name, 't1_survey')
+    import_test_data(db_name, 't1_sighting')
+    import_test_data(db_name, 'processing_method')
+
+    session = get_session()
+    session.execute(text("UPDATE taxon SET spno = CRC32(id) % 10000"))
+
+    # Move the surveys of a few taxa to a second source
+    session.execute(text("""INSERT INTO source (id, source_type_id, description, data_agreement_status_id, last_modified)
+        SELECT 2, source_type_id, 'Second Source', data_agreement_status_id, last_modified FROM source WHERE id = 1"""))
+    moved_taxa = [taxon_id for (taxon_id,) in session.execute(text("SELECT DISTINCT taxon_id FROM t1_sighting ORDER BY taxon_id LIMIT 3")).fetchall()]
+    session.execute(text("""UPDATE t1_survey SET source_id = 2
+        WHERE id IN (SELECT survey_id FROM t1_sighting WHERE taxon_id IN (%s))""" % sql_list_placeholder('taxon', moved_taxa)),
+        sql_list_argument('taxon', moved_taxa))
+    session.commit()
+
+    # No previous run
+    assert find_changes(session, Snapshot(session)) is None
+
+    Snapshot(session).save()
+
+    assert find_changes(session, Snapshot(session)) == ([], [])
+
+    # A new import for the second source recomputes exactly the species in its data
+    session.execute(text("""INSERT INTO data_import (source_id, status_id, data_type, is_admin)
+        SELECT 2, id, 1, 1 FROM data_import_status WHERE code = 'imported'"""))
+    session.commit()
+
+    expected_species = sorted(spno for (spno,) in session.execute(text("SELECT DISTINCT spno FROM taxon WHERE id IN (%s)" %
+        sql_list_placeholder('taxon', moved_taxa)), sql_list_argument('taxon', moved_taxa)).fetchall())
+    expected_taxa = sorted(taxon_id for (taxon_id,) in session.execute(text("SELECT id FROM taxon WHERE spno IN (%s)" %
+        sql_list_placeholder('species', expected_species)), sql_list_argument('species', expected_species)).fetchall())
+    all_species = session.execute(text("SELECT COUNT(DISTINCT spno) FROM taxon, t1_sighting WHERE taxon.id = taxon_id")).scalar()
+
+    species, taxa = find_changes(session, Snapshot(session))
+
+    assert species == expected_species
+    assert taxa == expected_taxa
+    assert len(species) < all_species
+
+    # Once the changes have been processed, nothing needs to be recomputed
+    Snapshot(session).save()
+
+    assert find_changes(session, Snapshot(session)) == ([], [])
+
+    session.close()
+
+def test_snapshot_journal(fresh_database, db_name):
+    import_test_data(db_name, 'unit')
+    import_test_data(db_name, 'source')
+    import_test_data(db_name, 'taxon_level')
+    import_test_data(db_name, 'taxon')
+    import_test_data(db_name, 't1_site')
+    import_test_data(db_name, 't1_survey')
+    import_test_data(db_name, 't1_sighting')
+
+    session = get_session()
+    session.execute(text("UPDATE taxon SET spno = CRC32(id) % 10000"))
+    session.commit()
+
+    journal = Journal()
+    journal.clear()
+    assert Snapshot.from_journal(journal) is None
+
+    # The snapshot taken at the start of a run is recorded in the journal...
+    snapshot = Snapshot(session)
+    snapshot.record(journal)
+
+    # ...so that a run resumed after more data has been imported saves the state of the sources when the run started
+    session.execute(text("""INSERT INTO data_import (source_id, status_id, data_type, is_admin)
+        SELECT 1, id, 1, 1 FROM data_import_status WHERE code = 'imported'"""))
+    session.commit()
+
+    resumed = Snapshot.from_journal(journal)
+    assert resumed.fingerprints == snapshot.fingerprints
+    assert resumed.source_taxa == snapshot.source_taxa
+    assert len(resumed.source_taxa) > 0
+
+    resumed.save()
+
+    # The data imported during the run is picked up by the next incremental run
+    species, taxa = find_changes(session, Snapshot(session))
+    assert len(species) > 0
+
+    session.close()
@@ -0,0 +1,144 @@
+import subprocess
+import time
+from sqlalchemy import text
+from tsx.db import get_session
+from tsx.process import Step, get_pipeline_steps, link_steps, run_pipeline, species_ready
+from tsx.processing.journal import STEP_COMPLETE
+
+processing_tables = ['processing_fingerprint', 'processing_fingerprint_taxon', 'region_lookup_cache', 't2_site_taxon_presence']
+
+def test_create_processing_tables(fresh_database):
+    # Simulate a database created with an older version of create.sql
+    session = get_session()
+    for table in processing_tables:
+        session.execute(text("DROP TABLE %s" % table))
+    session.commit()
+
+    subprocess.run(["python", "-m", "tsx.process", "-c", "clear"]).check_returncode()
+
+    for table in processing_tables:
+        assert session.execute(text("SELECT COUNT(*) FROM %s" % table)).scalar() == 0
+
+    session.close()
+
+class MemoryJournal:
+    """
+    In-memory stand-in for `tsx.processing.journal.Journal`
+    """
+    def __init__(self):
+        self.tasks = set()
+
+    def step_complete(self, step):
+        return STEP_COMPLETE in self.completed_tasks(step)
+
+    def complete_step(self, step):
+        self.record(step, STEP_COMPLETE)
+
+    def completed_tasks(self, step):
+        return set(key for (s, key) in list(self.tasks) if s == step)
+
+    def record(self, step, key):
+        self.tasks.add((step, str(key)))
+
+def test_pipeline_dependencies():
+    steps = get_pipeline_steps(MemoryJournal())
+    link_steps(steps)
+
+    assert { step.name: [d.name for d in step.depends_on] for step in steps } == {
+        'clear': [],
+        'alpha_hull': ['clear'],
+        'site_taxon_presence': ['clear'],
+        't1_aggregation': ['clear'],
+        't2_aggregation': ['clear'],
+        'spatial_rep': ['clear', 't2_aggregation'],
+        'filter_time_series': ['clear', 't1_aggregation', 't2_aggregation']
+    }
+    assert { step.name: [d.name for d in step.streams_from] for step in steps if step.streams_from } == {
+        'site_taxon_presence': ['alpha_hull'],
+        't2_aggregation': ['site_taxon_presence']
+    }
+
+    link_steps(steps, sequential = True)
+    for i, step in enumerate(steps):
+        assert step.depends_on == steps[:i]
+        assert step.streams_from == []
+
+def make_steps(calls, fail = ()):
+    def fn(name):
+        def run():
+            calls.append(name)
+            if name in fail:
+                raise RuntimeError("failed: %s" % name)
+        return run
+
+    return [
+        Step('a', "A", fn('a'), outputs = ['x']),
+        Step('b', "B", fn('b'), inputs = ['x'], outputs = ['y']),
+        Step('c', "C", fn('c'), inputs = ['y'], outputs = ['z']),
+        Step('d', "D", fn('d'), inputs = ['w'], outputs = ['v'])
+    ]
+
+def test_pipeline_resume_after_failure():
+    journal = MemoryJournal()
+
+    # c depends on b, so is never started, but d is independent of b and runs to completion
+    calls = []
+    assert not run_pipeline(make_steps(calls, fail = ['b']), journal)
+    assert sorted(calls) == ['a', 'b', 'd']
+    assert [step for step in 'abcd' if journal.step_complete(step)] == ['a', 'd']
+
+    # Resuming skips the steps that completed, and runs the rest in order
+    calls = []
+    steps = make_steps(calls)
+    assert run_pipeline(steps, journal)
+    assert calls == ['b', 'c']
+    assert [step.state for step in steps] == ['skipped', 'done', 'done', 'skipped']
+
+def test_pipeline_streaming():
+    journal = MemoryJournal()
+    species = [1, 2, 3, 4, 5]
+    received = []
+
+    def produce():
+        for spno in species:
+            time.sleep(0.05)
+            journal.record('producer', spno)
+
+    def consume():
+        pending = list(species)
+        while len(pending) > 0:
+            ready_species = ready()
+            ready_now = pending if ready_species is None else [spno for spno in pending if spno in ready_species]
+            received.extend(ready_now)
+            pending = [spno for spno in pending if spno not in ready_now]
+            time.sleep(0.01)
+
+    producer = Step('producer', "PRODUCER", produce, outputs = ['x'])
+    consumer = Step('consumer', "CONSUMER", consume, inputs = ['x'], outputs = ['y'], streams = ['x'])
+    ready = species_ready(journal, producer)
+
+    assert run_pipeline([producer, consumer], journal)
+    assert consumer.streams_from == [producer]
+    assert sorted(received) == species
+    # The consumer started before the producer finished
+    assert consumer.start_time < producer.end_time
+
+def test_pipeline_streaming_failure():
+    journal = MemoryJournal()
+
+    def produce():
+        time.sleep(0.1)
+        raise RuntimeError("producer failed")
+
+    def consume():
+        while ready() is not None:
+            time.sleep(0.01)
+
+    producer = Step('producer', "PRODUCER", produce, outputs = ['x'])
+    consumer = Step('consumer', "CONSUMER", consume, inputs = ['x'], outputs = ['y'], streams = ['x'])
+    ready = species_ready(journal, producer)
+
+    # The consumer sees the failure of the producer, rather than waiting forever
+    assert not run_pipeline([producer, consumer], journal)
+    assert producer.state == 'failed'
+    assert consumer.state == 'failed'
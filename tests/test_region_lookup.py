@@ -0,0 +1,64 @@
+import subprocess
+from sqlalchemy import text
+from tests.util import import_test_data
+from tsx.db import get_session
+from tsx.processing import region_lookup
+from tsx.processing.t1_aggregation import create_region_lookup_table
+from tsx.processing.t2_aggregation import update_site_centroid_regions
+
+def test_region_lookup(fresh_database, db_name):
+    subprocess.run(["python", "-m", "tsx.import_region", "tests/data/regions/regions.shp"]).check_returncode()
+
+    import_test_data(db_name, 'unit')
+    import_test_data(db_name, 'source')
+    import_test_data(db_name, 't1_site')
+    import_test_data(db_name, 't1_survey')
+
+    session = get_session()
+
+    # Type 1: region of each survey (aggregation uses the lowest region id of each site). The python engine is run twice, to
+    # check the results when the regions have been cached.
+    results = {}
+    for engine in region_lookup.engines + ['python']:
+        create_region_lookup_table(session, engine = engine)
+        results.setdefault(engine, []).append(set(session.execute(text("SELECT site_id, MIN(region_id) FROM tmp_region_lookup GROUP BY site_id")).fetchall()))
+
+    assert len(results['sql'][0]) > 0
+    assert results['python'] == results['sql'] * 2
+    assert session.execute(text("SELECT COUNT(*) FROM region_lookup_cache")).scalar() > 0
+
+    # Type 2: region of the centroid of each site (using the type 1 surveys as sample data)
+    session.execute(text("""CREATE TABLE tmp_site_centroid (site_id INT, centroid POINT SRID 0 NOT NULL, region_id INT)"""))
+    session.execute(text("""INSERT INTO tmp_site_centroid (site_id, centroid)
+        SELECT site_id, ST_Centroid(ST_Collect(coords)) FROM t1_survey GROUP BY site_id"""))
+    session.commit()
+
+    results = {}
+    for engine in region_lookup.engines:
+        session.execute(text("UPDATE tmp_site_centroid SET region_id = NULL"))
+        update_site_centroid_regions(session, engine = engine)
+        results[engine] = set(session.execute(text("SELECT site_id, region_id FROM tmp_site_centroid")).fetchall())
+
+    assert any(region_id is not None for site_id, region_id in results['sql'])
+    assert results['python'] == results['sql']
+
+    session.execute(text("DROP TABLE tmp_site_centroid"))
+    session.close()
+
+def test_region_cache_versions(fresh_database):
+    session = get_session()
+    session.execute(text("INSERT INTO region_lookup_cache (region_version, x_key, y_key, region_id) VALUES ('other', 0, 0, 1)"))
+    session.commit()
+
+    # Entries for other versions of the regions are left alone by lookups...
+    with region_lookup.RegionCache('test') as cache:
+        cache.lookup([0.0], [0.0])
+    assert session.execute(text("SELECT COUNT(*) FROM region_lookup_cache WHERE region_version = 'other'")).scalar() == 1
+    assert session.execute(text("SELECT COUNT(*) FROM region_lookup_cache WHERE region_version <> 'other'")).scalar() == 1
+
+    # ...and only removed by clear_cache
+    region_lookup.clear_cache(session)
+    session.commit()
+    assert session.execute(text("SELECT region_version FROM region_lookup_cache")).fetchall() == [(cache.version,)]
+
+    session.close()
@@ -0,0 +1,41 @@
+import subprocess
+from sqlalchemy import text
+from tests.util import import_test_data
+from tsx.db import get_session
+
+def test_site_taxon_presence(fresh_database, db_name):
+    subprocess.run(["python", "-m", "tsx.import_region", "tests/data/regions/regions.shp"]).check_returncode()
+
+    import_test_data(db_name, 'unit')
+    import_test_data(db_name, 'source')
+    import_test_data(db_name, 'taxon_level')
+    import_test_data(db_name, 'taxon')
+    import_test_data(db_name, 't1_site')
+    import_test_data(db_name, 't1_survey')
+
+    # Use the regions as alpha hulls (a different subset for each taxon, plus non-core range pieces that should be
+    # ignored), and the type 1 surveys as type 2 surveys
+    session = get_session()
+    session.execute(text("UPDATE taxon SET spno = CRC32(id) % 7"))
+    session.execute(text("""INSERT INTO taxon_presence_alpha_hull_subdiv (taxon_id, range_id, geometry)
+        SELECT taxon.id, IF(MOD(region_subdiv.id, 3) = MOD(CRC32(taxon.id), 3), 1, 2), region_subdiv.geometry
+        FROM taxon, region_subdiv"""))
+    session.execute(text("SET FOREIGN_KEY_CHECKS = 0"))
+    session.execute(text("""INSERT INTO t2_survey (id, site_id, source_id, start_date_y, coords, search_type_id, source_primary_key)
+        SELECT id, site_id, source_id, start_date_y, coords, 1, source_primary_key FROM t1_survey"""))
+    session.execute(text("SET FOREIGN_KEY_CHECKS = 1"))
+    session.commit()
+
+    subprocess.run(["python", "-m", "tsx.process", "-c", "site_taxon_presence"]).check_returncode()
+
+    expected = set(session.execute(text("""SELECT DISTINCT site_id, taxon_id
+        FROM taxon_presence_alpha_hull_subdiv alpha, t2_survey
+        WHERE ST_Contains(alpha.geometry, t2_survey.coords)
+        AND alpha.range_id = 1
+        AND site_id IS NOT NULL""")).fetchall())
+    actual = set(session.execute(text("SELECT site_id, taxon_id FROM t2_site_taxon_presence")).fetchall())
+
+    assert len(expected) > 0
+    assert actual == expected
+
+    session.close()
@@ -1,7 +1,7 @@
 import subprocess
-from tests.util import import_test_data, compare_output
+from tests.util import import_test_data, compare_output, get_csv_data, assert_csv_data_close
 
-def test_t1_aggregation(fresh_database, db_name, output_dir):
+def import_t1_test_data(db_name):
     import_test_data(db_name, 'unit')
     import_test_data(db_name, 'source')
     import_test_data(db_name, 'taxon_level')
@@ -11,6 +11,9 @@ def test_t1_aggregation(fresh_database, db_name, output_dir):
     import_test_data(db_name, 't1_sighting')
     import_test_data(db_name, 'processing_method')
 
+def test_t1_aggregation(fresh_database, db_name, output_dir):
+    import_t1_test_data(db_name)
+
     for cmd in [
         ["python", "-m", "tsx.process", "-c", "t1_aggregation"]
         ]:
@@ -18,3 +21,51 @@ def test_t1_aggregation(fresh_database, db_name, output_dir):
 
     for table in ["aggregated_by_month", "aggregated_by_year"]:
         compare_output(db_name, table, output_dir)
+
+def test_t1_aggregation_set_engine(fresh_database, db_name, output_dir):
+    import_t1_test_data(db_name)
+
+    for cmd in [
+        ["python", "-m", "tsx.process", "-c", "t1_aggregation", "--engine", "set"]
+        ]:
+        subprocess.run(cmd).check_returncode()
+
+    for table in ["aggregated_by_month", "aggregated_by_year"]:
+        compare_output(db_name, table, output_dir)
+
+def test_t1_aggregation_fused(fresh_database, db_name, output_dir):
+    import_t1_test_data(db_name)
+
+    for cmd in [
+        ["python", "-m", "tsx.process", "-c", "t1_aggregation", "--fused"]
+        ]:
+        subprocess.run(cmd).check_returncode()
+
+    for table in ["aggregated_by_month", "aggregated_by_year"]:
+        compare_output(db_name, table, output_dir)
+
+def test_t1_aggregation_duckdb_engine(fresh_database, db_name, output_dir, data_dir):
+    import_t1_test_data(db_name)
+
+    subprocess.run(["python", "-m", "tsx.process", "-c", "t1_aggregation"]).check_returncode()
+
+    expected = {}
+    for table in ["aggregated_by_month", "aggregated_by_year"]:
+        expected[table] = get_csv_data(db_name, table)
+
+    conn = fresh_database()
+    with conn.cursor() as cursor:
+        cursor.execute("DELETE FROM aggregated_by_month")
+        cursor.execute("DELETE FROM aggregated_by_year")
+    conn.commit()
+    conn.close()
+
+    for cmd in [
+        ["python", "-m", "tsx.preprocessing"],
+        ["python", "-m", "tsx.process", "-c", "t1_aggregation", "--engine", "duckdb"]
+        ]:
+        subprocess.run(cmd).check_returncode()
+
+    # DuckDB sums in a different order to MySQL, so averages may differ in the last digit
+    for table in ["aggregated_by_month", "aggregated_by_year"]:
+        assert_csv_data_close(expected[table], get_csv_data(db_name, table))
@@ -0,0 +1,191 @@
+import math
+import subprocess
+import pandas as pd
+from sqlalchemy import text
+from tests.util import import_test_data, number_pattern
+from tsx.db import get_session
+from tsx.processing import t2_aggregation
+from tsx.processing.t2_aggregation import aggregate_monthly_pandas
+
+def import_t2_test_data(db_name):
+    """
+    Loads type 2 test data, derived from the type 1 test data, and computes the sites where each taxon is present
+    """
+    subprocess.run(["python", "-m", "tsx.import_region", "tests/data/regions/regions.shp"]).check_returncode()
+
+    import_test_data(db_name, 'unit')
+    import_test_data(db_name, 'source')
+    import_test_data(db_name, 'taxon_level')
+    import_test_data(db_name, 'taxon')
+    import_test_data(db_name, 't1_site')
+    import_test_data(db_name, 't1_survey')
+    import_test_data(db_name, 't1_sighting')
+    import_test_data(db_name, 'processing_method')
+
+    session = get_session()
+
+    # One species per taxon (the taxon ids are a letter followed by a unique number)
+    session.execute(text("UPDATE taxon SET spno = CAST(REGEXP_REPLACE(id, '[a-z]', '') AS UNSIGNED)"))
+
+    # Use the regions as alpha hulls (a different subset for each taxon, plus non-core range pieces that should be ignored)
+    session.execute(text("""INSERT INTO taxon_presence_alpha_hull_subdiv (taxon_id, range_id, geometry)
+        SELECT taxon.id, IF(MOD(region_subdiv.id, 3) = MOD(CRC32(taxon.id), 3), 1, 2), region_subdiv.geometry
+        FROM taxon, region_subdiv"""))
+
+    # Use the type 1 surveys and sightings as type 2 data, with some incidental surveys (which are excluded from
+    # aggregation) and presence-only sightings
+    session.execute(text("SET FOREIGN_KEY_CHECKS = 0"))
+    session.execute(text("""INSERT INTO t2_survey (id, site_id, source_id, start_date_y, start_date_m, coords, positional_accuracy_in_m, search_type_id, source_primary_key)
+        SELECT id, site_id, source_id, start_date_y, start_date_m, coords, MOD(id, 4) * 10, IF(MOD(id, 11) = 0, 6, 2), source_primary_key FROM t1_survey"""))
+    session.execute(text("""INSERT INTO t2_sighting (id, survey_id, taxon_id, count, unit_id)
+        SELECT id, survey_id, taxon_id, count, IF(MOD(id, 5) = 0, 1, unit_id) FROM t1_sighting"""))
+    session.execute(text("SET FOREIGN_KEY_CHECKS = 1"))
+    session.execute(text("""INSERT INTO processing_method (taxon_id, unit_id, source_id, search_type_id, data_type, response_variable_type_id)
+        SELECT taxon_id, unit_id, source_id, search_type_id, 2, response_variable_type_id FROM processing_method"""))
+    session.commit()
+    session.close()
+
+    subprocess.run(["python", "-m", "tsx.process", "-c", "site_taxon_presence"]).check_returncode()
+
+def run_t2_aggregation(*args, species = None):
+    species_args = [] if species is None else ["--species", ",".join(str(spno) for spno in species)]
+    subprocess.run(["python", "-m", "tsx.process", "-c"] + species_args + ["t2_aggregation"] + list(args)).check_returncode()
+
+def get_t2_output(session):
+    """
+    Returns the type 2 aggregated data (excluding generated ids), and deletes it so that aggregation can be run again
+    """
+    output = {}
+    for table in ["aggregated_by_month", "aggregated_by_year"]:
+        month = "start_date_m" if table == "aggregated_by_month" else "NULL"
+        output[table] = sorted(session.execute(text("""SELECT start_date_y, {month}, site_id, search_type_id, taxon_id,
+                response_variable_type_id, value, source_id, region_id, unit_id, positional_accuracy_in_m,
+                ST_AsText(centroid_coords), survey_count
+            FROM {table}
+            WHERE data_type = 2""".format(table = table, month = month))).fetchall(), key = repr)
+        session.execute(text("DELETE FROM %s WHERE data_type = 2" % table))
+    session.commit()
+    return output
+
+def test_t2_aggregation_batch(fresh_database, db_name):
+    import_t2_test_data(db_name)
+    session = get_session()
+
+    run_t2_aggregation("--batch-size", "1")
+    expected = get_t2_output(session)
+
+    assert len(expected['aggregated_by_month']) > 0
+    assert len(expected['aggregated_by_year']) > 0
+
+    # Batches of taxa give the same results as one taxon at a time
+    run_t2_aggregation("--batch-size", "5")
+    assert get_t2_output(session) == expected
+
+    # As do a few species at a time
+    species = [spno for (spno,) in session.execute(text("""SELECT DISTINCT spno FROM taxon, processing_method
+        WHERE taxon.id = taxon_id AND data_type = 2 ORDER BY spno""")).fetchall()]
+    for i in range(0, len(species), 7):
+        run_t2_aggregation(species = species[i:i + 7])
+    assert get_t2_output(session) == expected
+
+    session.close()
+
+def test_t2_aggregation_site_presence(fresh_database, db_name):
+    import_t2_test_data(db_name)
+    session = get_session()
+
+    # Aggregate using the sites found with ST_Contains, as type 2 aggregation did before site presence was precomputed
+    session.execute(text("DELETE FROM t2_site_taxon_presence"))
+    session.execute(text("""INSERT INTO t2_site_taxon_presence (site_id, taxon_id)
+        SELECT DISTINCT site_id, taxon_id
+        FROM taxon_presence_alpha_hull_subdiv alpha, t2_survey
+        WHERE ST_Contains(alpha.geometry, t2_survey.coords)
+        AND alpha.range_id = 1
+        AND site_id IS NOT NULL"""))
+    session.commit()
+    t2_aggregation.process_database(commit = True, presence_ready = lambda: None)
+    expected = get_t2_output(session)
+
+    assert len(expected['aggregated_by_month']) > 0
+
+    # Run on its own, aggregation computes site presence first, so missing or stale site presence is never used
+    session.execute(text("DELETE FROM t2_site_taxon_presence"))
+    session.execute(text("INSERT INTO t2_site_taxon_presence (site_id, taxon_id) SELECT DISTINCT site_id, 'f24' FROM t2_survey"))
+    session.commit()
+    run_t2_aggregation()
+    assert get_t2_output(session) == expected
+
+    session.close()
+
+def assert_t2_output_close(expected, actual, rel_tol=1e-9):
+    """
+    Compares type 2 aggregated data (see get_t2_output), allowing averages and coordinates to differ by a relative
+    tolerance, as engines may sum in a different order
+    """
+    for table in expected:
+        assert len(expected[table]) == len(actual[table])
+        for expected_row, actual_row in zip(expected[table], actual[table]):
+            for x, y in zip(expected_row, actual_row):
+                if isinstance(x, str) and x.startswith('POINT'):
+                    assert number_pattern.sub('', x) == number_pattern.sub('', y), (expected_row, actual_row)
+                    for a, b in zip(number_pattern.findall(x), number_pattern.findall(y)):
+                        assert math.isclose(float(a), float(b), rel_tol=rel_tol), (expected_row, actual_row)
+                elif isinstance(x, float) and y is not None:
+                    assert math.isclose(x, y, rel_tol=rel_tol), (expected_row, actual_row)
+                else:
+                    assert x == y, (expected_row, actual_row)
+
+def test_t2_aggregation_pandas(fresh_database, db_name):
+    import_t2_test_data(db_name)
+    session = get_session()
+
+    run_t2_aggregation("--engine", "sql")
+    expected = get_t2_output(session)
+
+    assert len(expected['aggregated_by_month']) > 0
+    # All three response variable types (average count, maximum count and reporting rate) are covered
+    assert set(row[5] for row in expected['aggregated_by_month']) == set([1, 2, 3])
+
+    # The pandas engine re-implements the MySQL rounding of reporting rates, which must match exactly (the tolerance only
+    # allows for differences in the last digit of sums)
+    for batch_size in ["1", "5"]:
+        run_t2_aggregation("--engine", "pandas", "--batch-size", batch_size)
+        assert_t2_output_close(expected, get_t2_output(session))
+
+    session.close()
+
+def test_aggregate_monthly_pandas():
+    # (site_id, number of surveys, [(survey index, unit_id, count)])
+    sites = [
+        (1, 8, [(1, 12, 3.0)]), # rr = 0.125, rounded half up as in MySQL
+        (2, 3, [(1, 1, 1.0)]), # presence-only sighting
+        (3, 2, []), # no sightings: max_count is 0 rather than null
+        (4, 1, [(0, 1, None)]), # only presence-only surveys: no average count
+        (5, 3, [(0, 12, 2.0), (2, 12, 5.0)]) # rr = 0.66667
+    ]
+    surveys = []
+    sightings = []
+    for site_id, num_surveys, site_sightings in sites:
+        survey_ids = [site_id * 100 + i for i in range(num_surveys)]
+        for survey_id in survey_ids:
+            surveys.append(('t1', survey_id, 2000, 1, site_id, 2, 1, None, float(site_id), -float(site_id), 7))
+        for i, unit_id, count in site_sightings:
+            sightings.append(('t1', survey_ids[i], survey_ids[i] * 10, unit_id, count))
+
+    rows = aggregate_monthly_pandas(
+        pd.DataFrame(surveys, columns = ['taxon_id', 'survey_id', 'year', 'month', 'site_id', 'search_type_id', 'source_id', 'positional_accuracy_in_m', 'x', 'y', 'region_id']),
+        pd.DataFrame(sightings, columns = ['taxon_id', 'survey_id', 'sighting_id', 'unit_id', 'count']),
+        # Processing methods that only differ in other columns (e.g. search type) must not duplicate rows
+        pd.DataFrame([('t1', 1, 1, 2), ('t1', 1, 2, 2), ('t1', 1, 3, 2), ('t1', 1, 3, 5)], columns = ['taxon_id', 'source_id', 'response_variable_type_id', 'search_type_id']))
+
+    assert len(rows) == 14
+
+    assert { (row['site_id'], row['response_variable_type_id']): row['value'] for row in rows } == {
+        (1, 1): 0.375, (1, 2): 3.0, (1, 3): 0.13,
+        (2, 1): 0.0, (2, 2): 0.0, (2, 3): 0.33,
+        (3, 1): 0.0, (3, 2): 0.0, (3, 3): 0.0,
+        (4, 2): 0.0, (4, 3): 1.0,
+        (5, 1): 7.0 / 3, (5, 2): 5.0, (5, 3): 0.67
+    }
+    assert all(row['unit_id'] == (1 if row['response_variable_type_id'] == 3 else 2) for row in rows)
+    assert { row['site_id']: row['num_surveys'] for row in rows } == { site_id: num_surveys for site_id, num_surveys, site_sightings in sites }
@@ -3,6 +3,9 @@ import subprocess
 import filecmp
 import tempfile
 import textwrap
+import csv
+import math
+import re
 from csv import DictWriter
 from io import StringIO
 
@@ -61,6 +64,24 @@ def get_csv_data(db_name, table_name):
     result.check_returncode()
     return result.stdout
 
+def assert_csv_data_close(expected, actual, rel_tol=1e-9):
+    """
+    Compare two CSV exports (see get_csv_data), allowing numbers (including coordinates in geometries) to differ by a
+    relative tolerance, e.g. when results are calculated by different engines that sum in a different order
+    """
+    expected_rows = list(csv.reader(StringIO(expected)))
+    actual_rows = list(csv.reader(StringIO(actual)))
+    assert len(expected_rows) == len(actual_rows)
+    for expected_row, actual_row in zip(expected_rows, actual_rows):
+        assert len(expected_row) == len(actual_row)
+        for expected_val, actual_val in zip(expected_row, actual_row):
+            if expected_val != actual_val:
+                assert number_pattern.sub('', expected_val) == number_pattern.sub('', actual_val), (expected_row, actual_row)
+                for x, y in zip(number_pattern.findall(expected_val), number_pattern.findall(actual_val)):
+                    assert math.isclose(float(x), float(y), rel_tol=rel_tol), (expected_row, actual_row)
+
+number_pattern = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?')
+
 def get_single(conn, query):
     with conn.cursor() as cursor:
         cursor.execute(query)
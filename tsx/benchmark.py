@@ -0,0 +1,290 @@
+"""
+Micro-benchmarks for the performance sensitive parts of the processing pipeline
+
+Usage::
+
+	python -m tsx.benchmark alpha_shape --sizes 1000,100000,1000000
+	python -m tsx.benchmark point_in_polygon --points 1000000
+	python -m tsx.benchmark subdivide
+	python -m tsx.benchmark t1_aggregation --replace-data --engines taxon,set,duckdb
+
+Each benchmark runs the old and new implementations on the same synthetic input, checks that they agree, and
+prints the timings. The t1_aggregation benchmark uses the configured database instead of synthetic input.
+"""
+import argparse
+import logging
+import sys
+import time
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+def main():
+	logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)-15s %(name)s %(levelname)-8s %(message)s')
+
+	parser = argparse.ArgumentParser(description='TSX processing benchmarks')
+	parser.add_argument('--seed', type=int, default=1, help='Random seed for synthetic data')
+
+	subparsers = parser.add_subparsers(help = 'benchmark', dest = 'benchmark', required = True)
+
+	p = subparsers.add_parser('alpha_shape', help='Compare alpha shape engines')
+	p.add_argument('--sizes', type=parse_sizes, default=[1000, 100000, 1000000], help='Comma separated list of point counts')
+
+	p = subparsers.add_parser('range_clip', help='Compare whole-range intersection with STRtree clipping of subdivided ranges')
+	p.add_argument('--range-shp', default='sample-data/spatial/species-range/385.shp', help='Species range shapefile (default is a continental-scale range)')
+	p.add_argument('--points', type=int, default=100000, help='Number of sighting points used to generate the alpha hull')
+
+	p = subparsers.add_parser('point_in_polygon', help='Compare the tile cache point in polygon test with points_in_polygon')
+	p.add_argument('--points', type=int, default=1000000, help='Number of points to test')
+	p.add_argument('--hull-points', type=int, default=100000, help='Number of sighting points used to generate the (coastline clipped) alpha hull')
+
+	p = subparsers.add_parser('subdivide', help='Compare subdivide_geometry engines')
+	p.add_argument('--shp', default='sample-data/spatial/AusCoast_Islands_1kmBuffer.shp', help='Shapefile containing geometries to subdivide')
+	p.add_argument('--max-points', type=int, default=100, help='Maximum points per piece')
+	p.add_argument('--workers', type=int, default=4, help='Number of workers for the process pool engine')
+
+	p = subparsers.add_parser('t1_aggregation', help='Compare type 1 aggregation engines on the configured database')
+	p.add_argument('--engines', type=parse_list, default=['taxon', 'duckdb'], help='Comma separated list of engines (the duckdb engine requires up to date preprocessed data)')
+	p.add_argument('--replace-data', action='store_true', help='Confirm that existing type 1 aggregated data may be deleted (it is replaced by the output of the last engine)')
+
+	args = parser.parse_args()
+
+	rng = np.random.default_rng(args.seed)
+
+	if args.benchmark == 'alpha_shape':
+		benchmark_alpha_shape(rng, args.sizes)
+	elif args.benchmark == 'range_clip':
+		benchmark_range_clip(rng, args.range_shp, args.points)
+	elif args.benchmark == 'point_in_polygon':
+		benchmark_point_in_polygon(rng, args.points, args.hull_points)
+	elif args.benchmark == 'subdivide':
+		benchmark_subdivide(args.shp, args.max_points, args.workers)
+	elif args.benchmark == 't1_aggregation':
+		if not args.replace_data:
+			log.error("This benchmark deletes type 1 aggregated data, use --replace-data to confirm")
+			sys.exit(1)
+		benchmark_t1_aggregation(args.engines)
+
+def parse_sizes(value):
+	return [int(x) for x in value.split(",")]
+
+def parse_list(value):
+	return [x.strip() for x in value.split(",")]
+
+def timed(fn, *args, **kwargs):
+	t0 = time.perf_counter()
+	result = fn(*args, **kwargs)
+	return result, time.perf_counter() - t0
+
+def clustered_points(rng, n, num_clusters = 20, extent = 4e6):
+	"""
+	Generates `n` points (in metres) spread over a handful of gaussian clusters, which is roughly what sighting data looks like
+	"""
+	centres = rng.uniform(0, extent, size=(num_clusters, 2))
+	scales = rng.uniform(extent / 200, extent / 20, size=num_clusters)
+	cluster = rng.integers(0, num_clusters, size=n)
+	return centres[cluster] + rng.normal(size=(n, 2)) * scales[cluster, None]
+
+def print_results(rows):
+	header = rows[0].keys()
+	print("\t".join(header))
+	for row in rows:
+		print("\t".join(("%0.3f" % v) if isinstance(v, float) else str(v) for v in row.values()))
+
+def benchmark_alpha_shape(rng, sizes):
+	from tsx.processing.alpha_hull import alpha_shape_engines
+
+	rows = []
+	for n in sizes:
+		coords = clustered_points(rng, n)
+		# Drop exact duplicates, which Delaunay can't handle (the pipeline thins points first)
+		coords = np.unique(coords, axis=0)
+
+		row = { 'points': n }
+		results = {}
+		for engine, fn in alpha_shape_engines.items():
+			log.info("alpha_shape: %s points, engine = %s" % (n, engine))
+			(geom, edge_points), t = timed(fn, coords, alpha=1.6)
+			results[engine] = geom
+			row['%s_sec' % engine] = t
+
+		row['speedup'] = row['python_sec'] / row['numpy_sec']
+		row['identical'] = results['python'].equals(results['numpy'])
+		rows.append(row)
+
+	print_results(rows)
+
+def benchmark_range_clip(rng, range_shp, num_points):
+	import shapely
+	from shapely.geometry import shape
+	from tsx.geo import open_shapefile, subdivide_geometry, intersect_pieces, to_multipolygon, reproject_xy
+	from tsx.processing.alpha_hull import make_alpha_hull, to_working_transformer, to_db_transformer, reproject
+
+	with open_shapefile(range_shp, 'EPSG:4326') as (shp, reproject_range):
+		ranges = [reproject_range(shape(feature['geometry'])).buffer(0) for feature in shp]
+
+	# Generate an alpha hull from synthetic sightings spread across the extent of the ranges
+	minx, miny, maxx, maxy = shapely.total_bounds(ranges)
+	lonlat = clustered_points(rng, num_points, extent = 1) * [maxx - minx, maxy - miny] + [minx, miny]
+	xs, ys = reproject_xy(lonlat[:, 0], lonlat[:, 1], to_working_transformer)
+	hull = reproject(make_alpha_hull(xs, ys, None), to_db_transformer).buffer(0)
+
+	rows = []
+	for index, range_geom in enumerate(ranges):
+		log.info("range_clip: range polygon %s (%s points)" % (index, shapely.get_num_coordinates(range_geom)))
+		# Range subdivision happens at import time (taxon_range_subdiv) so is not included in the timing
+		pieces = list(subdivide_geometry(range_geom))
+
+		# Both paths include subdividing the result, as the pipeline does before inserting into taxon_presence_alpha_hull_subdiv
+		def full_path():
+			geom = to_multipolygon(range_geom.intersection(hull))
+			return geom, list(subdivide_geometry(geom, max_points = 100))
+
+		def strtree_path():
+			clipped_pieces = intersect_pieces(pieces, hull)
+			geom = to_multipolygon(shapely.union_all(clipped_pieces))
+			return geom, [g for piece in clipped_pieces for g in subdivide_geometry(piece, max_points = 100)]
+
+		(full, full_subdiv), full_sec = timed(full_path)
+		(clipped, clipped_subdiv), strtree_sec = timed(strtree_path)
+
+		rows.append({
+			'range': index,
+			'range_points': int(shapely.get_num_coordinates(range_geom)),
+			'pieces': len(pieces),
+			'full_sec': full_sec,
+			'strtree_sec': strtree_sec,
+			'speedup': full_sec / strtree_sec,
+			'area_diff': abs(full.area - clipped.area),
+			'subdiv_area_diff': abs(shapely.area(full_subdiv).sum() - shapely.area(clipped_subdiv).sum())
+		})
+
+	print_results(rows)
+
+def benchmark_point_in_polygon(rng, num_points, num_hull_points):
+	import shapely
+	from tsx.geo import point_intersects_geom, points_in_polygon
+	from tsx.processing.alpha_hull import make_alpha_hull
+	from tsx.processing.coastline import build_coastline_asset, get_coastal_shape
+
+	# Generate a realistic (i.e. complex) hull by clipping an alpha hull to the coastline
+	build_coastline_asset()
+	coastal_shape = get_coastal_shape()
+	minx, miny, maxx, maxy = coastal_shape.bounds
+	scale = [maxx - minx, maxy - miny]
+	coords = clustered_points(rng, num_hull_points, extent = 1) * scale + [minx, miny]
+	hull = make_alpha_hull(coords[:, 0], coords[:, 1], coastal_shape)
+	log.info("point_in_polygon: hull has %s points" % shapely.get_num_coordinates(hull))
+
+	coords = rng.uniform(0, 1, size=(num_points, 2)) * scale + [minx, miny]
+	xs, ys = coords[:, 0], coords[:, 1]
+
+	log.info("point_in_polygon: tile cache, %s points" % num_points)
+	def tile_cache():
+		cache = {}
+		return np.array([point_intersects_geom(hull, x, y, cache) for x, y in zip(xs.tolist(), ys.tolist())])
+	tile_mask, tile_sec = timed(tile_cache)
+
+	log.info("point_in_polygon: points_in_polygon, %s points" % num_points)
+	mask, vectorized_sec = timed(points_in_polygon, xs, ys, hull)
+
+	print_results([{
+		'points': num_points,
+		'hull_points': int(shapely.get_num_coordinates(hull)),
+		'inside': int(mask.sum()),
+		'tile_cache_sec': tile_sec,
+		'vectorized_sec': vectorized_sec,
+		'speedup': tile_sec / vectorized_sec,
+		'identical': bool((mask == tile_mask).all())
+	}])
+
+def benchmark_subdivide(shp_path, max_points, n_workers):
+	import shapely
+	from shapely.geometry import shape
+	from tsx.geo import open_shapefile, subdivide_geometry, subdivide_geometry_queue
+
+	with open_shapefile(shp_path, 'EPSG:4326') as (shp, reproject):
+		geoms = [reproject(shape(feature['geometry'])).buffer(0) for feature in shp]
+
+	rows = []
+	for index, geom in enumerate(geoms):
+		log.info("subdivide: geometry %s (%s points)" % (index, shapely.get_num_coordinates(geom)))
+		queue, queue_sec = timed(lambda: list(subdivide_geometry_queue(geom, max_points = max_points)))
+		batch, batch_sec = timed(lambda: list(subdivide_geometry(geom, max_points = max_points)))
+		pool, pool_sec = timed(lambda: list(subdivide_geometry(geom, max_points = max_points, n_workers = n_workers)))
+
+		wkb = shapely.to_wkb(queue)
+		rows.append({
+			'geometry': index,
+			'points': int(shapely.get_num_coordinates(geom)),
+			'pieces': len(queue),
+			'queue_sec': queue_sec,
+			'batch_sec': batch_sec,
+			'pool_sec': pool_sec,
+			'batch_speedup': queue_sec / batch_sec,
+			'pool_speedup': queue_sec / pool_sec,
+			'identical': bool(list(shapely.to_wkb(batch)) == list(wkb) and list(shapely.to_wkb(pool)) == list(wkb))
+		})
+
+	print_results(rows)
+
+def benchmark_t1_aggregation(engines):
+	import math
+	from sqlalchemy import text
+	from tsx.db import get_session
+	import tsx.processing.t1_aggregation
+
+	def clear():
+		session = get_session()
+		for table in ['aggregated_by_month', 'aggregated_by_year']:
+			session.execute(text("DELETE FROM %s WHERE data_type = 1" % table))
+		session.commit()
+		session.close()
+
+	# Integer columns first (compared exactly), then floating point columns (compared with a tolerance, as engines may
+	# sum in a different order)
+	def get_output():
+		session = get_session()
+		result = {}
+		for table, month_column in [('aggregated_by_month', 'start_date_m'), ('aggregated_by_year', 'NULL')]:
+			result[table] = session.execute(text("""SELECT
+					start_date_y, %s, source_id, site_id, search_type_id, taxon_id, response_variable_type_id, unit_id, region_id, survey_count,
+					value, positional_accuracy_in_m, ST_X(centroid_coords), ST_Y(centroid_coords)
+				FROM %s
+				WHERE data_type = 1
+				ORDER BY 1, 2, 3, 4, 5, 6, 7, 8, 9, 10""" % (month_column, table))).fetchall()
+		session.close()
+		return result
+
+	def same_output(a, b):
+		return all(
+			len(a[table]) == len(b[table]) and all(
+				row_a[:10] == row_b[:10] and all(
+					x == y or (x is not None and y is not None and math.isclose(x, y, rel_tol=1e-9))
+					for x, y in zip(row_a[10:], row_b[10:]))
+				for row_a, row_b in zip(a[table], b[table]))
+			for table in a)
+
+	rows = []
+	reference = None
+	for engine in engines:
+		clear()
+		log.info("t1_aggregation: engine = %s" % engine)
+		_, sec = timed(tsx.processing.t1_aggregation.process_database, commit = True, engine = engine)
+		output = get_output()
+		if reference is None:
+			reference = (sec, output)
+
+		rows.append({
+			'engine': engine,
+			'month_rows': len(output['aggregated_by_month']),
+			'year_rows': len(output['aggregated_by_year']),
+			'sec': sec,
+			'speedup': reference[0] / sec,
+			'identical': same_output(reference[1], output)
+		})
+
+	print_results(rows)
+
+if __name__ == '__main__':
+	main()
@@ -1 +1,3 @@
 from tsx.db.connect import get_session as get_session
+from tsx.db.bulk import BulkWriter as BulkWriter
+from tsx.db.bulk import GeometryWriter as GeometryWriter
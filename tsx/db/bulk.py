@@ -0,0 +1,98 @@
+from sqlalchemy import text
+import tsx.config
+import shapely.wkb
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+default_batch_size = 500
+
+class BulkWriter:
+    """
+    Buffers rows and inserts them in batches with `executemany`, rather than one round trip per row
+
+    Usage::
+
+        with BulkWriter(session, 't2_site_taxon_presence', ['site_id', 'taxon_id']) as writer:
+            for ...:
+                writer.add(site_id = ..., taxon_id = ...)
+
+    Rows are flushed when the batch is full and when the writer is closed.
+
+    The batch size defaults to the `bulk_insert_batch_size` option in the `database` config section.
+    """
+    def __init__(self, session, table, columns, batch_size = None):
+        self.session = session
+        self.table = table
+        self.columns = list(columns)
+        self.batch_size = batch_size or int(tsx.config.get("database", "bulk_insert_batch_size", default_batch_size))
+        self.rows = []
+        self.row_count = 0
+        self.elapsed = 0.0
+
+        self.sql = text("INSERT INTO %s (%s) VALUES (%s)" % (
+            table,
+            ", ".join(self.columns),
+            ", ".join(self.value_expression(column) for column in self.columns)
+        ))
+
+    def value_expression(self, column):
+        return ":%s" % column
+
+    def add(self, **row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            t0 = time.perf_counter()
+            self.session.execute(self.sql, self.rows)
+            self.elapsed += time.perf_counter() - t0
+            self.row_count += len(self.rows)
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.row_count > 0:
+            log.info("%s: inserted %s rows in %0.2fs (%0.0f rows/s)" % (self.table, self.row_count, self.elapsed, self.row_count / max(self.elapsed, 1e-9)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Don't bother inserting buffered rows if something went wrong (the transaction will be rolled back anyway)
+        if exc_type is None:
+            self.close()
+
+class GeometryWriter(BulkWriter):
+    """
+    A `BulkWriter` for rows containing geometries
+
+    Usage::
+
+        with GeometryWriter(session, 'region_subdiv', ['id', 'name', 'geometry']) as writer:
+            for ...:
+                writer.add(id = ..., name = ..., geometry = geom)
+
+    Geometry columns (by default just 'geometry') accept shapely geometries, which are converted to WKB. Works with both
+    MySQL and spatialite sessions.
+    """
+    def __init__(self, session, table, columns, geometry_columns = ('geometry',), batch_size = None):
+        self.geometry_columns = set(geometry_columns)
+        if session.get_bind().dialect.name == 'sqlite':
+            self.geometry_expression = "ST_GeomFromWKB(:%s, -1)"
+        else:
+            self.geometry_expression = "ST_GeomFromWKB(_BINARY :%s)"
+        super().__init__(session, table, columns, batch_size)
+
+    def value_expression(self, column):
+        if column in self.geometry_columns:
+            return self.geometry_expression % column
+        return super().value_expression(column)
+
+    def add(self, **row):
+        for column in self.geometry_columns:
+            row[column] = shapely.wkb.dumps(row[column])
+        super().add(**row)
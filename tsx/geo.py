@@ -5,11 +5,33 @@ from shapely.ops import transform
 import pyproj
 from contextlib import contextmanager
 import fiona
+import numpy as np
+import shapely
 
 def reproject_fn(src_proj, dest_proj):
 	transformer = pyproj.Transformer.from_proj(src_proj, dest_proj, always_xy=True)
 	return lambda geom: transform(transformer.transform, geom)
 
+def reproject_xy(xs, ys, transformer):
+	"""
+	Reprojects arrays of x and y coordinates with a single call to the transformer
+
+	This is much faster than reprojecting a shapely Point per coordinate, and avoids allocating any geometry objects.
+	Returns a tuple of (xs, ys) arrays.
+	"""
+	xs = np.asarray(xs, dtype=float)
+	ys = np.asarray(ys, dtype=float)
+	if len(xs) == 0:
+		return xs, ys
+	return transformer.transform(xs, ys)
+
+def xy_arrays(rows):
+	"""
+	Converts a sequence of (x, y) rows (e.g. a database query result) into a tuple of (xs, ys) arrays
+	"""
+	coords = np.array(rows, dtype=float).reshape(-1, 2)
+	return coords[:, 0], coords[:, 1]
+
 
 # Opening a shapefile and reprojecting it is really verbose
 @contextmanager
@@ -19,9 +41,93 @@ def open_shapefile(filename, dest_crs):
 		reproject = reproject_fn(src_crs, dest_crs)
 		yield shp, reproject
 
-def subdivide_geometry(geometry, max_points = 100, max_extent = None):
+def subdivide_geometry(geometry, max_points = 100, max_extent = None, n_workers = 1):
 	"""
 	Subdivides a geometry into pieces having no more than max_points points each
+
+	Each level of the split tree is processed as a single batch of vectorized shapely operations. The pieces (and their
+	order) are identical to `subdivide_geometry_queue`.
+
+	If n_workers > 1, large geometries are split until there is enough work to go around, and the remaining subtrees
+	are subdivided in a process pool.
+	"""
+	if n_workers > 1 and shapely.get_num_coordinates(geometry) > parallel_subdivide_min_points:
+		from tsx.util import run_parallel
+
+		# Split until there are a few subtrees per worker
+		leaves, pending = _subdivide_levels([geometry], [()], max_points, max_extent, min_pending = n_workers * 4)
+
+		tasks = [(path, geom, max_points, max_extent) for geom, path in zip(*pending)]
+		for result, error in run_parallel(_subdivide_subtree, tasks, n_workers = n_workers):
+			if error:
+				raise error
+			leaves.extend(result)
+	else:
+		leaves, pending = _subdivide_levels([geometry], [()], max_points, max_extent)
+
+	yield from _dfs_order(leaves)
+
+# Geometries with fewer points than this aren't worth sending to a process pool
+parallel_subdivide_min_points = 100000
+
+def _subdivide_subtree(path, geom, max_points, max_extent):
+	leaves, pending = _subdivide_levels([geom], [path], max_points, max_extent)
+	return leaves
+
+def _subdivide_levels(geoms, paths, max_points, max_extent, min_pending = None):
+	"""
+	Splits geometries level by level until every piece satisfies max_points and max_extent (or, if min_pending is
+	specified, until at least min_pending pieces still need splitting)
+
+	Each piece is identified by its path in the split tree (a tuple of 0 = first half, 1 = second half).
+	Returns a list of finished (path, geom) tuples, and a tuple of (geoms, paths) still to be split.
+	"""
+	leaves = []
+	geoms = np.asarray(geoms, dtype=object)
+
+	while len(geoms) > 0:
+		ok = np.ones(len(geoms), dtype=bool)
+		if max_points is not None:
+			ok &= shapely.get_num_coordinates(geoms) <= max_points
+		bounds = shapely.bounds(geoms)
+		if max_extent is not None:
+			# Note: empty geometries have NaN bounds, so are never split
+			ok &= ~(np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1]) > max_extent)
+
+		leaves.extend((paths[i], geoms[i]) for i in np.flatnonzero(ok))
+
+		split = ~ok
+		geoms, bounds = geoms[split], bounds[split]
+		paths = [path for path, s in zip(paths, split) if s]
+
+		if min_pending is not None and len(geoms) >= min_pending:
+			break
+
+		# Intersect each geometry with each half of its bounding box (see `split_bounds`)
+		minx, miny, maxx, maxy = bounds.T
+		tall = maxy - miny > maxx - minx
+		midx = (minx + maxx) / 2
+		midy = (miny + maxy) / 2
+		first = shapely.box(minx, miny, np.where(tall, maxx, midx), np.where(tall, midy, maxy))
+		second = shapely.box(np.where(tall, minx, midx), np.where(tall, midy, miny), maxx, maxy)
+
+		geoms = np.concatenate([shapely.intersection(geoms, first), shapely.intersection(geoms, second)])
+		paths = [path + (0,) for path in paths] + [path + (1,) for path in paths]
+
+	return leaves, (geoms, paths)
+
+def _dfs_order(leaves):
+	"""
+	Orders (path, geom) tuples in the order they are yielded by `subdivide_geometry_queue`, which takes the second half
+	of each split first
+	"""
+	return [geom for path, geom in sorted(leaves, key = lambda leaf: tuple(1 - c for c in leaf[0]))]
+
+def subdivide_geometry_queue(geometry, max_points = 100, max_extent = None):
+	"""
+	Subdivides a geometry into pieces having no more than max_points points each
+
+	This is the original one-piece-at-a-time implementation, kept for benchmarking.
 	"""
 	q = deque([geometry])
 
@@ -37,6 +143,30 @@ def subdivide_geometry(geometry, max_points = 100, max_extent = None):
 			for b in split_bounds(*geom.bounds):
 				q.append(geom.intersection(Polygon.from_bounds(*b)))
 
+def intersect_pieces(pieces, geom):
+	"""
+	Intersects geom with each of a list of pieces (e.g. the output of `subdivide_geometry`)
+
+	geom is split into its parts, and an STRtree is used to find the (piece, part) pairs that actually intersect, so that
+	each piece is only intersected with the nearby parts of geom rather than the whole thing.
+
+	Returns a list of the non-empty intersections as MultiPolygons, one per intersecting piece.
+	"""
+	pieces = np.asarray(pieces, dtype=object)
+	if len(pieces) == 0 or geom.is_empty:
+		return []
+
+	parts = shapely.get_parts(geom)
+	piece_index, part_index = shapely.STRtree(parts).query(pieces, predicate='intersects')
+
+	result = {}
+	for i, g in zip(piece_index, shapely.intersection(pieces[piece_index], parts[part_index])):
+		result.setdefault(i, []).append(g)
+
+	# The parts of geom are disjoint, so the intersections for each piece can be collected without a union
+	result = [to_multipolygon(GeometryCollection(geoms)) for geoms in result.values()]
+	return [g for g in result if not g.is_empty]
+
 def extent(geom):
 	minx, miny, maxx, maxy = geom.bounds
 	return max(maxx - minx, maxy - miny)
@@ -158,6 +288,18 @@ def point_intersects_geom(poly, x, y, cache, z = 2, tile_key = None, tile_bounds
 	else:
 		return point_intersects_geom(val, x, y, cache, z = z + 2, tile_key = tile_key, tile_bounds = tile_bounds) # z + 2 chosen based on testing
 
+def points_in_polygon(xs, ys, geom):
+	"""
+	Vectorized point in polygon test
+
+	Returns a boolean NumPy array which is True for each point (xs[i], ys[i]) that intersects geom (i.e. points on the
+	boundary count as inside, as with `point_intersects_geom`).
+
+	geom is prepared in-place if it is not already, so repeated calls with the same geometry are cheap.
+	"""
+	shapely.prepare(geom)
+	return shapely.intersects_xy(geom, np.asarray(xs, dtype=float), np.asarray(ys, dtype=float))
+
 def fast_difference(a, b):
 	# We can extend this to other geometry types if we want
 	if not isinstance(a, MultiPoint) or not isinstance(b, Polygon | MultiPolygon):
@@ -166,10 +308,6 @@ def fast_difference(a, b):
 	if b.is_empty:
 		return a
 
-	cache = {}
-	result = []
-	for point in a.geoms:
-		if not point_intersects_geom(b, point.x, point.y, cache):
-			result.append(point)
+	coords = shapely.get_coordinates(a)
+	return shapely.multipoints(coords[~points_in_polygon(coords[:, 0], coords[:, 1], b)])
 
-	return MultiPoint(result)
@@ -1,5 +1,5 @@
 import fiona
-from tsx.db import get_session
+from tsx.db import get_session, GeometryWriter
 import os
 import logging
 import sys
@@ -21,27 +21,38 @@ def main():
 
 	parser = argparse.ArgumentParser(description='Import species range polygons into TSX database')
 	parser.add_argument('dir', type=str, help='Directory containing species range shapefiles')
+	parser.add_argument('--subdivide', action='store_true', help='Also insert subdivided range polygons into taxon_range_subdiv (used by alpha hull processing with range_clip=pieces)')
 	args = parser.parse_args()
 
+	global insert_subdivided
+	insert_subdivided = args.subdivide
+
 	session = get_session()
 
 	filenames = [f for f in os.listdir(args.dir) if f.endswith('.shp')]
 
+	columns = ['taxon_id', 'range_id', 'breeding_range_id', 'geometry']
+	range_writer = GeometryWriter(session, 'taxon_range', columns)
+	subdiv_writer = GeometryWriter(session, 'taxon_range_subdiv', columns)
+
 	for filename in tqdm(filenames):
 		spno = int(filename[0:-4])
 		try:
 			# https://pyproj4.github.io/pyproj/stable/crs_compatibility.html#fiona
 			with fiona.Env(OSR_WKT_FORMAT="WKT2_2018"), fiona.open(os.path.join(args.dir, filename), encoding = 'Windows-1252') as shp:
-				process_shp(session, spno, shp)
+				process_shp(session, spno, shp, range_writer, subdiv_writer)
 		except KeyboardInterrupt:
 			log.info("Aborting - no changes saved")
 			return
 
+	range_writer.close()
+	subdiv_writer.close()
+
 	session.commit()
 
 _taxon_re = re.compile(r'(u?[0-9]+)([a-z](\.[a-z])*)?')
 
-def process_shp(session, spno, shp):
+def process_shp(session, spno, shp, range_writer, subdiv_writer):
 	transformer = pyproj.Transformer.from_crs(pyproj.CRS.from_wkt(shp.crs_wkt), 'EPSG:4326', always_xy=True)
 	for feature in shp:
 		try:
@@ -76,27 +87,21 @@ def process_shp(session, spno, shp):
 			for s in suffix.split("."):
 				taxon_exists = len(session.execute(text("SELECT 1 FROM taxon WHERE id = :id"), { 'id': prefix + s }).fetchall()) > 0
 				if taxon_exists:
-					session.execute(text("""INSERT INTO taxon_range (taxon_id, range_id, breeding_range_id, geometry) VALUES
-						(:taxon_id, :range_id, :breeding_range_id, ST_GeomFromWKB(_BINARY :geom_wkb))"""), {
-							'taxon_id': prefix + s,
-							'range_id': props['RNGE'] or None,
-							'breeding_range_id': props['BRRNGE'] or None,
-							'geom_wkb': shapely.wkb.dumps(geometry)
-						}
-					)
+					range_writer.add(
+						taxon_id = prefix + s,
+						range_id = props['RNGE'] or None,
+						breeding_range_id = props['BRRNGE'] or None,
+						geometry = geometry)
 
 					if insert_subdivided:
 						for geom in subdivide_geometry(geometry.buffer(0)):
 							geom = to_multipolygon(geom)
 							if not geom.is_empty:
-								session.execute(text("""INSERT INTO taxon_range_subdiv (taxon_id, range_id, breeding_range_id, geometry) VALUES
-									(:taxon_id, :range_id, :breeding_range_id, ST_GeomFromWKB(_BINARY :geom_wkb))"""), {
-										'taxon_id': prefix + s,
-										'range_id': props['RNGE'] or None,
-										'breeding_range_id': props['BRRNGE'] or None,
-										'geom_wkb': shapely.wkb.dumps(to_multipolygon(geom))
-									}
-								)
+								subdiv_writer.add(
+									taxon_id = prefix + s,
+									range_id = props['RNGE'] or None,
+									breeding_range_id = props['BRRNGE'] or None,
+									geometry = geom)
 
 		except:
 			log.error("Error processing row: %s" % props)
@@ -1,5 +1,5 @@
 import fiona
-from tsx.db import get_session
+from tsx.db import get_session, GeometryWriter
 import logging
 import sys
 import argparse
@@ -11,6 +11,7 @@ from shapely.geometry import shape
 from fiona.transform import transform_geom
 from sqlalchemy import text
 from tsx.preprocessing import region_db_path
+from tsx.processing.region_lookup import create_cache_table, clear_cache
 import os
 
 log = logging.getLogger(__name__)
@@ -27,8 +28,14 @@ def main():
 
 	session = get_session()
 
+	# Before making any changes, as this implicitly commits in MySQL
+	create_cache_table(session)
+
 	session.execute(text("DELETE FROM t1_survey_region"))
 
+	region_writer = GeometryWriter(session, 'region', ['id', 'name', 'geometry', 'state', 'positional_accuracy_in_m'])
+	subdiv_writer = GeometryWriter(session, 'region_subdiv', ['id', 'name', 'geometry'])
+
 	with fiona.open(args.filename, encoding = 'Windows-1252') as shp:
 		for index, feature in enumerate(tqdm(shp)):
 			props = feature['properties']
@@ -36,27 +43,29 @@ def main():
 			geometry = shape(transform_geom(shp.crs, 'EPSG:4326', feature['geometry']))
 			geometry = geometry.buffer(0)
 
-			session.execute(text("""INSERT INTO region (id, name, geometry, state, positional_accuracy_in_m)
-					VALUES (:id, :name, ST_GeomFromWKB(_BINARY :geometry_wkb), :state, :positional_accuracy_in_m)"""), {
-						'id': index,
-						'name': props['RegName'],
-						'geometry_wkb': shapely.wkb.dumps(to_multipolygon(geometry)),
-						'state': props['StateName'],
-						'positional_accuracy_in_m': int(props['Accuracy'])
-					})
+			region_writer.add(
+				id = index,
+				name = props['RegName'],
+				geometry = to_multipolygon(geometry),
+				state = props['StateName'],
+				positional_accuracy_in_m = int(props['Accuracy']))
 
 			for geometry in subdivide_geometry(geometry):
+				subdiv_writer.add(
+					id = index,
+					name = props['RegName'],
+					geometry = to_multipolygon(geometry))
 
-				session.execute(text("""INSERT INTO region_subdiv (id, name, geometry)
-					VALUES (:id, :name, ST_GeomFromWKB(_BINARY :geometry_wkb))"""), {
-						'id': index,
-						'name': props['RegName'],
-						'geometry_wkb': shapely.wkb.dumps(to_multipolygon(geometry))
-					})
+	region_writer.close()
+	subdiv_writer.close()
 
 	log.info("Updating t1_survey_region (this may take a while)")
 	session.execute(text("CALL update_t1_survey_region(NULL)"))
 
+	# Cached regions are for the old regions (they would not be used anyway, as the cache is keyed by a fingerprint of the
+	# regions, but this frees up the space)
+	clear_cache(session)
+
 	session.commit()
 
 	try:
@@ -9,17 +9,26 @@ import os
 from tsx.db import get_session
 from tsx.mysql_to_sqlite import export_to_sqlite
 import binascii
-from tsx.util import get_resource
+import tsx.util
+from tsx.util import get_resource, WorkerPool
 import subprocess
 import shutil
 from datetime import datetime
 import random
+import threading
+import queue
+import time
 import tsx.processing.alpha_hull
+import tsx.processing.coastline
+import tsx.processing.site_taxon_presence
 import tsx.processing.t1_aggregation
 import tsx.processing.t2_aggregation
 import tsx.processing.export_lpi
 import tsx.processing.spatial_rep
 import tsx.processing.filter_time_series
+import tsx.processing.incremental
+import tsx.processing.region_lookup
+from tsx.processing.journal import Journal, STEP_COMPLETE
 from tsx.geo import to_multipolygon
 from sqlalchemy import text
 
@@ -39,10 +48,12 @@ def main():
 
     parser.add_argument('--species', '-s', help='Comma separated list of species numbers (SPNO) to process')
     parser.add_argument('--commit', '-c', action='store_true', dest='commit', help='Commit changes to database (default is dry-run)')
+    parser.add_argument('--profile-dir', help='Write a report of task timings and memory usage for each processing step to this directory')
 
     subparsers = parser.add_subparsers(help = 'command', dest = 'command')
 
     p = subparsers.add_parser('alpha_hull')
+    p = subparsers.add_parser('coastline')
     p = subparsers.add_parser('export')
 
     p.add_argument('layers', nargs='+', choices=['alpha', 'ultrataxa', 'pa'], help='Layers to export')
@@ -50,7 +61,12 @@ def main():
     p = subparsers.add_parser('range_ultrataxon') # LEGACY
     p = subparsers.add_parser('pseudo_absence') # LEGACY
     p = subparsers.add_parser('t1_aggregation')
+    p.add_argument('--engine', choices=tsx.processing.t1_aggregation.engines, help='Aggregation engine (default is set in config)')
+    p.add_argument('--fused', action='store_true', default=None, help='Perform yearly aggregation in the same pass as monthly aggregation')
+    p = subparsers.add_parser('site_taxon_presence')
     p = subparsers.add_parser('t2_aggregation')
+    p.add_argument('--batch-size', type=int, help='Number of taxa aggregated together (default is set in config)')
+    p.add_argument('--engine', choices=tsx.processing.t2_aggregation.engines, help='Aggregation engine (default is set in config)')
     p = subparsers.add_parser('response_variable') # LEGACY
     p = subparsers.add_parser('export_lpi')
 
@@ -62,6 +78,10 @@ def main():
     p = subparsers.add_parser('filter_time_series')
     p = subparsers.add_parser('clear')
     p = subparsers.add_parser('all')
+    p.add_argument('--resume', '-r', action='store_true', dest='resume', help='Resume a previous run that failed or was interrupted, skipping completed steps and taxa')
+    p.add_argument('--sequential', action='store_true', dest='sequential', help='Run the processing steps one at a time, instead of overlapping independent steps')
+    p = subparsers.add_parser('incremental', help='Recompute only the species affected by data imports since the last run')
+    p.add_argument('--sequential', action='store_true', dest='sequential', help='Run the processing steps one at a time, instead of overlapping independent steps')
     p = subparsers.add_parser('simple')
 
     p = subparsers.add_parser('single_source')
@@ -80,14 +100,47 @@ def main():
     if not args.commit:
         log.info("Not committing any changes to database (dry-run only)")
 
+    if args.profile_dir:
+        os.makedirs(args.profile_dir, exist_ok = True)
+        tsx.util.profile_dir = args.profile_dir
+
+    if args.commit and args.command in table_commands:
+        create_processing_tables()
+
+    # Start worker processes once and reuse them for every processing step, rather than once per step
+    if args.command in pooled_commands:
+        with WorkerPool(preload = worker_preload, init_db = True):
+            run_command(args, species)
+    else:
+        run_command(args, species)
+
+# Commands that write the tables created by `create_processing_tables`
+table_commands = ['all', 'incremental', 'site_taxon_presence', 't2_aggregation', 'clear']
+
+# Commands that use run_parallel
+pooled_commands = ['alpha_hull', 't1_aggregation', 't2_aggregation', 'spatial_rep', 'all', 'incremental', 'simple', 'single_source']
+
+# Modules imported by each worker process on startup
+worker_preload = [
+    'tsx.processing.alpha_hull',
+    'tsx.processing.t1_aggregation',
+    'tsx.processing.t2_aggregation',
+    'tsx.processing.spatial_rep'
+]
+
+def run_command(args, species):
     if args.command == 'alpha_hull':
         tsx.processing.alpha_hull.process_database(species = species, commit = args.commit)
+    elif args.command == 'coastline':
+        tsx.processing.coastline.build_coastline_asset()
     elif args.command == 'export':
         export(args.layers, species = species)
     elif args.command == 't1_aggregation':
-        tsx.processing.t1_aggregation.process_database(species = species, commit = args.commit)
+        tsx.processing.t1_aggregation.process_database(species = species, commit = args.commit, engine = args.engine, fused = args.fused)
+    elif args.command == 'site_taxon_presence':
+        tsx.processing.site_taxon_presence.process_database(species = species, commit = args.commit)
     elif args.command == 't2_aggregation':
-        tsx.processing.t2_aggregation.process_database(species = species, commit = args.commit)
+        tsx.processing.t2_aggregation.process_database(species = species, commit = args.commit, batch_size = args.batch_size, engine = args.engine)
     elif args.command == 'export_lpi':
         tsx.processing.export_lpi.process_database(species = species, monthly = args.monthly, filter_output = args.filter, include_all_years_data = args.include_all_years_data)
     elif args.command == 'spatial_rep':
@@ -113,23 +166,62 @@ def main():
             log.error("Passing species not supported for 'all'")
             return
 
-        log.info("STEP 0 - CLEARING PREVIOUS RESULTS")
-        clear_database()
+        # Progress is recorded in the run journal, so that a failed run can be resumed with --resume
+        journal = Journal()
+
+        # Record the state of the sources for the next incremental run. When resuming, this is the state when the run
+        # started, as data imported since then has not been processed by the steps already completed.
+        if args.resume:
+            snapshot = tsx.processing.incremental.Snapshot.from_journal(journal)
+            if snapshot is None:
+                log.warning("No snapshot of the sources found for the run being resumed - the next incremental run will also recompute data processed by this run")
+        else:
+            journal.clear()
+            session = get_session()
+            snapshot = tsx.processing.incremental.Snapshot(session)
+            session.close()
+            snapshot.record(journal)
+
+        if not run_pipeline(get_pipeline_steps(journal), journal, sequential = args.sequential):
+            log.error("PROCESSING FAILED - fix the problem and then run again with --resume")
+            exit(1)
+
+        if snapshot is not None:
+            snapshot.save()
+
+        log.info("PROCESSING COMPLETE")
+
+    elif args.command == 'incremental':
+        if not args.commit:
+            log.error("Dry-run mode not supported for 'incremental'")
+            return
+        if args.species:
+            log.error("Passing species not supported for 'incremental'")
+            return
 
-        log.info("STEP 1 - ALPHA HULLS")
-        tsx.processing.alpha_hull.process_database(commit = True)
+        session = get_session()
+        snapshot = tsx.processing.incremental.Snapshot(session)
+        changes = tsx.processing.incremental.find_changes(session, snapshot)
+        session.close()
 
-        log.info("STEP 2 - TYPE 1 DATA AGGREGATION")
-        tsx.processing.t1_aggregation.process_database(commit = True)
+        if changes is None:
+            log.error("No record of a previous run found - run 'all' first")
+            return
 
-        log.info("STEP 3 - TYPE 2 DATA AGGREGATION")
-        tsx.processing.t2_aggregation.process_database(commit = True)
+        species, taxa = changes
+        log.info("%s species to recompute, %s taxa to filter" % (len(species), len(taxa)))
 
-        log.info("STEP 4 - CALCULATE SPATIAL REPRESENTATIVENESS")
-        tsx.processing.spatial_rep.process_database(commit = True)
+        if len(species) > 0:
+            # Note: an incremental run can't be resumed, but is safe to repeat if it fails
+            journal = Journal()
+            journal.clear()
+            if not run_pipeline(get_pipeline_steps(journal, species = species, taxa = taxa), journal, sequential = args.sequential):
+                log.error("PROCESSING FAILED - fix the problem and then run again")
+                exit(1)
+        elif len(taxa) > 0:
+            tsx.processing.filter_time_series.process_database(taxa = taxa)
 
-        log.info("STEP 5 - FILTER TIME SERIES")
-        tsx.processing.filter_time_series.process_database()
+        snapshot.save()
 
         log.info("PROCESSING COMPLETE")
 
@@ -156,6 +248,203 @@ def main():
         log.info("Processing source %s" % args.source_id)
         process_source(args.source_id, args.output_dir)
 
+def get_pipeline_steps(journal, species = None, taxa = None):
+    """
+    The steps of `python -m tsx.process all`, and the tables each step reads and writes (see `Step`)
+
+    If `species` is supplied, only the results for those species are cleared and recomputed, and only the time series for
+    `taxa` are filtered (see `tsx.processing.incremental`).
+    """
+    alpha_hull = Step(tsx.processing.alpha_hull.step_name, "ALPHA HULLS",
+        lambda: tsx.processing.alpha_hull.process_database(species = species, commit = True, journal = journal),
+        inputs = ['t1_sighting', 't2_sighting', 'taxon_range', 'taxon_range_subdiv'],
+        outputs = ['taxon_presence_alpha_hull', 'taxon_presence_alpha_hull_subdiv'])
+
+    site_taxon_presence = Step(tsx.processing.site_taxon_presence.step_name, "TYPE 2 SITE PRESENCE",
+        lambda: tsx.processing.site_taxon_presence.process_database(species = species, commit = True, journal = journal, hulls_ready = hulls_ready),
+        inputs = ['t2_survey', 'taxon_presence_alpha_hull_subdiv'],
+        outputs = ['t2_site_taxon_presence'],
+        streams = ['taxon_presence_alpha_hull_subdiv'])
+
+    # Lets site presence be computed for each species as soon as its alpha hull has been committed
+    hulls_ready = species_ready(journal, alpha_hull)
+
+    # Lets type 2 aggregation process each taxon as soon as its site presence has been committed
+    presence_ready = species_ready(journal, site_taxon_presence)
+
+    return [
+        Step('clear', "CLEARING PREVIOUS RESULTS",
+            clear_database if species is None else lambda: tsx.processing.incremental.clear_species(species),
+            outputs = ['taxon_presence_alpha_hull', 'taxon_presence_alpha_hull_subdiv', 't2_site_taxon_presence', 't2_survey_site', 'aggregated_by_year', 'aggregated_by_month', 'taxon_source_alpha_hull']),
+        alpha_hull,
+        site_taxon_presence,
+        Step('t1_aggregation', "TYPE 1 DATA AGGREGATION",
+            lambda: tsx.processing.t1_aggregation.process_database(species = species, commit = True, journal = journal),
+            inputs = ['t1_survey', 't1_sighting', 'region_subdiv', 'processing_method'],
+            outputs = ['aggregated_by_month:1', 'aggregated_by_year:1']),
+        Step('t2_aggregation', "TYPE 2 DATA AGGREGATION",
+            lambda: tsx.processing.t2_aggregation.process_database(species = species, commit = True, journal = journal, presence_ready = presence_ready),
+            inputs = ['t2_survey', 't2_sighting', 'region_subdiv', 'processing_method', 't2_site_taxon_presence'],
+            outputs = ['aggregated_by_month:2', 'aggregated_by_year:2'],
+            streams = ['t2_site_taxon_presence']),
+        Step('spatial_rep', "CALCULATE SPATIAL REPRESENTATIVENESS",
+            lambda: tsx.processing.spatial_rep.process_database(species = species, commit = True, journal = journal),
+            inputs = ['t1_survey', 't1_sighting', 't2_survey', 'aggregated_by_year:2', 'taxon_range'],
+            outputs = ['taxon_source_alpha_hull']),
+        Step('filter_time_series', "FILTER TIME SERIES",
+            lambda: tsx.processing.filter_time_series.process_database(taxa = taxa),
+            inputs = ['aggregated_by_year', 'data_source', 'custodian_feedback', 'data_source_excluded_years'],
+            outputs = ['aggregated_by_year:include_in_analysis', 'time_series_inclusion', 'data_source_merged'])
+    ]
+
+class Step:
+    """
+    A processing step in a pipeline (see `run_pipeline`)
+
+    `inputs` and `outputs` are the tables read and written by the step. A table name can be qualified with a part of the
+    table that is read or written independently of the rest, e.g. 'aggregated_by_year:1' for the type 1 rows. A step
+    depends on each earlier step that writes one of its inputs, reads one of its outputs, or writes one of its outputs.
+
+    `streams` lists inputs that the step can consume while they are being written, i.e. it can start as soon as the steps
+    that write them have started, and is responsible for waiting for the data it needs.
+    """
+    def __init__(self, name, description, fn, inputs = (), outputs = (), streams = ()):
+        self.name = name
+        self.description = description
+        self.fn = fn
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+        self.streams = set(streams)
+        self.depends_on = []
+        self.streams_from = []
+        self.state = 'pending'
+        self.start_time = None
+        self.end_time = None
+
+    def finished(self):
+        """
+        Returns True if the step has completed (raises an exception if the step failed)
+        """
+        if self.state == 'failed':
+            raise RuntimeError("Step failed: %s" % self.name)
+        return self.state in ('done', 'skipped')
+
+def species_ready(journal, step):
+    """
+    Returns a function for a step that streams the output of `step`, which returns the set of species numbers that
+    `step` has committed so far, or None once `step` has completed
+
+    `step` must record species numbers as its journal tasks (as the alpha_hull and site_taxon_presence steps do). The
+    function is called from the streaming step's thread. The journal is read after checking whether `step` has
+    completed, and `step` is only marked as completed after all of its tasks have been committed, so no species is
+    missed if `step` completes in between.
+    """
+    def ready():
+        if step.finished():
+            return None
+        return set(int(spno) for spno in journal.completed_tasks(step.name) if spno != STEP_COMPLETE)
+    return ready
+
+def tables_overlap(a, b):
+    for x in a:
+        for y in b:
+            if x == y or x.startswith(y + ':') or y.startswith(x + ':'):
+                return True
+    return False
+
+def link_steps(steps, sequential = False):
+    """
+    Sets `depends_on` and `streams_from` for each step, from the tables read and written by the steps (see `Step`)
+    """
+    for i, step in enumerate(steps):
+        step.depends_on = []
+        step.streams_from = []
+        for prev in steps[:i]:
+            if sequential or tables_overlap(step.inputs - step.streams, prev.outputs) or tables_overlap(step.outputs, prev.inputs | prev.outputs):
+                step.depends_on.append(prev)
+            elif tables_overlap(step.streams, prev.outputs):
+                step.streams_from.append(prev)
+
+def run_pipeline(steps, journal, sequential = False):
+    """
+    Runs processing steps, each in its own thread as soon as the steps it depends on have completed, so that independent
+    steps overlap (their tasks share the active `WorkerPool`)
+
+    Steps already completed according to the journal are skipped, and each step is recorded in the journal as it completes.
+    If `sequential` is True, steps are run one at a time in the order given.
+
+    Prints a timeline of the run, and returns False if any step failed.
+    """
+    link_steps(steps, sequential)
+
+    t0 = time.time()
+    finished_q = queue.Queue()
+
+    def run(step):
+        try:
+            step.fn()
+            journal.complete_step(step.name)
+            step.state = 'done'
+        except BaseException: # Note: steps may call exit()
+            log.exception("Step failed: %s" % step.name)
+            step.state = 'failed'
+        step.end_time = time.time() - t0
+        finished_q.put(step)
+
+    running = 0
+    failed = False
+    while True:
+        if not failed:
+            for i, step in enumerate(steps):
+                if step.state == 'pending' and all(d.state in ('done', 'skipped') for d in step.depends_on) and all(d.state != 'pending' for d in step.streams_from):
+                    step.start_time = time.time() - t0
+                    if journal.step_complete(step.name):
+                        log.info("STEP %s - %s (already complete)" % (i, step.description))
+                        step.state = 'skipped'
+                        step.end_time = step.start_time
+                        finished_q.put(step)
+                    else:
+                        log.info("STEP %s - %s" % (i, step.description))
+                        step.state = 'running'
+                        thread = threading.Thread(target = run, args = (step,))
+                        thread.daemon = True
+                        thread.start()
+                    running += 1
+
+        if running == 0:
+            break
+
+        step = finished_q.get()
+        running -= 1
+        if step.state == 'failed':
+            failed = True
+        elif step.state == 'done':
+            log.info("Completed step %s in %0.1fs" % (step.name, step.end_time - step.start_time))
+
+    log_timeline(steps, time.time() - t0)
+
+    return not failed
+
+def log_timeline(steps, elapsed, width = 50):
+    """
+    Logs a chart of when each step ran, and how much time was saved by overlapping steps
+    """
+    log.info("Timeline:")
+    for step in steps:
+        if step.start_time is None:
+            log.info("  %-20s (not run)" % step.name)
+            continue
+        start = int(width * step.start_time / max(elapsed, 1e-9))
+        end = max(int(round(width * step.end_time / max(elapsed, 1e-9))), start + 1)
+        bar = ' ' * start + '#' * (end - start) + ' ' * (width - end)
+        log.info("  %-20s |%s| %7.1fs - %7.1fs %s" % (step.name, bar, step.start_time, step.end_time, step.state))
+
+    # Note: steps take longer when they overlap, because they share the workers, so the total step time is an upper
+    # estimate of the time the steps would take when run one at a time
+    total = sum(step.end_time - step.start_time for step in steps if step.start_time is not None)
+    log.info("Elapsed time %0.1fs, total step time %0.1fs: overlapping steps saved up to %0.1fs (%0.0f%%)" % (
+        elapsed, total, total - elapsed, 100.0 * (total - elapsed) / max(total, 1e-9)))
+
 tmp_dir = '/tmp/tsx-work'
 
 def is_csv_empty(path):
@@ -197,6 +486,20 @@ def process_source(source_id, output_dir = None):
         shutil.copy(os.path.join(path, "data_infile_Results.txt"), os.path.join(output_dir, "trend.csv"))
     log.info("done")
 
+def create_processing_tables():
+    """
+    Creates the processing tables that may be missing from databases created with an older version of create.sql
+
+    This is done once, up front, in its own session, because in MySQL DDL statements implicitly commit any changes made so
+    far in a session.
+    """
+    session = get_session()
+    tsx.processing.incremental.create_fingerprint_tables(session)
+    tsx.processing.region_lookup.create_cache_table(session)
+    tsx.processing.site_taxon_presence.create_table(session)
+    session.commit()
+    session.close()
+
 def clear_database():
     # Clears out all derived data from the database
     session = get_session()
@@ -205,6 +508,7 @@ def clear_database():
         "TRUNCATE taxon_presence_alpha_hull;",
         "TRUNCATE taxon_presence_alpha_hull_subdiv;",
         "TRUNCATE t2_survey_site;",
+        "TRUNCATE t2_site_taxon_presence;",
         "TRUNCATE aggregated_by_year;",
         "TRUNCATE aggregated_by_month;",
         "SET FOREIGN_KEY_CHECKS = 1;"
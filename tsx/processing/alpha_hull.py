@@ -11,15 +11,22 @@ import math
 import sys
 import getopt
 from shapely.geometry import shape, Point, MultiPolygon
-from tsx.geo import to_multipolygon, subdivide_geometry, fast_difference
+from tsx.geo import to_multipolygon, subdivide_geometry, points_in_polygon, reproject_xy, xy_arrays, intersect_pieces
 from tsx.util import run_parallel
-from tsx.db import get_session
+from tsx.processing.journal import record_task
+from tsx.processing.coastline import build_coastline_asset, get_coastal_shape, clip_to_coastline
+from tsx.db import get_session, GeometryWriter
 import tsx.db.connect
 import tsx.config
 from tqdm import tqdm
 import logging
+import shapely
 import shapely.wkb
+import shapely.errors
 import binascii
+import hashlib
+import json
+import os
 from sqlalchemy import text
 
 
@@ -118,6 +125,56 @@ def alpha_shape(coords, alpha):
     triangles = list(polygonize(m))
     return unary_union(triangles), edge_points
 
+def alpha_shape_numpy(coords, alpha):
+    """
+    Create alpha shape in following Burgman and Fox paper.
+
+    Equivalent to `alpha_shape`, but computes edges, edge lengths and the triangle filter as array operations
+    on the Delaunay simplices instead of looping over them in Python.
+    """
+    # Return empty geometry if not enough points
+    if len(coords) < 3:
+        return MultiPolygon(), None
+
+    coords = np.asarray(coords, dtype=float)
+
+    tri = Delaunay(coords)
+    simplices = tri.simplices
+
+    # Each triangle contributes edges (a, b), (b, c) and (c, a)
+    edges = np.concatenate([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [2, 0]]])
+
+    # Mean length of all unique edges
+    unique_edges = np.unique(np.sort(edges, axis=1), axis=0)
+    delta = coords[unique_edges[:, 0]] - coords[unique_edges[:, 1]]
+    alphadistance = np.hypot(delta[:, 0], delta[:, 1]).mean() * alpha
+
+    # Keep triangles whose mean side length is less than alpha distance
+    pa, pb, pc = coords[simplices[:, 0]], coords[simplices[:, 1]], coords[simplices[:, 2]]
+    a = np.hypot(*(pa - pb).T)
+    b = np.hypot(*(pb - pc).T)
+    c = np.hypot(*(pc - pa).T)
+    keep = (a + b + c) / 3 < alphadistance
+
+    # Unique edges of the remaining triangles, in the same order that `alpha_shape` would add them
+    kept_edges = np.stack([simplices[keep][:, [0, 1]], simplices[keep][:, [1, 2]], simplices[keep][:, [2, 0]]], axis=1).reshape(-1, 2)
+    _, first_index = np.unique(np.sort(kept_edges, axis=1), axis=0, return_index=True)
+    kept_edges = kept_edges[np.sort(first_index)]
+    edge_points = coords[kept_edges]
+
+    if len(edge_points) == 0:
+        return MultiPolygon(), edge_points
+
+    # Polygonize the edges (rather than just unioning the kept triangles) so that any holes fully enclosed by kept
+    # triangles are filled in exactly as in `alpha_shape`. The faces form a coverage, so can be unioned cheaply.
+    faces = shapely.get_parts(shapely.polygonize(shapely.linestrings(edge_points)))
+    return shapely.coverage_union_all(faces), edge_points
+
+alpha_shape_engines = {
+    'python': alpha_shape,
+    'numpy': alpha_shape_numpy
+}
+
 def thinning(coords, thinning_distance):
     """
     Removes points from coords such that no two points remain within thinning_distance of each other
@@ -132,56 +189,263 @@ def thinning(coords, thinning_distance):
 
     return np.array([coord for i, coord in enumerate(coords) if i not in removed])
 
-def make_alpha_hull(points, coastal_shape,
+def grid_thinning(coords, thinning_distance):
+    """
+    Removes points from coords such that no two points remain within thinning_distance of each other
+
+    Same guarantee as `thinning`, but runs in linear time and memory by hashing points into a grid of
+    thinning_distance sized cells, so that only the neighbouring cells need to be checked for each point.
+
+    Points are visited in sorted (x, y) order and kept if no previously kept point is within thinning_distance,
+    so the output does not depend on the order of the input. Note that this keeps a slightly different set of points
+    from `thinning`, so hulls generated with the two methods differ slightly.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+
+    if thinning_distance <= 0:
+        # Only exact duplicates are within distance zero
+        return np.unique(coords, axis=0)
+
+    if len(coords) == 0:
+        return coords
+
+    coords = coords[np.lexsort((coords[:, 1], coords[:, 0]))]
+
+    # Cell of each point as a single integer, with a margin of one cell so that neighbouring cells have valid keys
+    cells = np.floor(coords / thinning_distance).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    width = int(cells[:, 1].max()) + 2
+    keys = cells[:, 0] * width + cells[:, 1]
+    offsets = [dx * width + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+    # Points with no other point in the neighbouring cells are always kept, and don't affect any other point
+    unique_keys, counts = np.unique(keys, return_counts=True)
+    neighbours = np.zeros(len(keys), dtype=np.int64)
+    for offset in offsets:
+        index = np.searchsorted(unique_keys, keys + offset).clip(max=len(unique_keys) - 1)
+        neighbours += np.where(unique_keys[index] == keys + offset, counts[index], 0)
+    keep = neighbours == 1
+
+    # The remaining points are checked against the kept points in the neighbouring cells, in order
+    max_dist_sq = thinning_distance * thinning_distance
+    grid = {}
+    crowded = np.flatnonzero(~keep)
+    for i, x, y, key in zip(crowded.tolist(), coords[crowded, 0].tolist(), coords[crowded, 1].tolist(), keys[crowded].tolist()):
+        if not any((kx - x) ** 2 + (ky - y) ** 2 <= max_dist_sq for offset in offsets for kx, ky in grid.get(key + offset, ())):
+            grid.setdefault(key, []).append((x, y))
+            keep[i] = True
+
+    return coords[keep]
+
+thinning_methods = {
+    'kdtree': thinning,
+    'grid': grid_thinning
+}
+
+def make_alpha_hull(xs, ys, coastal_shape,
                     thinning_distance=250, alpha=1.6,
-                    hullbuffer_distance=1000, isolatedbuffer_distance=1000):
+                    hullbuffer_distance=1000, isolatedbuffer_distance=1000,
+                    engine='numpy', thinning_method='kdtree', cache=None):
     """
+    `xs` and `ys` are arrays of point coordinates in the working projection
+    `engine` selects the alpha shape implementation - see `alpha_shape_engines`
+    `thinning_method` selects the point thinning implementation - see `thinning_methods`
+    `cache` is an optional `AlphaHullCache` used to reuse hulls computed for the same points in previous runs
     """
-    coords = np.array([point.coords[0] for point in points])
-    thinned_list = thinning(coords, thinning_distance)
-    # print thinned_list
-    concave_hull, edge_points = alpha_shape(thinned_list,alpha=alpha)
-    # buffer
-    alpha_hull_buff = concave_hull.buffer(hullbuffer_distance)
-    # now get the isolated points
-    multipoint = geometry.MultiPoint(points)
-    # single_points = multipoint.difference(alpha_hull_buff).buffer(isolatedbuffer_distance) # slow
-    single_points = fast_difference(multipoint, alpha_hull_buff).buffer(isolatedbuffer_distance)
-    final = alpha_hull_buff.union(single_points)
+    coords = np.column_stack([xs, ys]).astype(float)
+
+    final = None
+    if cache is not None:
+        key = cache.key(coords,
+            engine = engine,
+            thinning_distance = thinning_distance,
+            alpha = alpha,
+            hullbuffer_distance = hullbuffer_distance,
+            isolatedbuffer_distance = isolatedbuffer_distance,
+            thinning_method = thinning_method)
+        final = cache.get(key)
+
+    if final is None:
+        thinned_list = thinning_methods[thinning_method](coords, thinning_distance)
+        # print thinned_list
+        concave_hull, edge_points = alpha_shape_engines[engine](thinned_list,alpha=alpha)
+        # buffer
+        alpha_hull_buff = concave_hull.buffer(hullbuffer_distance)
+        # now get the isolated points
+        # single_points = multipoint.difference(alpha_hull_buff).buffer(isolatedbuffer_distance) # slow
+        isolated = ~points_in_polygon(coords[:, 0], coords[:, 1], alpha_hull_buff)
+        single_points = shapely.multipoints(coords[isolated]).buffer(isolatedbuffer_distance)
+        final = alpha_hull_buff.union(single_points)
+
+        if cache is not None:
+            cache.put(key, final)
 
     #clipping
     if coastal_shape is not None:
-        final = final.intersection(coastal_shape)
+        final = clip_to_coastline(final, coastal_shape)
 
     return final
     #_ = plot_polygon(final)
     #pl.show()
 
 
+class AlphaHullCache:
+    """
+    Persistent, content-addressed cache of alpha hulls (before coastal clipping)
+
+    Hulls are stored as WKB files under `data_dir('cache')/alpha_hull`, keyed by a hash of the input coordinates and
+    the alpha hull parameters, so that unchanged species can skip hull generation on subsequent pipeline runs.
+
+    Note that the key covers all input points, not just the thinned points, because isolated points outside the hull
+    are buffered into the result as well.
+
+    Each worker process creates its own instance; `hits` and `misses` count lookups made through that instance.
+
+    Files are touched when they are read, and `prune` removes the least recently used files once the cache exceeds its
+    maximum size. Unreadable files are removed when they are found.
+    """
+    def __init__(self, path = None):
+        self.path = path or os.path.join(tsx.config.data_dir('cache'), 'alpha_hull')
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, coords, **params):
+        # Sort coordinates so that the key doesn't depend on the order in which the database returned them
+        coords = np.ascontiguousarray(coords[np.lexsort((coords[:, 1], coords[:, 0]))], dtype='<f8')
+        h = hashlib.sha256(coords.tobytes())
+        h.update(json.dumps(params, sort_keys=True).encode('utf8'))
+        return h.hexdigest()
+
+    def file_path(self, key):
+        return os.path.join(self.path, key[0:2], key + '.wkb')
+
+    def get(self, key):
+        path = self.file_path(key)
+        try:
+            with open(path, 'rb') as f:
+                geom = shapely.wkb.loads(f.read())
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except shapely.errors.GEOSException:
+            log.warning("Removing unreadable alpha hull cache file: %s" % path)
+            self.remove(path)
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass # Removed by another process in the meantime
+
+        self.hits += 1
+        return geom
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def put(self, key, geom):
+        path = self.file_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename, so that concurrent workers never see a partially written file
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(shapely.wkb.dumps(geom))
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        return { 'hits': self.hits, 'misses': self.misses }
+
+    def prune(self, max_size):
+        """
+        Removes the least recently used files until the total size of the cache is at most `max_size` bytes
+        """
+        files = []
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for mtime, size, path in files)
+        removed = 0
+        for mtime, size, path in sorted(files):
+            if total_size <= max_size:
+                break
+            self.remove(path)
+            total_size -= size
+            removed += 1
+
+        if removed > 0:
+            log.info("Alpha hull cache: removed %s least recently used files" % removed)
+
+def get_alpha_hull_cache():
+    """
+    Returns a new `AlphaHullCache`, or None if caching is disabled in the `processing.alpha_hull` config section
+    """
+    if tsx.config.config.getboolean('processing.alpha_hull', 'cache', fallback=True):
+        return AlphaHullCache()
+    else:
+        return None
+
+def prune_alpha_hull_cache():
+    """
+    Limits the size of the alpha hull cache to the `cache_max_size` option (in MB) in the `processing.alpha_hull` config
+    section (called at the end of each step that uses the cache)
+    """
+    cache = get_alpha_hull_cache()
+    if cache is not None:
+        cache.prune(tsx.config.config.getfloat('processing.alpha_hull', 'cache_max_size', fallback=1024) * 1024 * 1024)
+
+def log_cache_stats(results):
+    """
+    Logs the combined alpha hull cache statistics from a list of `AlphaHullCache.stats()` results
+    """
+    hits = sum(stats['hits'] for stats in results if stats)
+    misses = sum(stats['misses'] for stats in results if stats)
+    total = hits + misses
+    if total > 0:
+        log.info("Alpha hull cache: %s hits, %s misses (%0.1f%% of hulls reused)" % (hits, misses, 100.0 * hits / total))
+
 # Process a single species.
 # This gets run off the main thread.
-def process_spno(spno, coastal_shape, commit):
+def process_spno(spno, commit, coastal_shape = None, journal_step = None):
+    """
+    Generates alpha hulls for a species
+
+    `coastal_shape` is the simplified coastal boundary (see `get_coastal_shape`), which is loaded if not supplied
+    `journal_step`, if supplied, is the step under which the species is recorded in the run journal when committed
+    """
     session = get_session()
+    cache = get_alpha_hull_cache()
 
     try:
         # Get raw points from DB
-        raw_points = get_species_points(session, spno)
+        xs, ys = get_species_points(session, spno)
 
-        if len(raw_points) < 4:
-            # Not enough points to create an alpha hull
+        if len(xs) < 4:
+            # Not enough points to create an alpha hull (the species is still recorded as complete in the journal)
+            if commit and journal_step:
+                record_task(session, journal_step, spno)
+                session.commit()
             return
 
-        # Read points from database
-        points = [reproject(p, to_working_transformer) for p in raw_points]
+        # Reproject points to working projection
+        xs, ys = reproject_xy(xs, ys, to_working_transformer)
 
         # Generate alpha shape
         alpha_shp = make_alpha_hull(
-            points = points,
-            coastal_shape = coastal_shape,
-            thinning_distance = tsx.config.config.getfloat('processing.alpha_hull', 'thinning_distance'),
-            alpha = tsx.config.config.getfloat('processing.alpha_hull', 'alpha'),
-            hullbuffer_distance = tsx.config.config.getfloat('processing.alpha_hull', 'hullbuffer_distance'),
-            isolatedbuffer_distance = tsx.config.config.getfloat('processing.alpha_hull', 'isolatedbuffer_distance'))
+            xs = xs,
+            ys = ys,
+            coastal_shape = get_coastal_shape() if coastal_shape is None else coastal_shape,
+            cache = cache,
+            **get_alpha_hull_params())
 
         # Convert back to DB projection
         alpha_shp = reproject(alpha_shp, to_db_transformer)
@@ -189,51 +453,67 @@ def process_spno(spno, coastal_shape, commit):
         # Clean up geometry
         alpha_shp = alpha_shp.buffer(0)
 
-        # Get range polygons to intersect with alpha shape
-        for taxon_id, range_id, breeding_range_id, geom_wkb in get_species_range_polygons(session, spno):
-            # Intersect and insert into DB
-            geom = shapely.wkb.loads(binascii.unhexlify(geom_wkb)).buffer(0)
-            geom = to_multipolygon(geom.intersection(alpha_shp)) # slow
-            if len(geom.geoms) > 0:
-                session.execute(text("""INSERT INTO taxon_presence_alpha_hull (taxon_id, range_id, breeding_range_id, geometry)
-                    VALUES (:taxon_id, :range_id, :breeding_range_id, ST_GeomFromWKB(_BINARY :geom_wkb))"""), {
-                        'taxon_id': taxon_id,
-                        'range_id': range_id,
-                        'breeding_range_id': breeding_range_id,
-                        'geom_wkb': shapely.wkb.dumps(geom)
-                    }
-                )
-            # We also subdivide the geometries into small pieces and insert this into the database. This allows for much faster
-            # spatial queries in the database.
-            for subgeom in subdivide_geometry(geom, max_points = 100):
-                if len(geom.geoms) > 0:
-                    session.execute(text("""INSERT INTO taxon_presence_alpha_hull_subdiv (taxon_id, range_id, breeding_range_id, geometry)
-                        VALUES (:taxon_id, :range_id, :breeding_range_id, ST_GeomFromWKB(_BINARY :geom_wkb))"""), {
-                            'taxon_id': taxon_id,
-                            'range_id': range_id,
-                            'breeding_range_id': breeding_range_id,
-                            'geom_wkb': shapely.wkb.dumps(subgeom)
-                        }
-                    )
+        columns = ['taxon_id', 'range_id', 'breeding_range_id', 'geometry']
+        with GeometryWriter(session, 'taxon_presence_alpha_hull', columns) as hull_writer, \
+                GeometryWriter(session, 'taxon_presence_alpha_hull_subdiv', columns) as subdiv_writer:
+            # If enabled, where pre-subdivided range pieces are available, only intersect the pieces that touch the alpha hull
+            use_pieces = get_range_clip_method() == 'pieces'
+            if use_pieces:
+                for (taxon_id, range_id, breeding_range_id), pieces in get_species_range_pieces(session, spno).items():
+                    clipped_pieces = intersect_pieces(pieces, alpha_shp)
+                    geom = to_multipolygon(shapely.union_all(clipped_pieces))
+                    insert_alpha_hull(hull_writer, subdiv_writer, taxon_id, range_id, breeding_range_id, geom, clipped_pieces)
+
+            # Otherwise intersect whole range polygons with alpha shape
+            for taxon_id, range_id, breeding_range_id, geom_wkb in get_species_range_polygons(session, spno, exclude_subdivided = use_pieces):
+                geom = shapely.wkb.loads(binascii.unhexlify(geom_wkb)).buffer(0)
+                geom = to_multipolygon(geom.intersection(alpha_shp)) # slow
+                insert_alpha_hull(hull_writer, subdiv_writer, taxon_id, range_id, breeding_range_id, geom, [geom])
+
         if commit:
+            if journal_step:
+                record_task(session, journal_step, spno)
             session.commit()
 
+        return cache and cache.stats()
+
     except:
         log.exception("Exception processing alpha hull")
         raise
     finally:
         session.close()
 
-def process_database(species = None, commit = False):
+def insert_alpha_hull(hull_writer, subdiv_writer, taxon_id, range_id, breeding_range_id, geom, pieces):
+    """
+    Inserts an alpha hull (intersected with a range polygon) into taxon_presence_alpha_hull, and the pieces that make up
+    the hull into taxon_presence_alpha_hull_subdiv (via the given `GeometryWriter`s)
+    """
+    if len(geom.geoms) > 0:
+        hull_writer.add(taxon_id = taxon_id, range_id = range_id, breeding_range_id = breeding_range_id, geometry = geom)
+        # We also subdivide the geometries into small pieces and insert this into the database. This allows for much faster
+        # spatial queries in the database. (Clipped range pieces can still have too many points, because the hull adds
+        # points along the cut, so they are subdivided too - pieces that are already small enough are passed through
+        # unchanged.)
+        for piece in pieces:
+            for subgeom in subdivide_geometry(piece, max_points = 100):
+                subdiv_writer.add(taxon_id = taxon_id, range_id = range_id, breeding_range_id = breeding_range_id, geometry = subgeom)
+
+# Name of this processing step in the run journal
+step_name = 'alpha_hull'
+
+def process_database(species = None, commit = False, journal = None):
     """
     Generates alpha hulls from raw sighting data in the database
 
     Intersects alpha hulls with range layers, and inserts the result back into the database
+
+    If a `Journal` is supplied, completed species are recorded in it, and species already completed are skipped.
     """
     session = get_session()
 
+    resuming = journal is not None and journal.started(step_name)
 
-    if commit:
+    if commit and not resuming:
         log.info("Deleting previous alpha hulls")
         if species is None:
             session.execute(text("""DELETE FROM taxon_presence_alpha_hull"""))
@@ -253,31 +533,41 @@ def process_database(species = None, commit = False):
     if species is None:
         species = get_all_spno(session)
 
-    # Load coastal shapefile
-    coastal_shape_filename = tsx.config.config.get("processing.alpha_hull", "coastal_shp")
-    # https://pyproj4.github.io/pyproj/stable/crs_compatibility.html#fiona
-    with fiona.Env(OSR_WKT_FORMAT="WKT2_2018"), fiona.open(coastal_shape_filename, 'r') as coastal_shape:
-        # Convert from fiona dictionary to shapely geometry and reproject
-        shp_to_working_transformer = pyproj.Transformer.from_proj(pyproj.CRS.from_wkt(coastal_shape.crs_wkt), working_proj, always_xy=True)
-        coastal_shape = reproject(shape(coastal_shape[0]['geometry']), shp_to_working_transformer)
-        # Simplify coastal boundary - makes things run ~20X faster
-        log.info("Simplifying coastal boundary")
-        coastal_shape = coastal_shape.buffer(10000).simplify(10000)
-
-        # TODO: cache simplified shapefile
-        # with fiona.open(coastal_shape_filename[0:-4] + ".shp", 'w'):
-
-    # The geometry operations above allocate quite a lot of memory, which for some reason doesn't seem to get garbage collected
-    # in a timely manner. This problem is made even worse by the subsequent process forking.
-    # gc.collect()
-    session.close()
+    # Build the simplified coastal boundary once, up front, and share it with the workers
+    build_coastline_asset()
+    shared_kwargs = { 'commit': commit, 'coastal_shape': get_coastal_shape() }
+
+    if journal is not None:
+        species = journal.remaining_tasks(step_name, species)
+        shared_kwargs['journal_step'] = step_name
 
-    tasks = [(spno, coastal_shape, commit) for spno in species]
+    # Process the species with the most sightings first, so that large species don't hold up the end of the run
+    cost = get_species_costs(session)
+
+    session.close()
 
     # Process all the species in parallel
-    for result, error in tqdm(run_parallel(process_spno, tasks), total = len(species)):
+    results = []
+    for result, error in tqdm(run_parallel(process_spno, species, shared_kwargs = shared_kwargs, cost = cost), total = len(species)):
         if error:
-            print(error)
+            log.error(error)
+        results.append(result)
+
+    log_cache_stats(results)
+    prune_alpha_hull_cache()
+
+def get_alpha_hull_params():
+    """
+    Reads the alpha hull parameters (as accepted by `make_alpha_hull`) from the `processing.alpha_hull` config section
+    """
+    return {
+        'thinning_distance': tsx.config.config.getfloat('processing.alpha_hull', 'thinning_distance'),
+        'alpha': tsx.config.config.getfloat('processing.alpha_hull', 'alpha'),
+        'hullbuffer_distance': tsx.config.config.getfloat('processing.alpha_hull', 'hullbuffer_distance'),
+        'isolatedbuffer_distance': tsx.config.config.getfloat('processing.alpha_hull', 'isolatedbuffer_distance'),
+        'engine': tsx.config.get('processing.alpha_hull', 'engine', 'numpy').strip(),
+        'thinning_method': tsx.config.get('processing.alpha_hull', 'thinning_method', 'kdtree').strip()
+    }
 
 def reproject(geom, transformer):
     return transform(transformer.transform, geom)
@@ -285,6 +575,21 @@ def reproject(geom, transformer):
 def get_all_spno(session):
     return [spno for (spno,) in session.execute(text("SELECT DISTINCT spno FROM taxon")).fetchall()]
 
+def get_species_costs(session):
+    """
+    Estimated processing cost of each species (number of sightings), for scheduling
+    """
+    return dict(session.execute(text("""SELECT spno, SUM(n)
+        FROM (
+            SELECT taxon_id, COUNT(*) AS n FROM t1_sighting GROUP BY taxon_id
+            UNION ALL
+            SELECT taxon_id, COUNT(*) AS n FROM t2_sighting GROUP BY taxon_id
+            UNION ALL
+            SELECT taxon_id, COUNT(*) AS n FROM incidental_sighting GROUP BY taxon_id
+        ) counts, taxon
+        WHERE taxon_id = taxon.id
+        GROUP BY spno""")).fetchall())
+
 def get_species_points(session, spno):
     sql = """SELECT DISTINCT ST_X(coords), ST_Y(coords)
         FROM t1_survey, t1_sighting, taxon
@@ -304,15 +609,57 @@ def get_species_points(session, spno):
         AND spno = :spno
         """
 
-    return [Point(x,y) for x, y in session.execute(text(sql), { 'spno': spno }).fetchall()]
+    return xy_arrays(session.execute(text(sql), { 'spno': spno }).fetchall())
+
+def get_range_clip_method():
+    """
+    How alpha hulls are clipped to range polygons (the `range_clip` option in the `processing.alpha_hull` config section):
 
-def get_species_range_polygons(session, spno):
-    return session.execute(text("""SELECT taxon_id, range_id, breeding_range_id, HEX(ST_AsWKB(geometry))
+    - 'whole' (default): each hull is intersected with the whole range polygon
+    - 'pieces': where taxon_range_subdiv has pieces for a range, the hull is only intersected with the pieces that touch
+      it (see `tsx.geo.intersect_pieces`). This is only faster when the hull covers a small part of a large range -
+      `python -m tsx.benchmark range_clip` compares the two.
+    """
+    method = tsx.config.get('processing.alpha_hull', 'range_clip', 'whole').strip()
+    if method not in ('whole', 'pieces'):
+        raise ValueError("Unknown range_clip method: %s" % method)
+    return method
+
+def get_species_range_polygons(session, spno, exclude_subdivided = False):
+    """
+    Returns range polygons for the species, excluding any that have pre-subdivided pieces if `exclude_subdivided` is True
+    (see `get_species_range_pieces`)
+    """
+    sql = """SELECT taxon_id, range_id, breeding_range_id, HEX(ST_AsWKB(geometry))
                         FROM taxon_range, taxon
                         WHERE taxon_id = taxon.id
                         AND spno = :spno
+                        """
+    if exclude_subdivided:
+        sql += """AND NOT EXISTS (
+                            SELECT 1 FROM taxon_range_subdiv s
+                            WHERE s.taxon_id = taxon_range.taxon_id
+                            AND s.range_id = taxon_range.range_id
+                            AND s.breeding_range_id <=> taxon_range.breeding_range_id)
+                        """
+    return session.execute(text(sql), { 'spno': spno }).fetchall()
+
+def get_species_range_pieces(session, spno):
+    """
+    Returns the pre-subdivided range pieces (from taxon_range_subdiv) for the species, as a dictionary
+    of (taxon_id, range_id, breeding_range_id) => list of geometries
+    """
+    rows = session.execute(text("""SELECT taxon_id, range_id, breeding_range_id, HEX(ST_AsWKB(geometry))
+                        FROM taxon_range_subdiv, taxon
+                        WHERE taxon_id = taxon.id
+                        AND spno = :spno
                         """), { 'spno': spno }).fetchall()
 
+    result = {}
+    for taxon_id, range_id, breeding_range_id, geom_wkb in rows:
+        result.setdefault((taxon_id, range_id, breeding_range_id), []).append(shapely.wkb.loads(binascii.unhexlify(geom_wkb)))
+    return result
+
 # The rest of the functions below are only used when this file is called as a stand-alone script
 # (Leaving this here from Hoang's original script)
 
@@ -334,12 +681,14 @@ def generate_alphashape(infile, outfile, inproj, outproj, coastal_shape,
                           pyproj.Proj(init=outproj))
 
         occurence_points_proj = [transform(project, geometry.shape(point['geometry'])) for point in i_shape]
+        occurence_xs = np.array([p.x for p in occurence_points_proj])
+        occurence_ys = np.array([p.y for p in occurence_points_proj])
 
         spno=i_shape[0]['properties']['SpNo']
 
         c_shape = fiona.open(coastal_shape)
         c_shape_proj = transform(project, geometry.shape(c_shape[0]['geometry']))
-        alpha_shp = make_alpha_hull(occurence_points_proj, c_shape_proj, \
+        alpha_shp = make_alpha_hull(occurence_xs, occurence_ys, c_shape_proj, \
                                     thinning_distance, alpha, \
                                     hullbuffer_distance,isolatedbuffer_distance)
 
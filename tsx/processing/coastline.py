@@ -0,0 +1,104 @@
+import fiona
+import pyproj
+import shapely
+import shapely.wkb
+from shapely.geometry import shape
+from shapely.ops import transform
+import tsx.config
+import hashlib
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+working_proj = pyproj.Proj('EPSG:3112') # GDA94 / Geoscience Australia Lambert - so that we can buffer in metres
+
+# Parameters used to simplify the coastal boundary. These form part of the asset key, so changing them causes the
+# asset to be rebuilt.
+simplify_buffer_distance = 10000
+simplify_tolerance = 10000
+
+def coastal_shapefile_path():
+    return tsx.config.config.get("processing.alpha_hull", "coastal_shp")
+
+def coastline_asset_key(filename):
+    """
+    Key identifying the contents of the coastal shapefile (and the simplification parameters)
+    """
+    h = hashlib.sha256()
+    h.update(("%s %s" % (simplify_buffer_distance, simplify_tolerance)).encode('utf8'))
+    for path in [filename, filename[0:-4] + ".prj"]:
+        if os.path.exists(path):
+            h.update(("%s\n" % os.path.getmtime(path)).encode('utf8'))
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+    return h.hexdigest()
+
+def coastline_asset_path():
+    filename = coastal_shapefile_path()
+    return os.path.join(tsx.config.data_dir('cache'), 'coastline-%s.wkb' % coastline_asset_key(filename))
+
+def build_coastline_asset():
+    """
+    Writes the simplified coastal boundary, reprojected to the working projection, to the cache directory as WKB
+
+    Does nothing if an asset already exists for the current coastal shapefile. Returns the path of the asset.
+    """
+    path = coastline_asset_path()
+
+    if os.path.exists(path):
+        log.info("Using cached coastal boundary: %s" % path)
+        return path
+
+    coastal_shape_filename = coastal_shapefile_path()
+    # https://pyproj4.github.io/pyproj/stable/crs_compatibility.html#fiona
+    with fiona.Env(OSR_WKT_FORMAT="WKT2_2018"), fiona.open(coastal_shape_filename, 'r') as coastal_shape:
+        # Convert from fiona dictionary to shapely geometry and reproject
+        shp_to_working_transformer = pyproj.Transformer.from_proj(pyproj.CRS.from_wkt(coastal_shape.crs_wkt), working_proj, always_xy=True)
+        coastal_shape = transform(shp_to_working_transformer.transform, shape(coastal_shape[0]['geometry']))
+
+    # Simplify coastal boundary - makes things run ~20X faster
+    log.info("Simplifying coastal boundary")
+    coastal_shape = coastal_shape.buffer(simplify_buffer_distance).simplify(simplify_tolerance)
+
+    # Write to a temporary file and rename, so that other processes never see a partially written file
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(shapely.wkb.dumps(coastal_shape))
+    os.replace(tmp_path, path)
+
+    log.info("Saved simplified coastal boundary: %s" % path)
+
+    return path
+
+_coastal_shape = None
+
+def get_coastal_shape():
+    """
+    Returns the simplified coastal boundary as a prepared geometry in the working projection
+
+    The asset is loaded once per process and then reused. `build_coastline_asset` should be called (in the main process)
+    before any workers call this function.
+    """
+    global _coastal_shape
+
+    if _coastal_shape is None:
+        with open(coastline_asset_path(), 'rb') as f:
+            geom = shapely.wkb.loads(f.read())
+        shapely.prepare(geom)
+        _coastal_shape = geom
+
+    return _coastal_shape
+
+def clip_to_coastline(geom, coastal_shape):
+    """
+    Clips geom to the coastal boundary
+
+    Uses the prepared coastal boundary to skip the (expensive) intersection for geometries that lie entirely inland.
+    (The boundary is prepared here if necessary, e.g. after being passed to a worker process.)
+    """
+    shapely.prepare(coastal_shape)
+    if coastal_shape.contains(geom):
+        return geom
+    return geom.intersection(coastal_shape)
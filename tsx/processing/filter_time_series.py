@@ -1,13 +1,26 @@
 from tsx.db import get_session
 import logging
 import tsx.config
+from tsx.util import sql_list_placeholder, sql_list_argument
 from sqlalchemy import text
 
 log = logging.getLogger(__name__)
 
-def process_database():
+def process_database(taxa = None):
+    """
+    Filters time series, updating the time_series_inclusion table and aggregated_by_year.include_in_analysis
+
+    If `taxa` is supplied, only the time series for those taxa are updated.
+    """
     session = get_session()
 
+    if taxa is None:
+        taxon_params = {}
+        taxon_condition = "TRUE"
+    else:
+        taxon_params = sql_list_argument('taxon', taxa)
+        taxon_condition = "agg.taxon_id IN (%s)" % sql_list_placeholder('taxon', taxa)
+
     log.info("Step 1/3 - Update data source information")
 
     sql_stmts = [
@@ -73,7 +86,12 @@ def process_database():
     max_year = tsx.config.config.getint("processing", "max_year")
     min_tssy = tsx.config.config.getint("processing", "min_time_series_sample_years")
 
-    session.execute(text("DELETE FROM time_series_inclusion;"))
+    if taxa is None:
+        session.execute(text("DELETE FROM time_series_inclusion;"))
+    else:
+        # The taxon id is the last component of the time series id
+        session.execute(text("DELETE FROM time_series_inclusion WHERE SUBSTRING_INDEX(time_series_id, '_', -1) IN (%s)" %
+            sql_list_placeholder('taxon', taxa)), taxon_params)
     session.execute(text("""
         INSERT INTO time_series_inclusion (
             time_series_id,
@@ -110,11 +128,13 @@ def process_database():
         INNER JOIN source ON agg.source_id = source.id
         LEFT JOIN data_source_merged AS data_source ON data_source.taxon_id = agg.taxon_id AND data_source.source_id = agg.source_id
         LEFT JOIN data_source_excluded_years ey ON ey.taxon_id = agg.taxon_id AND ey.source_id = agg.source_id AND ey.year = agg.start_date_y
+        WHERE %s
         GROUP BY agg.time_series_id;
-    """), {
+    """ % taxon_condition), {
         'min_year': min_year,
         'max_year': max_year,
-        'min_tssy': min_tssy
+        'min_tssy': min_tssy,
+        **taxon_params
     })
 
     log.info("Step 3/3 - Updating aggregated_by_year table")
@@ -129,9 +149,11 @@ def process_database():
             AND agg.start_date_y <= LEAST(COALESCE(data_source.end_year, :max_year), :max_year)
             AND agg.start_date_y >= GREATEST(COALESCE(data_source.start_year, :min_year), :min_year)
             AND ey.year IS NULL
-        )"""), {
+        )
+        WHERE %s""" % taxon_condition), {
         'min_year': min_year,
-        'max_year': max_year
+        'max_year': max_year,
+        **taxon_params
     })
 
     session.commit()
@@ -0,0 +1,234 @@
+"""
+Incremental reprocessing, used by `python -m tsx.process incremental`
+
+At the end of each full or incremental run, a fingerprint of each source is saved (in the processing_fingerprint table),
+along with the taxa present in the source's raw data (in processing_fingerprint_taxon). An incremental run compares the
+saved fingerprints with the current state of the data_import and source tables to find:
+
+- sources whose data has changed (i.e. new or re-run imports, or deleted sources): every species that is or was present in
+  the source's data, or that the source is configured to process, is recomputed. Alpha hulls are calculated from all
+  sources combined, and type 2 aggregation depends on the alpha hulls, so a species is always recomputed as a whole.
+- sources whose details have changed: only time series filtering is repeated for the source's taxa.
+"""
+from sqlalchemy import text
+from tsx.db import get_session
+from tsx.util import sql_list_placeholder, sql_list_argument
+from tsx.processing.journal import record_tasks, STEP_COMPLETE
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+# Journal step under which the snapshot taken at the start of a run is recorded (see `Snapshot.record`)
+snapshot_step = 'snapshot'
+
+# Derived tables that are recomputed for affected species
+#
+# Note: t2_survey_site is cleared by a full run, but not here. It has no taxon column, and is only written and read by the
+# legacy pseudo_absence and response_variable commands, not by any step of the pipeline, so it doesn't depend on which
+# species are recomputed.
+derived_tables = [
+    'aggregated_by_month',
+    'aggregated_by_year',
+    'taxon_presence_alpha_hull',
+    'taxon_presence_alpha_hull_subdiv',
+    't2_site_taxon_presence',
+    'taxon_source_alpha_hull'
+]
+
+def create_fingerprint_tables(session):
+    # The tables are also defined in create.sql, but this allows incremental processing to be used with existing databases
+    # (see `tsx.process.create_processing_tables`)
+    session.execute(text("""CREATE TABLE IF NOT EXISTS processing_fingerprint (
+        source_id INT NOT NULL,
+        data_fingerprint CHAR(40) NOT NULL,
+        metadata_fingerprint CHAR(40) NOT NULL,
+        PRIMARY KEY (source_id))"""))
+    session.execute(text("""CREATE TABLE IF NOT EXISTS processing_fingerprint_taxon (
+        source_id INT NOT NULL,
+        taxon_id CHAR(8) NOT NULL,
+        PRIMARY KEY (source_id, taxon_id))"""))
+
+def get_source_fingerprints(session):
+    """
+    Fingerprints the current state of each source
+
+    Returns a dictionary of source_id => (data_fingerprint, metadata_fingerprint). The data fingerprint changes whenever an
+    import for the source is run (or re-run), and the metadata fingerprint whenever the source's details are edited.
+    """
+    rows = session.execute(text("""
+        SELECT source.id, source.last_modified, data_import.id, data_import.last_modified
+        FROM source
+        LEFT JOIN data_import ON data_import.source_id = source.id
+            AND data_import.status_id IN (SELECT id FROM data_import_status WHERE code IN ('importing', 'import_error', 'imported', 'approved'))
+        ORDER BY source.id, data_import.id""")).fetchall()
+
+    imports = {}
+    metadata = {}
+    for source_id, source_modified, data_import_id, data_import_modified in rows:
+        metadata[source_id] = str(source_modified)
+        imports.setdefault(source_id, [])
+        if data_import_id is not None:
+            imports[source_id].append((data_import_id, str(data_import_modified)))
+
+    return {
+        source_id: (sha1(imports[source_id]), sha1(metadata[source_id]))
+        for source_id in metadata
+    }
+
+def sha1(value):
+    return hashlib.sha1(repr(value).encode('utf-8')).hexdigest()
+
+def get_saved_fingerprints(session):
+    """
+    Returns the fingerprints saved at the end of the last run (see `get_source_fingerprints`), or None if there are none
+    """
+    rows = session.execute(text("SELECT source_id, data_fingerprint, metadata_fingerprint FROM processing_fingerprint")).fetchall()
+    if len(rows) == 0:
+        return None
+    return { source_id: (data_fp, metadata_fp) for source_id, data_fp, metadata_fp in rows }
+
+def get_source_taxa(session, sources = None):
+    """
+    Returns the set of (source_id, taxon_id) pairs present in the raw type 1 and type 2 data, optionally limited to a list of
+    sources
+    """
+    if sources is not None and len(sources) == 0:
+        return set()
+
+    condition = "" if sources is None else "WHERE source_id IN (%s)" % sql_list_placeholder('source', sources)
+    params = {} if sources is None else sql_list_argument('source', sources)
+
+    return set(session.execute(text("""
+        SELECT DISTINCT source_id, taxon_id
+        FROM t1_survey
+        JOIN t1_sighting ON t1_sighting.survey_id = t1_survey.id
+        {condition}
+        UNION
+        SELECT DISTINCT source_id, taxon_id
+        FROM t2_survey
+        JOIN t2_sighting ON t2_sighting.survey_id = t2_survey.id
+        {condition}""".format(condition = condition)), params).fetchall())
+
+class Snapshot:
+    """
+    The state of the sources at the start of a run, which is saved once the run completes successfully (so that data
+    imported while the run is in progress is picked up by the next incremental run)
+
+    A run that can be resumed records its snapshot in the run journal (see `record` and `from_journal`), so that the
+    resumed run saves the state of the sources when the run started, rather than when it was resumed.
+    """
+    def __init__(self, session = None):
+        self.fingerprints = {} if session is None else get_source_fingerprints(session)
+        self.source_taxa = set() if session is None else get_source_taxa(session)
+
+    def record(self, journal):
+        """
+        Records the snapshot in the run journal
+        """
+        session = get_session(journal.database_config)
+        record_tasks(session, snapshot_step,
+            ['source:%s:%s:%s' % (source_id, data_fp, metadata_fp) for source_id, (data_fp, metadata_fp) in self.fingerprints.items()] +
+            ['taxon:%s:%s' % (source_id, taxon_id) for source_id, taxon_id in self.source_taxa] +
+            [STEP_COMPLETE])
+        session.commit()
+        session.close()
+
+    @classmethod
+    def from_journal(cls, journal):
+        """
+        Returns the snapshot recorded in the run journal, or None if there isn't one
+        """
+        if not journal.step_complete(snapshot_step):
+            return None
+
+        snapshot = cls()
+        for key in journal.completed_tasks(snapshot_step):
+            if key.startswith('source:'):
+                source_id, data_fp, metadata_fp = key.split(':')[1:]
+                snapshot.fingerprints[int(source_id)] = (data_fp, metadata_fp)
+            elif key.startswith('taxon:'):
+                source_id, taxon_id = key.split(':', 2)[1:]
+                snapshot.source_taxa.add((int(source_id), taxon_id))
+        return snapshot
+
+    def save(self, database_config = None):
+        session = get_session(database_config)
+        session.execute(text("DELETE FROM processing_fingerprint"))
+        session.execute(text("DELETE FROM processing_fingerprint_taxon"))
+        session.execute(text("""INSERT INTO processing_fingerprint (source_id, data_fingerprint, metadata_fingerprint)
+            VALUES (:source_id, :data_fp, :metadata_fp)"""), [
+                { 'source_id': source_id, 'data_fp': data_fp, 'metadata_fp': metadata_fp }
+                for source_id, (data_fp, metadata_fp) in self.fingerprints.items()
+            ])
+        if len(self.source_taxa) > 0:
+            session.execute(text("INSERT INTO processing_fingerprint_taxon (source_id, taxon_id) VALUES (:source_id, :taxon_id)"), [
+                { 'source_id': source_id, 'taxon_id': taxon_id }
+                for source_id, taxon_id in self.source_taxa
+            ])
+        session.commit()
+        session.close()
+
+def find_changes(session, snapshot):
+    """
+    Compares the snapshot with the fingerprints saved by the last run
+
+    Returns a tuple of (species, taxa):
+    - species is the list of species (spno) that need to be recomputed
+    - taxa is the list of taxa whose time series need to be filtered again (including all taxa of the species)
+
+    Returns None if there is no saved fingerprint (i.e. a full run is required).
+    """
+    saved = get_saved_fingerprints(session)
+    if saved is None:
+        return None
+
+    current = snapshot.fingerprints
+    data_changed = sorted(source_id for source_id in set(saved) | set(current)
+        if saved.get(source_id, (None, None))[0] != current.get(source_id, (None, None))[0])
+    metadata_changed = sorted(source_id for source_id in current
+        if source_id in saved and saved[source_id][1] != current[source_id][1] and source_id not in data_changed)
+
+    log.info("Sources with changed data: %s" % (data_changed or 'none'))
+    log.info("Sources with changed details: %s" % (metadata_changed or 'none'))
+
+    species = []
+    if len(data_changed) > 0:
+        params = sql_list_argument('source', data_changed)
+        sources = sql_list_placeholder('source', data_changed)
+
+        # Taxa present in the sources' data now, in the previous run, configured for processing, or in previous results
+        taxa = set(taxon_id for source_id, taxon_id in snapshot.source_taxa if source_id in data_changed)
+        for sql in [
+                "SELECT taxon_id FROM processing_fingerprint_taxon WHERE source_id IN (%s)",
+                "SELECT DISTINCT taxon_id FROM processing_method WHERE source_id IN (%s)",
+                "SELECT DISTINCT taxon_id FROM aggregated_by_year WHERE source_id IN (%s)",
+                "SELECT DISTINCT taxon_id FROM taxon_source_alpha_hull WHERE source_id IN (%s)"]:
+            taxa.update(taxon_id for (taxon_id,) in session.execute(text(sql % sources), params).fetchall())
+
+        if len(taxa) > 0:
+            species = [spno for (spno,) in session.execute(text("SELECT DISTINCT spno FROM taxon WHERE id IN (%s) ORDER BY spno" %
+                sql_list_placeholder('taxon', list(taxa))), sql_list_argument('taxon', list(taxa))).fetchall()]
+
+    taxa = set()
+    if len(species) > 0:
+        taxa.update(taxon_id for (taxon_id,) in session.execute(text("SELECT id FROM taxon WHERE spno IN (%s)" %
+            sql_list_placeholder('species', species)), sql_list_argument('species', species)).fetchall())
+    if len(metadata_changed) > 0:
+        taxa.update(taxon_id for (taxon_id,) in session.execute(text("SELECT DISTINCT taxon_id FROM aggregated_by_year WHERE source_id IN (%s)" %
+            sql_list_placeholder('source', metadata_changed)), sql_list_argument('source', metadata_changed)).fetchall())
+
+    return species, sorted(taxa)
+
+def clear_species(species, database_config = None):
+    """
+    Deletes derived data for the species, ready for it to be recomputed
+    """
+    session = get_session(database_config)
+    params = sql_list_argument('species', species)
+    for table in derived_tables:
+        log.info("Deleting %s rows" % table)
+        session.execute(text("DELETE FROM %s WHERE taxon_id IN (SELECT id FROM taxon WHERE spno IN (%s))" % (
+            table, sql_list_placeholder('species', species))), params)
+    session.commit()
+    session.close()
@@ -0,0 +1,98 @@
+"""
+Run journal, allowing `python -m tsx.process all` to be resumed after a failure
+
+The journal (the processing_journal table) records each completed processing step, and each completed task (e.g. taxon)
+within a step. Tasks are recorded by the worker in the same transaction as the task's results, so a resumed run never
+repeats work that has already been committed, and never skips work that hasn't.
+"""
+from sqlalchemy import text
+from tsx.db import get_session
+import logging
+
+log = logging.getLogger(__name__)
+
+# Task key used to mark a whole step as complete
+STEP_COMPLETE = ''
+
+class Journal:
+    """
+    The run journal
+
+    Each method uses its own short-lived session, so a journal can be shared by processing steps running in different
+    threads, and always sees tasks committed by workers in the meantime.
+    """
+    def __init__(self, database_config = None):
+        self.database_config = database_config
+        # The table is also defined in create.sql, but this allows the journal to be used with existing databases
+        self.execute("""CREATE TABLE IF NOT EXISTS processing_journal (
+            step VARCHAR(64) NOT NULL,
+            task_key VARCHAR(255) NOT NULL,
+            completed TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (step, task_key))""")
+
+    def clear(self):
+        """
+        Clears the journal, ready for a new run
+        """
+        self.execute("DELETE FROM processing_journal")
+
+    def started(self, step):
+        """
+        Returns True if any tasks in the step have been completed (i.e. the step is being resumed)
+        """
+        return len(self.execute("SELECT 1 FROM processing_journal WHERE step = :step LIMIT 1", step)) > 0
+
+    def step_complete(self, step):
+        return STEP_COMPLETE in self.completed_tasks(step)
+
+    def complete_step(self, step):
+        session = get_session(self.database_config)
+        try:
+            record_task(session, step, STEP_COMPLETE)
+            session.commit()
+        finally:
+            session.close()
+
+    def completed_tasks(self, step):
+        return set(key for (key,) in self.execute("SELECT task_key FROM processing_journal WHERE step = :step", step))
+
+    def execute(self, sql, step = None):
+        session = get_session(self.database_config)
+        try:
+            result = session.execute(text(sql), { 'step': step })
+            rows = result.fetchall() if result.returns_rows else None
+            session.commit()
+            return rows
+        finally:
+            session.close()
+
+    def remaining_tasks(self, step, tasks):
+        """
+        Filters out the tasks (e.g. taxon ids) already completed in the step
+        """
+        completed = self.completed_tasks(step)
+        remaining = [task for task in tasks if str(task) not in completed]
+        if len(remaining) < len(tasks):
+            log.info("%s: resuming, %s of %s tasks already complete" % (step, len(tasks) - len(remaining), len(tasks)))
+        return remaining
+
+def record_task(session, step, key):
+    """
+    Records a completed task in the journal
+
+    This should be called by the task just before it commits, so that the journal entry is committed along with the
+    task's results.
+    """
+    session.execute(text("INSERT INTO processing_journal (step, task_key) VALUES (:step, :key)"), {
+        'step': step,
+        'key': str(key)
+    })
+
+def record_tasks(session, step, keys):
+    """
+    Records several completed tasks in the journal (see `record_task`)
+    """
+    if len(keys) > 0:
+        session.execute(text("INSERT INTO processing_journal (step, task_key) VALUES (:step, :key)"), [
+            { 'step': step, 'key': str(key) } for key in keys
+        ])
@@ -0,0 +1,233 @@
+"""
+Assigns regions to sites, for type 1 and type 2 aggregation
+
+The 'sql' engine uses a spatial join between the points and region_subdiv in MySQL. The 'python' engine (the default)
+loads region_subdiv once into an STRtree, and tests each batch of points against the candidate pieces with a single
+vectorized call, which is much faster than the spatial join. As with ST_Intersects, points on the boundary of a region
+are considered to be inside it.
+
+The engine is selected with the `engine` option in the `processing.region_lookup` config section.
+
+The region of each point is also cached across runs in the region_lookup_cache table (see `RegionCache`), so that only
+new points need to be tested.
+"""
+from sqlalchemy import text
+from tsx.db import get_session, BulkWriter
+import tsx.config
+import binascii
+import hashlib
+import logging
+import numpy as np
+import shapely
+
+log = logging.getLogger(__name__)
+
+engines = ['python', 'sql']
+
+# Points are cached by their coordinates rounded to this many decimal places (i.e. about 1cm)
+cache_precision = 7
+
+def get_engine(engine = None):
+    if engine is None:
+        engine = tsx.config.get('processing.region_lookup', 'engine', 'python').strip()
+    if engine not in engines:
+        raise ValueError("Unknown region lookup engine: %s" % engine)
+    return engine
+
+class RegionAssigner:
+    """
+    Finds the regions that points intersect, using an STRtree of the region_subdiv table
+    """
+    def __init__(self, session):
+        rows = session.execute(text("SELECT id, HEX(ST_AsWKB(geometry)) FROM region_subdiv")).fetchall()
+        self.region_ids = np.array([region_id for region_id, geom_wkb in rows], dtype=np.int64)
+        self.geoms = shapely.from_wkb([binascii.unhexlify(geom_wkb) for region_id, geom_wkb in rows])
+        shapely.prepare(self.geoms)
+        self.tree = shapely.STRtree(self.geoms)
+        log.info("Loaded %s region pieces" % len(rows))
+
+    def assign(self, xs, ys):
+        """
+        Returns a tuple of (point_index, region_id) arrays, with an entry for each region that each point (xs[i], ys[i])
+        intersects
+        """
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        if len(xs) == 0 or len(self.geoms) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+        # The tree only compares bounding boxes, so candidates are then tested exactly
+        point_index, geom_index = self.tree.query(shapely.points(xs, ys))
+        mask = shapely.intersects_xy(self.geoms[geom_index], xs[point_index], ys[point_index])
+        return point_index[mask], self.region_ids[geom_index[mask]]
+
+    def assign_min(self, xs, ys):
+        """
+        Returns an array containing the lowest id of the regions that each point intersects, or -1 if none
+        """
+        result = np.full(len(xs), -1, dtype=np.int64)
+        point_index, region_ids = self.assign(xs, ys)
+        # Process in descending order of region id, so that the lowest id is written last
+        order = np.argsort(-region_ids, kind='stable')
+        result[point_index[order]] = region_ids[order]
+        return result
+
+def create_cache_table(session):
+    # The table is also defined in create.sql, but this allows the cache to be used with existing databases
+    session.execute(text("""CREATE TABLE IF NOT EXISTS region_lookup_cache (
+        region_version CHAR(40) NOT NULL,
+        x_key BIGINT NOT NULL,
+        y_key BIGINT NOT NULL,
+        region_id INT NULL,
+        PRIMARY KEY (region_version, x_key, y_key))"""))
+
+def clear_cache(session):
+    """
+    Deletes cached regions for other versions of the regions (called when the regions are re-imported)
+
+    Cached regions are never used with a different version of the regions (see `get_region_version`), so this only frees
+    up space. It isn't done by `RegionCache`, so that a run using an older copy of region_subdiv can't remove the entries
+    of other runs.
+
+    The table must already exist (see `create_cache_table`, which must be called before making any changes in the
+    session, as DDL statements implicitly commit them in MySQL)
+    """
+    session.execute(text("DELETE FROM region_lookup_cache WHERE region_version <> :version"), { 'version': get_region_version(session) })
+
+def get_region_version(session):
+    """
+    Fingerprints the region_subdiv table, so that cached regions are never used with a different set of regions
+    """
+    row = session.execute(text("""SELECT COUNT(*), COALESCE(SUM(id), 0), COALESCE(SUM(CRC32(ST_AsWKB(geometry))), 0)
+        FROM region_subdiv""")).fetchone()
+    return hashlib.sha1(repr(tuple(int(value) for value in row)).encode('utf-8')).hexdigest()
+
+class RegionCache:
+    """
+    Looks up the region of points, using (and filling) the persistent region_lookup_cache table
+
+    Each point is assigned the lowest id of the regions whose region_subdiv pieces it intersects. Points are cached by
+    their rounded coordinates (see `cache_precision`) and a fingerprint of region_subdiv, and the regions of points that
+    are not in the cache are found with a `RegionAssigner`, which is only loaded if needed.
+
+    The cache has its own session, and new entries are committed after each lookup. Set the `cache` option in the
+    `processing.region_lookup` config section to false to disable it.
+    """
+    def __init__(self, name, database_config = None, lookup_batch_size = 1000):
+        self.name = name
+        self.session = get_session(database_config)
+        self.enabled = tsx.config.config.getboolean('processing.region_lookup', 'cache', fallback=True)
+        self.lookup_batch_size = lookup_batch_size
+        self.assigner = None
+        self.hits = 0
+        self.misses = 0
+
+        if self.enabled:
+            create_cache_table(self.session)
+            self.version = get_region_version(self.session)
+
+    def lookup(self, xs, ys):
+        """
+        Returns an array containing the region id of each point (xs[i], ys[i]), or -1 if it is not in any region
+        """
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        if len(xs) == 0:
+            return np.array([], dtype=np.int64)
+
+        if not self.enabled:
+            self.misses += len(xs)
+            return self.get_assigner().assign_min(xs, ys)
+
+        scale = 10 ** cache_precision
+        keys = np.stack([np.rint(xs * scale), np.rint(ys * scale)], axis=1).astype(np.int64)
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        unique_regions = np.full(len(unique_keys), -1, dtype=np.int64)
+        found = np.zeros(len(unique_keys), dtype=bool)
+        for start in range(0, len(unique_keys), self.lookup_batch_size):
+            batch = unique_keys[start:start + self.lookup_batch_size].tolist()
+            params = { 'version': self.version }
+            for i, (x_key, y_key) in enumerate(batch):
+                params['x%s' % i] = x_key
+                params['y%s' % i] = y_key
+            rows = self.session.execute(text("""SELECT x_key, y_key, region_id
+                FROM region_lookup_cache
+                WHERE region_version = :version
+                AND (x_key, y_key) IN (%s)""" % ", ".join("(:x%s, :y%s)" % (i, i) for i in range(len(batch)))), params).fetchall()
+            index = { (x_key, y_key): start + i for i, (x_key, y_key) in enumerate(batch) }
+            for x_key, y_key, region_id in rows:
+                i = index[(x_key, y_key)]
+                found[i] = True
+                unique_regions[i] = -1 if region_id is None else region_id
+
+        missing = np.flatnonzero(~found)
+        self.hits += len(unique_keys) - len(missing)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            # Points with the same key are within about 1cm of each other, so any of them can represent the key
+            representative = np.zeros(len(unique_keys), dtype=np.int64)
+            representative[inverse] = np.arange(len(inverse))
+            points = representative[missing]
+            unique_regions[missing] = self.get_assigner().assign_min(xs[points], ys[points])
+
+            # INSERT IGNORE, in case another process has cached the same points in the meantime
+            self.session.execute(text("""INSERT IGNORE INTO region_lookup_cache (region_version, x_key, y_key, region_id)
+                VALUES (:version, :x_key, :y_key, :region_id)"""), [{
+                    'version': self.version,
+                    'x_key': x_key,
+                    'y_key': y_key,
+                    'region_id': None if region_id < 0 else region_id
+                } for (x_key, y_key), region_id in zip(unique_keys[missing].tolist(), unique_regions[missing].tolist())])
+            self.session.commit()
+
+        return unique_regions[inverse]
+
+    def get_assigner(self):
+        if self.assigner is None:
+            self.assigner = RegionAssigner(self.session)
+        return self.assigner
+
+    def report(self):
+        total = self.hits + self.misses
+        log.info("%s: region cache hit rate %0.1f%% (%s of %s points)" % (
+            self.name, 100.0 * self.hits / total if total else 0, self.hits, total))
+
+    def close(self):
+        self.report()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def create_site_region_table(session, table, sites_sql, name, database_config = None, batch_size = 100000):
+    """
+    Creates `table` with a (site_id, region_id) row for each region that the points of each site are in
+
+    `sites_sql` is a query returning (site_id, x, y) rows - a site may have more than one point. The points are
+    processed in batches of `batch_size`, using a `RegionCache` (`name` is used to report the cache hit rate). The table
+    is committed, so that it can be used by other sessions.
+    """
+    session.execute(text("DROP TABLE IF EXISTS %s" % table))
+    session.execute(text("CREATE TABLE %s (site_id INT, region_id INT, INDEX (site_id))" % table))
+
+    site_regions = set()
+    with RegionCache(name, database_config) as cache:
+        result = session.execute(text(sites_sql))
+        while True:
+            rows = result.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            region_ids = cache.lookup([x for site_id, x, y in rows], [y for site_id, x, y in rows])
+            site_regions.update((site_id, region_id) for (site_id, x, y), region_id in zip(rows, region_ids.tolist()) if region_id >= 0)
+
+    with BulkWriter(session, table, ['site_id', 'region_id']) as writer:
+        for site_id, region_id in site_regions:
+            writer.add(site_id = site_id, region_id = region_id)
+
+    session.commit()
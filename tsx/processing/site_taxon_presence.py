@@ -0,0 +1,150 @@
+"""
+Finds the type 2 sites where each taxon is present, for type 2 aggregation
+
+A site is present for a taxon if any of the site's survey locations is within the taxon's core range alpha hull
+(taxon_presence_alpha_hull_subdiv with range_id = 1). Rather than testing the surveys against each taxon's hull with
+ST_Contains, the distinct site locations are loaded once into an STRtree, which is queried with the hull pieces of a
+chunk of species at a time. The result is stored in the t2_site_taxon_presence table.
+
+As with ST_Contains, points on the boundary of a hull are not considered to be inside it.
+"""
+from sqlalchemy import text
+from tsx.db import get_session, BulkWriter
+from tsx.processing.journal import record_tasks
+from tsx.util import sql_list_placeholder, sql_list_argument
+from tqdm import tqdm
+import binascii
+import logging
+import numpy as np
+import shapely
+import time
+
+log = logging.getLogger(__name__)
+
+# Name of this processing step in the run journal
+step_name = 'site_taxon_presence'
+
+# How often to check for newly generated alpha hulls when streaming (see `process_database`)
+hull_poll_interval = 5
+
+def create_table(session):
+    # The table is also defined in create.sql, but this allows the step to be used with existing databases (see
+    # `tsx.process.create_processing_tables`)
+    session.execute(text("""CREATE TABLE IF NOT EXISTS t2_site_taxon_presence (
+        site_id INT NOT NULL,
+        taxon_id CHAR(8) NOT NULL,
+        PRIMARY KEY (taxon_id, site_id))"""))
+
+class SiteIndex:
+    """
+    An STRtree of the distinct locations of the type 2 sites
+    """
+    def __init__(self, session):
+        rows = session.execute(text("""SELECT DISTINCT site_id, ST_X(coords), ST_Y(coords)
+            FROM t2_survey
+            WHERE site_id IS NOT NULL""")).fetchall()
+        self.site_ids = np.array([site_id for site_id, x, y in rows], dtype=np.int64)
+        self.tree = shapely.STRtree(shapely.points(
+            np.array([x for site_id, x, y in rows], dtype=float),
+            np.array([y for site_id, x, y in rows], dtype=float)))
+        log.info("Loaded %s site locations" % len(rows))
+
+    def find_sites(self, geoms):
+        """
+        Returns a tuple of (geom_index, site_id) arrays, with an entry for each site that has a location inside each geometry
+        """
+        if len(geoms) == 0 or len(self.site_ids) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+        geom_index, point_index = self.tree.query(geoms, predicate = 'contains')
+        return geom_index, self.site_ids[point_index]
+
+def process_species(session, site_index, species):
+    """
+    Inserts the sites where the taxa of each species are present into t2_site_taxon_presence
+    """
+    rows = session.execute(text("""SELECT taxon_id, HEX(ST_AsWKB(geometry))
+        FROM taxon_presence_alpha_hull_subdiv
+        WHERE range_id = 1
+        AND taxon_id IN (SELECT id FROM taxon WHERE spno IN (%s))""" % sql_list_placeholder('species', species)),
+        sql_list_argument('species', species)).fetchall()
+
+    taxa = np.array([taxon_id for taxon_id, geom_wkb in rows], dtype=object)
+    geoms = shapely.from_wkb([binascii.unhexlify(geom_wkb) for taxon_id, geom_wkb in rows])
+    geom_index, site_ids = site_index.find_sites(geoms)
+
+    # A site can be inside more than one piece of a hull, and can have more than one location
+    presence = set(zip(taxa[geom_index].tolist(), site_ids.tolist()))
+
+    with BulkWriter(session, 't2_site_taxon_presence', ['site_id', 'taxon_id']) as writer:
+        for taxon_id, site_id in presence:
+            writer.add(site_id = site_id, taxon_id = taxon_id)
+
+    return len(presence)
+
+def process_database(species = None, commit = False, database_config = None, journal = None, hulls_ready = None, chunk_size = 100):
+    """
+    Populates the t2_site_taxon_presence table, for all species or for a list of species
+
+    Species are processed in chunks of `chunk_size`, each of which is committed along with its journal entries (if a
+    `Journal` is supplied, species already completed are skipped).
+
+    As for `tsx.processing.t2_aggregation.process_database`, `hulls_ready` allows this step to run at the same time as
+    alpha hull generation: it is a function returning the set of species numbers whose alpha hulls have been committed
+    so far, or None once alpha hull generation is complete.
+    """
+    session = get_session(database_config)
+
+    resuming = journal is not None and journal.started(step_name)
+
+    if commit and not resuming:
+        log.info("Deleting previous site presence")
+        if species is None:
+            session.execute(text("DELETE FROM t2_site_taxon_presence"))
+        else:
+            session.execute(text("""DELETE FROM t2_site_taxon_presence
+                WHERE taxon_id IN (SELECT id FROM taxon WHERE spno IN (%s))""" % sql_list_placeholder('species', species)),
+                sql_list_argument('species', species))
+        session.commit()
+
+    if species is None:
+        species = [spno for (spno,) in session.execute(text("SELECT DISTINCT spno FROM taxon WHERE spno IS NOT NULL")).fetchall()]
+
+    if journal is not None:
+        species = journal.remaining_tasks(step_name, species)
+
+    site_index = SiteIndex(session)
+
+    log.info("Finding sites where each taxon is present")
+    total = 0
+    pending = list(species)
+    with tqdm(total = len(pending)) as progress:
+        while len(pending) > 0:
+            ready_species = None if hulls_ready is None else hulls_ready()
+            if ready_species is None:
+                ready = pending
+            else:
+                ready = [spno for spno in pending if int(spno) in ready_species]
+
+            if len(ready) == 0:
+                time.sleep(hull_poll_interval)
+                continue
+
+            chunk = ready[:chunk_size]
+            chunk_set = set(chunk)
+            pending = [spno for spno in pending if spno not in chunk_set]
+
+            total += process_species(session, site_index, chunk)
+
+            if commit:
+                if journal is not None:
+                    record_tasks(session, step_name, chunk)
+                session.commit()
+            else:
+                session.rollback()
+
+            progress.update(len(chunk))
+
+    log.info("%s site/taxon pairs" % total)
+
+    session.close()
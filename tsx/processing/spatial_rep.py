@@ -1,8 +1,8 @@
 
 from shapely.ops import transform
 import pyproj
-from shapely.geometry import shape, Point, GeometryCollection
-from tsx.geo import to_multipolygon
+from shapely.geometry import GeometryCollection
+from tsx.geo import to_multipolygon, reproject_xy
 from tsx.util import run_parallel, sql_list_placeholder, sql_list_argument
 from tsx.db import get_session
 import tsx.db.connect
@@ -11,11 +11,12 @@ from tqdm import tqdm
 import logging
 import shapely.wkb
 import binascii
+import numpy as np
 from sqlalchemy import text
 
-from tsx.processing.alpha_hull import make_alpha_hull
-
-import fiona
+from tsx.processing.alpha_hull import make_alpha_hull, get_alpha_hull_params, get_alpha_hull_cache, log_cache_stats, prune_alpha_hull_cache
+from tsx.processing.coastline import build_coastline_asset, get_coastal_shape, clip_to_coastline
+from tsx.processing.journal import record_task
 
 log = logging.getLogger(__name__)
 
@@ -24,17 +25,24 @@ working_proj = pyproj.Proj('EPSG:3112') # GDA94 / Geoscience Australia Lambert -
 to_working_transformer = pyproj.Transformer.from_proj(db_proj, working_proj, always_xy=True)
 to_db_transformer = pyproj.Transformer.from_proj(working_proj, db_proj, always_xy=True)
 
-def process_database(species = None, commit = False):
+# Name of this processing step in the run journal
+step_name = 'spatial_rep'
+
+def process_database(species = None, commit = False, journal = None):
     """
     Calculates spatial representativeness using alpha hulls
 
     Generates alpha hulls from each source x taxon combination
 
     Intersects alpha hulls with range layers, and then calculates percentage of range covered
+
+    If a `Journal` is supplied, completed taxa are recorded in it, and taxa already completed are skipped.
     """
     session = get_session()
 
-    if commit:
+    resuming = journal is not None and journal.started(step_name)
+
+    if commit and not resuming:
         if species is None:
             session.execute(text("DELETE FROM taxon_source_alpha_hull"))
         else:
@@ -43,67 +51,71 @@ def process_database(species = None, commit = False):
                 sql_list_argument('species', species))
         session.commit()
 
-    # Load coastal shapefile
-    coastal_shape_filename = tsx.config.config.get("processing.alpha_hull", "coastal_shp")
-    with fiona.Env(OSR_WKT_FORMAT="WKT2_2018"), fiona.open(coastal_shape_filename, 'r') as coastal_shape:
-        # Convert from fiona dictionary to shapely geometry and reproject
-        shp_to_working_transformer = pyproj.Transformer.from_proj(pyproj.CRS.from_wkt(coastal_shape.crs_wkt), working_proj, always_xy=True)
-        coastal_shape = reproject(shape(coastal_shape[0]['geometry']), shp_to_working_transformer)
-        # Simplify coastal boundary - makes things run ~20X faster
-        log.info("Simplifying coastal boundary")
-        coastal_shape = coastal_shape.buffer(10000).simplify(10000)
+    # Build the simplified coastal boundary once, up front, so that workers can just load it
+    build_coastline_asset()
 
     log.info("Generating alpha shapes")
 
-    for data_type in 1,2:
-        log.info("Processing type %s data" % data_type)
+    # Each task processes both data types for a taxon, so that the taxon's points only need to be loaded once
+    taxa = list(dict.fromkeys(get_taxa(session, 1, species) + get_taxa(session, 2, species)))
+
+    # Share the coastal boundary with the workers, so tasks only need to carry the taxon id
+    shared_kwargs = { 'commit': commit, 'coastal_shape': get_coastal_shape() }
+
+    if journal is not None:
+        taxa = journal.remaining_tasks(step_name, taxa)
+        shared_kwargs['journal_step'] = step_name
 
-        taxa = get_taxa(session, data_type, species)
+    # Process the taxa with the most data first, so that large taxa don't hold up the end of the run
+    cost = get_taxon_costs(session)
 
-        tasks = [(taxon_id, coastal_shape, data_type, commit) for taxon_id in taxa]
+    # This is important because we are about to spawn child processes, and this stops them attempting to share the
+    # same database connection pool
+    session.close() # TODO: not sure if this is needed now
 
-        # This is important because we are about to spawn child processes, and this stops them attempting to share the
-        # same database connection pool
-        session.close() # TODO: not sure if this is needed now
+    # Process all the species in parallel
+    results = []
+    for result, error in tqdm(run_parallel(process, taxa, shared_kwargs = shared_kwargs, cost = cost), total = len(taxa)):
+        if error:
+            print(error)
+        results.append(result)
 
-        # Process all the species in parallel
-        for result, error in tqdm(run_parallel(process, tasks), total = len(tasks)):
-            if error:
-                print(error)
+    log_cache_stats(results)
+    prune_alpha_hull_cache()
 
 # Process a single species.
 # This gets run off the main thread.
-def process(taxon_id, coastal_shape, data_type, commit):
+def process(taxon_id, commit, coastal_shape = None, journal_step = None):
     session = get_session()
+    cache = get_alpha_hull_cache()
 
     try:
-        # Load core range geometry
-        core_range_geom = reproject(get_core_range_geometry(session, taxon_id), to_working_transformer).buffer(0).intersection(coastal_shape)
+        if coastal_shape is None:
+            coastal_shape = get_coastal_shape()
 
-        for source_id in get_source_ids(session, data_type, taxon_id):
+        # Load core range geometry (shared by all sources and data types)
+        core_range_geom = clip_to_coastline(reproject(get_core_range_geometry(session, taxon_id), to_working_transformer).buffer(0), coastal_shape)
 
-            log.info("Processing taxon_id: %s, source_id: %s" % (taxon_id, source_id))
+        for (data_type, source_id), (xs, ys) in get_taxon_points(session, taxon_id).items():
 
-            # Get raw points from DB
-            raw_points = get_raw_points(session, data_type, taxon_id, source_id)
+            log.info("Processing taxon_id: %s, source_id: %s, data_type: %s" % (taxon_id, source_id, data_type))
 
-            empty = len(raw_points) < 4
+            empty = len(xs) < 4
 
             if empty:
-                log.info("Taxon %s: not enough points to create alpha hull (%s)" % (taxon_id, len(raw_points)))
+                log.info("Taxon %s: not enough points to create alpha hull (%s)" % (taxon_id, len(xs)))
 
             if not empty:
-                # Read points from database
-                points = [reproject(p, to_working_transformer) for p in raw_points]
+                # Reproject points to working projection
+                xs, ys = reproject_xy(xs, ys, to_working_transformer)
 
                 # Generate alpha shape
                 alpha_shp = make_alpha_hull(
-                    points = points,
+                    xs = xs,
+                    ys = ys,
                     coastal_shape = None,
-                    thinning_distance = tsx.config.config.getfloat('processing.alpha_hull', 'thinning_distance'),
-                    alpha = tsx.config.config.getfloat('processing.alpha_hull', 'alpha'),
-                    hullbuffer_distance = tsx.config.config.getfloat('processing.alpha_hull', 'hullbuffer_distance'),
-                    isolatedbuffer_distance = tsx.config.config.getfloat('processing.alpha_hull', 'isolatedbuffer_distance'))
+                    cache = cache,
+                    **get_alpha_hull_params())
 
                 # Clean up geometry
                 alpha_shp = alpha_shp.buffer(0)
@@ -136,8 +148,13 @@ def process(taxon_id, coastal_shape, data_type, commit):
                         'alpha_hull_area': intersected_alpha.area
                     })
 
-            if commit:
-                session.commit()
+        # Commit all sources for the taxon together, so that a resumed run never sees a partially processed taxon
+        if commit:
+            if journal_step:
+                record_task(session, journal_step, taxon_id)
+            session.commit()
+
+        return cache and cache.stats()
 
     except:
         log.exception("Exception processing alpha hull")
@@ -171,35 +188,50 @@ def get_taxa(session, data_type, species):
 
     return taxa
 
-def get_source_ids(session, data_type, taxon_id):
-    if data_type == 1:
-        sql = """SELECT DISTINCT source_id
-        FROM t1_survey, t1_sighting
-        WHERE survey_id = t1_survey.id
-        AND taxon_id = :taxon_id"""
-    else:
-        sql = """SELECT DISTINCT source_id
-        FROM aggregated_by_year
-        WHERE data_type = 2
-        AND taxon_id = :taxon_id"""
-
-    return [source_id for (source_id,) in session.execute(text(sql), { 'taxon_id': taxon_id }).fetchall()]
+def get_taxon_costs(session):
+    """
+    Estimated processing cost of each taxon (number of type 1 sightings and type 2 aggregated rows), for scheduling
+    """
+    return dict(session.execute(text("""SELECT taxon_id, SUM(n)
+        FROM (
+            SELECT taxon_id, COUNT(*) AS n FROM t1_sighting GROUP BY taxon_id
+            UNION ALL
+            SELECT taxon_id, COUNT(*) AS n FROM aggregated_by_year WHERE data_type = 2 GROUP BY taxon_id
+        ) counts
+        GROUP BY taxon_id""")).fetchall())
+
+def get_taxon_points(session, taxon_id):
+    """
+    Loads the distinct sighting coordinates for a taxon, for all sources and both data types, in a single query
 
-def get_raw_points(session, data_type, taxon_id, source_id):
-    if data_type == 1:
-        sql = """SELECT DISTINCT ST_X(coords), ST_Y(coords)
+    Returns a dictionary of (data_type, source_id) => (xs, ys), ordered by data type and then source. Sources without any
+    coordinates (possible for type 2 data) are included with empty arrays.
+    """
+    rows = session.execute(text("""
+        SELECT DISTINCT 1, source_id, ST_X(coords), ST_Y(coords)
         FROM t1_survey, t1_sighting
         WHERE survey_id = t1_survey.id
-        AND source_id = :source_id
-        AND taxon_id = :taxon_id"""
-    else:
-        sql = """SELECT DISTINCT ST_X(t2_survey.coords), ST_Y(t2_survey.coords)
+        AND taxon_id = :taxon_id
+        UNION
+        SELECT DISTINCT 2, agg.source_id, ST_X(t2_survey.coords), ST_Y(t2_survey.coords)
         FROM aggregated_by_year agg
-        JOIN t2_survey ON t2_survey.site_id = agg.site_id
+        LEFT JOIN t2_survey ON t2_survey.site_id = agg.site_id
         WHERE agg.data_type = 2
-        AND agg.source_id = :source_id
-        AND agg.taxon_id = :taxon_id"""
+        AND agg.taxon_id = :taxon_id"""), { 'taxon_id': taxon_id }).fetchall()
+
+    if len(rows) == 0:
+        return {}
+
+    # Note: NULL coordinates become NaN
+    rows = np.array(rows, dtype=float).reshape(-1, 4)
+
+    # Group rows by (data_type, source_id) - lexsort is stable, so the original row order is kept within each group
+    rows = rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+    keys, starts = np.unique(rows[:, 0:2], axis=0, return_index=True)
 
-    xys = session.execute(text(sql), { 'taxon_id': taxon_id, 'source_id': source_id }).fetchall()
+    result = {}
+    for (data_type, source_id), group in zip(keys, np.split(rows[:, 2:4], starts[1:])):
+        group = group[~np.isnan(group).any(axis=1)]
+        result[(int(data_type), int(source_id))] = (group[:, 0], group[:, 1])
 
-    return [Point(x, y) for x, y in xys]
+    return result
@@ -1,12 +1,57 @@
 import logging
 from tqdm import tqdm
+import tsx.config
 from tsx.db import get_session
 from tsx.util import run_parallel, sql_list_placeholder, sql_list_argument
 from sqlalchemy import text
+from tsx.processing.journal import record_task, record_tasks
+from tsx.processing import region_lookup
+from tsx.preprocessing import raw_data_glob, preprocessed_data_dir
+import duckdb
+import glob
+import os
+import pyarrow as pa
 
 log = logging.getLogger(__name__)
 
-def process_database(species = None, commit = False, simple_mode = False, database_config = None):
+# Names of the processing steps in the run journal
+monthly_step_name = 't1_aggregation.monthly'
+yearly_step_name = 't1_aggregation.yearly'
+
+# Aggregation engines:
+# - 'taxon': each taxon is a task, with one statement per processing_method row (see `aggregate_monthly`)
+# - 'set': all taxa are aggregated together, with one statement per response variable type (see `aggregate_monthly_set`)
+# - 'duckdb': all taxa are aggregated by month and year in DuckDB from the preprocessed raw data, and the results loaded
+#   into MySQL (see `aggregate_duckdb`)
+engines = ['taxon', 'set', 'duckdb']
+
+def process_database(species = None, commit = False, simple_mode = False, database_config = None, journal = None, engine = None, fused = None):
+    """
+    Aggregates type 1 data by month and then by year
+
+    If a `Journal` is supplied, completed taxa are recorded in it, and taxa already completed are skipped.
+
+    `engine` selects how monthly aggregation is performed (see `engines`), and defaults to the `engine` option in the
+    `processing.t1_aggregation` config section. The 'taxon' engine is always used when processing a list of species.
+
+    With the 'set' engine, the `partitions` option splits the taxa into that many groups, each aggregated separately (and
+    in parallel), which limits the size of the temporary tables MySQL uses for grouping.
+
+    The 'duckdb' engine reads the raw data exported by `tsx.preprocessing`, which must be up to date.
+
+    If `fused` is true (default: the `fused` config option), each task also performs the yearly aggregation of its taxa in
+    the same transaction as the monthly aggregation, instead of running a second pass over all taxa.
+    """
+    if fused is None:
+        fused = tsx.config.config.getboolean('processing.t1_aggregation', 'fused', fallback=False)
+    if engine is None:
+        engine = tsx.config.get('processing.t1_aggregation', 'engine', 'taxon')
+    if engine not in engines:
+        raise ValueError("Unknown engine: %s" % engine)
+    if species is not None and engine == 'set':
+        log.info("Using 'taxon' engine to process species list")
+        engine = 'taxon'
+
     session = get_session(database_config)
     if species is None:
         taxa = [taxon_id for (taxon_id,) in session.execute(text("SELECT DISTINCT taxon_id FROM t1_sighting")).fetchall()]
@@ -15,8 +60,10 @@ def process_database(species = None, commit = False, simple_mode = False, databa
             text("SELECT DISTINCT taxon_id FROM t1_sighting, taxon WHERE taxon.id = taxon_id AND spno IN (%s)" % sql_list_placeholder('species', species)),
             sql_list_argument('species', species)).fetchall()]
 
+    resuming = journal is not None and journal.started(monthly_step_name)
+
     # Refuse to continue if aggregated data already exists
-    if species is None:
+    if species is None and not resuming:
         for table in ["aggregated_by_month", "aggregated_by_year"]:
             sql = "SELECT 1 FROM %s WHERE data_type = 1 LIMIT 1" % table
             data_exists = len(session.execute(text(sql)).fetchall()) > 0
@@ -25,28 +72,217 @@ def process_database(species = None, commit = False, simple_mode = False, databa
                 exit(1)
 
     if not simple_mode:
-        create_region_lookup_table(session)
+        create_region_lookup_table(session, database_config = database_config)
+
+    # Process in parallel - tasks are just taxon ids, the other arguments are shared by all tasks
+    shared_kwargs = { 'simple_mode': simple_mode, 'commit': commit, 'database_config': database_config }
+    if fused:
+        shared_kwargs['fused'] = True
+
+    # Process the taxa with the most sightings first, so that large taxa don't hold up the end of the run
+    cost = get_taxon_costs(session)
+
+    log.info("Step 1/2: Monthly aggregation" + (" (and yearly aggregation)" if fused else ""))
+
+    monthly_taxa = taxa
+    if journal is not None:
+        monthly_taxa = journal.remaining_tasks(monthly_step_name, taxa)
+        shared_kwargs['journal_step'] = monthly_step_name
+
+    if engine == 'duckdb':
+        # DuckDB parallelises the aggregation internally, and performs the yearly aggregation as well
+        if len(monthly_taxa) > 0:
+            aggregate_duckdb(
+                None if len(monthly_taxa) == len(taxa) and species is None else monthly_taxa,
+                monthly_taxa if journal is not None else (),
+                simple_mode = simple_mode,
+                commit = commit,
+                database_config = database_config,
+                journal = journal is not None)
+    elif engine == 'set':
+        # Split the taxa into partitions of similar cost - each partition is a task with one statement per response
+        # variable type
+        partitions = get_partitions(monthly_taxa, cost, int(tsx.config.get('processing.t1_aggregation', 'partitions', 1)))
+        if len(partitions) == 1 and len(monthly_taxa) == len(taxa):
+            # No need to list the taxa if all are being processed
+            tasks = [(0, None, partitions[0])]
+        else:
+            tasks = [(i, partition, partition) for i, partition in enumerate(partitions)]
+        for result, error in tqdm(run_parallel(aggregate_monthly_set, tasks, shared_kwargs = shared_kwargs), total=len(tasks)):
+            if error:
+                log.error(error)
+    else:
+        for result, error in tqdm(run_parallel(aggregate_monthly, monthly_taxa, shared_kwargs = shared_kwargs, cost = cost), total=len(monthly_taxa)):
+            if error:
+                log.error(error)
 
-    # Process in parallel
-    tasks = [(taxon_id, simple_mode, commit, database_config) for taxon_id in taxa]
+    log.info("Step 2/2: Yearly aggregation")
 
-    log.info("Step 1/2: Monthly aggregation")
+    if (fused or engine == 'duckdb') and journal is None:
+        # Already done by step 1
+        yearly_taxa = []
+    else:
+        yearly_taxa = taxa
+    if journal is not None:
+        # Yearly aggregation is based on the monthly aggregation, so skip any taxa that failed in the previous step
+        # (they will be picked up if the run is resumed). In fused mode, this only leaves taxa whose monthly aggregation
+        # was completed by an earlier run that was not fused.
+        monthly_complete = journal.completed_tasks(monthly_step_name)
+        yearly_taxa = journal.remaining_tasks(yearly_step_name, [taxon_id for taxon_id in taxa if taxon_id in monthly_complete])
+        shared_kwargs['journal_step'] = yearly_step_name
+
+    shared_kwargs.pop('fused', None)
+    if len(yearly_taxa) > 0:
+        for result, error in tqdm(run_parallel(aggregate_yearly, yearly_taxa, shared_kwargs = shared_kwargs, cost = cost), total=len(yearly_taxa)):
+            if error:
+                log.error(error)
 
-    for result, error in tqdm(run_parallel(aggregate_monthly, tasks), total=len(tasks)):
-        if error:
-            print(error)
+    session = get_session(database_config)
+    cleanup_region_lookup_table(session)
 
-    log.info("Step 2/2: Yearly aggregation")
 
-    for result, error in tqdm(run_parallel(aggregate_yearly, tasks), total=len(tasks)):
-        if error:
-            print(error)
+def get_taxon_costs(session):
+    """
+    Estimated processing cost of each taxon (number of sightings), for scheduling
+    """
+    return dict(session.execute(text("SELECT taxon_id, COUNT(*) FROM t1_sighting GROUP BY taxon_id")).fetchall())
+
+def get_partitions(taxa, cost, n):
+    """
+    Splits a list of taxa into (at most) n contiguous ranges of roughly equal total cost
+    """
+    taxa = sorted(taxa)
+    n = max(1, min(n, len(taxa)))
+    total = sum(cost.get(taxon_id, 0) for taxon_id in taxa)
+
+    partitions = [[]]
+    running_cost = 0
+    for taxon_id in taxa:
+        if running_cost >= total * len(partitions) / n and len(partitions) < n:
+            partitions.append([])
+        partitions[-1].append(taxon_id)
+        running_cost += cost.get(taxon_id, 0)
+
+    return [partition for partition in partitions if len(partition) > 0]
+
+# Monthly aggregate value for each response variable type
+aggregate_expressions = {
+    1: 'AVG(count)',
+    2: 'MAX(count)',
+    3: 'AVG(count > 0)'
+}
+
+def get_region_expression(simple_mode):
+    if simple_mode:
+        return 'NULL'
+    else:
+        return 'MIN((SELECT MIN(region_id) FROM tmp_region_lookup t WHERE t.site_id = survey.site_id))'
+
+def get_centroid_expression(database_config, coords = 'survey.coords'):
+    if database_config and "sqlite:" in database_config:
+        return "MakePoint(AVG(ST_X({coords})), AVG(ST_Y({coords})), -1)".format(coords = coords)
+    else:
+        return "Point(AVG(ST_X({coords})), AVG(ST_Y({coords})))".format(coords = coords)
 
+def aggregate_monthly_set(partition, taxa = None, journal_taxa = (), simple_mode = False, commit = False, database_config = None, journal_step = None, fused = False):
+    """
+    Monthly aggregation for many taxa at once (the 'set' engine)
+
+    Rather than one statement per processing_method row (see `aggregate_monthly`), processing_method is joined to the
+    sightings, so that there is a single statement per response variable type. The output is identical.
+
+    `taxa` is the list of taxa to process, or None for all taxa. `journal_taxa` are the taxa recorded in the journal.
+
+    If `fused` is true, the yearly aggregation of the taxa is performed in the same transaction.
+    """
     session = get_session(database_config)
-    cleanup_region_lookup_table(session)
+    try:
+        if simple_mode:
+            # Equivalent of processing_method in simple mode (see `aggregate_monthly`)
+            processing_method = """(SELECT DISTINCT
+                    sighting.taxon_id, survey.source_id, sighting.unit_id, site.search_type_id, 1 AS response_variable_type_id
+                FROM t1_survey survey, t1_sighting sighting, t1_site site
+                WHERE survey.site_id = site.id
+                AND sighting.survey_id = survey.id)"""
+        else:
+            processing_method = "(SELECT * FROM processing_method WHERE data_type = 1)"
+
+        params = {}
+        taxon_condition = ""
+        if taxa is not None:
+            taxon_condition = "AND pm.taxon_id IN (%s)" % sql_list_placeholder('taxon', taxa)
+            params.update(sql_list_argument('taxon', taxa))
+
+        for response_variable_type_id, aggregate_expression in aggregate_expressions.items():
+            sql = """INSERT INTO aggregated_by_month (
+                start_date_y,
+                start_date_m,
+                source_id,
+                site_id,
+                search_type_id,
+                taxon_id,
+                response_variable_type_id,
+                value,
+                region_id,
+                positional_accuracy_in_m,
+                unit_id,
+                data_type,
+                centroid_coords,
+                survey_count)
+            SELECT
+                start_date_y,
+                start_date_m,
+                survey.source_id,
+                survey.site_id,
+                site.search_type_id,
+                sighting.taxon_id,
+                :response_variable_type_id,
+                {aggregate_expression},
+                {region_expression},
+                MAX(survey.positional_accuracy_in_m),
+                sighting.unit_id,
+                1,
+                {centroid_expression},
+                COUNT(*)
+            FROM {processing_method} pm
+            INNER JOIN
+                t1_sighting sighting ON sighting.taxon_id = pm.taxon_id AND sighting.unit_id = pm.unit_id
+            INNER JOIN
+                t1_survey survey ON survey.id = sighting.survey_id AND survey.source_id = pm.source_id
+            INNER JOIN
+                t1_site site ON site.id = survey.site_id AND site.search_type_id = pm.search_type_id
+            WHERE
+                pm.response_variable_type_id = :response_variable_type_id
+                {taxon_condition}
+            GROUP BY
+                sighting.taxon_id, survey.source_id, sighting.unit_id, site.search_type_id, start_date_y, start_date_m, survey.site_id
+            """.format(
+                    processing_method = processing_method,
+                    aggregate_expression = aggregate_expression,
+                    region_expression = get_region_expression(simple_mode),
+                    centroid_expression = get_centroid_expression(database_config),
+                    taxon_condition = taxon_condition
+                )
+
+            session.execute(text(sql), { 'response_variable_type_id': response_variable_type_id, **params })
 
+        if fused:
+            insert_yearly(session, taxa, database_config)
 
-def aggregate_monthly(taxon_id, simple_mode = False, commit = False, database_config = None):
+        if commit:
+            if journal_step:
+                record_tasks(session, journal_step, journal_taxa)
+                if fused:
+                    record_tasks(session, yearly_step_name, journal_taxa)
+            session.commit()
+
+    except:
+        log.exception("Exception aggregating partition: %s" % partition)
+        raise
+    finally:
+        session.close()
+
+def aggregate_monthly(taxon_id, simple_mode = False, commit = False, database_config = None, journal_step = None, fused = False):
     session = get_session(database_config)
     try:
         if simple_mode:
@@ -67,24 +303,9 @@ def aggregate_monthly(taxon_id, simple_mode = False, commit = False, database_co
 
             where_conditions = []
 
-            if response_variable_type_id == 1:
-                aggregate_expression = 'AVG(count)'
-
-            elif response_variable_type_id == 2:
-                aggregate_expression = 'MAX(count)'
-
-            elif response_variable_type_id == 3:
-                aggregate_expression = 'AVG(count > 0)'
-
-            if simple_mode:
-                region_expression = 'NULL'
-            else:
-                region_expression = 'MIN((SELECT MIN(region_id) FROM tmp_region_lookup t WHERE t.site_id = survey.site_id))'
-
-            if database_config and "sqlite:" in database_config:
-                centroid_expression = "MakePoint(AVG(ST_X(survey.coords)), AVG(ST_Y(survey.coords)), -1)"
-            else:
-                centroid_expression = "Point(AVG(ST_X(survey.coords)), AVG(ST_Y(survey.coords)))"
+            aggregate_expression = aggregate_expressions[response_variable_type_id]
+            region_expression = get_region_expression(simple_mode)
+            centroid_expression = get_centroid_expression(database_config)
 
             # ingest into the table
             sql = """INSERT INTO aggregated_by_month (
@@ -145,7 +366,14 @@ def aggregate_monthly(taxon_id, simple_mode = False, commit = False, database_co
                 'search_type_id': search_type_id
             })
 
+        if fused:
+            insert_yearly(session, [taxon_id], database_config)
+
         if commit:
+            if journal_step:
+                record_task(session, journal_step, taxon_id)
+                if fused:
+                    record_task(session, yearly_step_name, taxon_id)
             session.commit()
 
     except:
@@ -156,30 +384,211 @@ def aggregate_monthly(taxon_id, simple_mode = False, commit = False, database_co
 
 
 
-def aggregate_yearly(taxon_id, simple_mode = False, commit = False, database_config = None):
+def aggregate_yearly(taxon_id, simple_mode = False, commit = False, database_config = None, journal_step = None):
     session = get_session(database_config)
 
-    if database_config and "sqlite:" in database_config:
-        centroid_expression = "MakePoint(AVG(ST_X(centroid_coords)), AVG(ST_Y(centroid_coords)), -1)"
-    else:
-        centroid_expression = "Point(AVG(ST_X(centroid_coords)), AVG(ST_Y(centroid_coords)))"
+    try:
+        insert_yearly(session, [taxon_id], database_config)
 
+        if commit:
+            if journal_step:
+                record_task(session, journal_step, taxon_id)
+            session.commit()
+    except:
+        log.exception("Exception aggregating taxon: %s" % taxon_id)
+        raise
+    finally:
+        session.close()
+
+def insert_yearly(session, taxa, database_config = None):
+    """
+    Aggregates the monthly rows of the given taxa (or all taxa if None) by year
+
+    Monthly rows inserted earlier in the same transaction are included, which allows the yearly aggregation to be fused
+    with the monthly aggregation.
+    """
+    centroid_expression = get_centroid_expression(database_config, coords = 'centroid_coords')
+
+    params = {}
+    taxon_condition = ""
+    if taxa is not None:
+        taxon_condition = "AND taxon_id IN (%s)" % sql_list_placeholder('taxon', taxa)
+        params.update(sql_list_argument('taxon', taxa))
+
+    sql = """
+        INSERT INTO aggregated_by_year (
+            start_date_y,
+            source_id,
+            search_type_id,
+            site_id,
+            taxon_id,
+            response_variable_type_id,
+            value,
+            data_type,
+            region_id,
+            unit_id,
+            positional_accuracy_in_m,
+            centroid_coords,
+            survey_count)
+        SELECT
+            start_date_y,
+            source_id,
+            search_type_id,
+            site_id,
+            taxon_id,
+            response_variable_type_id,
+            AVG(value),
+            data_type,
+            region_id,
+            unit_id,
+            MAX(positional_accuracy_in_m),
+            {centroid_expression},
+            SUM(survey_count)
+        FROM aggregated_by_month
+        WHERE data_type = 1
+        {taxon_condition}
+        GROUP BY
+            start_date_y,
+            source_id,
+            search_type_id,
+            site_id,
+            taxon_id,
+            response_variable_type_id,
+            data_type,
+            region_id,
+            unit_id
+    """.format(centroid_expression = centroid_expression, taxon_condition = taxon_condition)
+
+    session.execute(text(sql), params)
+
+
+
+# Monthly aggregate value for each response variable type, in DuckDB. MySQL averages integers as DECIMAL with 4 decimal
+# places (rounding half up), so the same is done here with integer arithmetic.
+duckdb_aggregate_expressions = {
+    1: 'AVG(count)',
+    2: 'MAX(count)',
+    3: '((SUM((count > 0)::INTEGER) * 20000 + COUNT(*)) // (2 * COUNT(*))) / 10000.0'
+}
+
+def aggregate_duckdb(taxa = None, journal_taxa = (), simple_mode = False, commit = False, database_config = None, journal = False, batch_size = 10000):
+    """
+    Monthly and yearly aggregation in DuckDB (the 'duckdb' engine)
+
+    Sightings are read from the raw data files written by `tsx.preprocessing`, and processing_method and the region lookup
+    are read from the database. The aggregated rows are then inserted into aggregated_by_month and aggregated_by_year in
+    a single transaction. The output is the same as `aggregate_monthly` followed by `aggregate_yearly`.
+
+    `taxa` is the list of taxa to process, or None for all taxa. If `journal` is true, `journal_taxa` are recorded in the
+    journal as complete for both the monthly and yearly steps.
+    """
+    session = get_session(database_config)
+    db = duckdb.connect()
     try:
-        sql = """
-            INSERT INTO aggregated_by_year (
-                start_date_y,
-                source_id,
-                search_type_id,
-                site_id,
-                taxon_id,
-                response_variable_type_id,
-                value,
-                data_type,
-                region_id,
-                unit_id,
-                positional_accuracy_in_m,
-                centroid_coords,
-                survey_count)
+        params = {}
+        taxon_condition = ""
+        if taxa is not None:
+            taxon_condition = "AND taxon_id IN (%s)" % sql_list_placeholder('taxon', taxa)
+            params.update(sql_list_argument('taxon', taxa))
+
+        if len(glob.glob(os.path.join(preprocessed_data_dir(), "*_raw.parquet"))) == 0:
+            raise ValueError("No preprocessed data found (run 'python -m tsx.preprocessing')")
+
+        # The unit and search type are only present in the raw data as descriptions, but the time series id contains the ids
+        db.execute("""CREATE TABLE sighting AS
+            SELECT
+                TaxonID AS taxon_id,
+                SourceID AS source_id,
+                string_split(TimeSeriesID, '_')[2]::INTEGER AS unit_id,
+                NULLIF(string_split(TimeSeriesID, '_')[3]::INTEGER, 0) AS search_type_id,
+                SiteID AS site_id,
+                StartYear AS start_date_y,
+                StartMonth AS start_date_m,
+                X AS x,
+                Y AS y,
+                PositionalAccuracyInM AS positional_accuracy_in_m,
+                Count AS count
+            FROM read_parquet('%s')
+            WHERE DataType = 1""" % raw_data_glob())
+        if taxa is not None:
+            db.execute("DELETE FROM sighting WHERE taxon_id NOT IN (SELECT UNNEST($taxa))", { 'taxa': list(taxa) })
+
+        check_raw_data(session, db, taxon_condition, params)
+
+        if simple_mode:
+            db.execute("""CREATE TABLE processing_method AS
+                SELECT DISTINCT taxon_id, source_id, unit_id, search_type_id, 1 AS response_variable_type_id
+                FROM sighting""")
+            db.execute("CREATE TABLE site_region (site_id INTEGER, region_id INTEGER)")
+        else:
+            rows = session.execute(text("""SELECT taxon_id, source_id, unit_id, search_type_id, response_variable_type_id
+                FROM processing_method
+                WHERE data_type = 1
+                {taxon_condition}""".format(taxon_condition = taxon_condition)), params).fetchall()
+            processing_method = pa.table(list(zip(*rows)) if rows else [[]] * 5, schema = pa.schema([
+                ('taxon_id', pa.string()),
+                ('source_id', pa.int32()),
+                ('unit_id', pa.int32()),
+                ('search_type_id', pa.int32()),
+                ('response_variable_type_id', pa.int32())]))
+            db.register('processing_method', processing_method)
+
+            rows = session.execute(text("SELECT site_id, MIN(region_id) FROM tmp_region_lookup GROUP BY site_id")).fetchall()
+            site_region = pa.table(list(zip(*rows)) if rows else [[]] * 2, schema = pa.schema([
+                ('site_id', pa.int32()),
+                ('region_id', pa.int32())]))
+            db.register('site_region', site_region)
+
+        db.execute("""CREATE TABLE month (
+            start_date_y INTEGER,
+            start_date_m INTEGER,
+            source_id INTEGER,
+            site_id INTEGER,
+            search_type_id INTEGER,
+            taxon_id VARCHAR,
+            response_variable_type_id INTEGER,
+            value DOUBLE,
+            region_id INTEGER,
+            positional_accuracy_in_m DOUBLE,
+            unit_id INTEGER,
+            data_type INTEGER,
+            x DOUBLE,
+            y DOUBLE,
+            survey_count INTEGER)""")
+
+        for response_variable_type_id, aggregate_expression in duckdb_aggregate_expressions.items():
+            db.execute("""INSERT INTO month
+                SELECT
+                    start_date_y,
+                    start_date_m,
+                    s.source_id,
+                    s.site_id,
+                    s.search_type_id,
+                    s.taxon_id,
+                    pm.response_variable_type_id,
+                    {aggregate_expression},
+                    {region_expression},
+                    MAX(positional_accuracy_in_m),
+                    s.unit_id,
+                    1,
+                    AVG(x),
+                    AVG(y),
+                    COUNT(*)
+                FROM processing_method pm
+                JOIN sighting s ON s.taxon_id = pm.taxon_id
+                    AND s.source_id = pm.source_id
+                    AND s.unit_id = pm.unit_id
+                    AND s.search_type_id = pm.search_type_id
+                LEFT JOIN site_region r ON r.site_id = s.site_id
+                WHERE pm.response_variable_type_id = $response_variable_type_id
+                GROUP BY
+                    s.taxon_id, s.source_id, s.unit_id, s.search_type_id, start_date_y, start_date_m, s.site_id, pm.response_variable_type_id
+                """.format(
+                    aggregate_expression = aggregate_expression,
+                    region_expression = 'NULL' if simple_mode else 'MIN(r.region_id)'
+                ), { 'response_variable_type_id': response_variable_type_id })
+
+        db.execute("""CREATE TABLE year AS
             SELECT
                 start_date_y,
                 source_id,
@@ -187,16 +596,15 @@ def aggregate_yearly(taxon_id, simple_mode = False, commit = False, database_con
                 site_id,
                 taxon_id,
                 response_variable_type_id,
-                AVG(value),
+                AVG(value) AS value,
                 data_type,
                 region_id,
                 unit_id,
-                MAX(positional_accuracy_in_m),
-                {centroid_expression},
-                SUM(survey_count)
-            FROM aggregated_by_month
-            WHERE taxon_id = :taxon_id
-            AND data_type = 1
+                MAX(positional_accuracy_in_m) AS positional_accuracy_in_m,
+                AVG(x) AS x,
+                AVG(y) AS y,
+                SUM(survey_count) AS survey_count
+            FROM month
             GROUP BY
                 start_date_y,
                 source_id,
@@ -206,29 +614,78 @@ def aggregate_yearly(taxon_id, simple_mode = False, commit = False, database_con
                 response_variable_type_id,
                 data_type,
                 region_id,
-                unit_id
-        """.format(centroid_expression = centroid_expression)
+                unit_id""")
 
-        session.execute(text(sql), { 'taxon_id': taxon_id })
+        for table, target_table in [('month', 'aggregated_by_month'), ('year', 'aggregated_by_year')]:
+            load_duckdb_table(session, db, table, target_table, database_config, batch_size)
 
         if commit:
+            if journal:
+                record_tasks(session, monthly_step_name, journal_taxa)
+                record_tasks(session, yearly_step_name, journal_taxa)
             session.commit()
+
     except:
-        log.exception("Exception aggregating taxon: %s" % taxon_id)
+        log.exception("Exception aggregating with DuckDB")
         raise
     finally:
+        db.close()
         session.close()
 
+def check_raw_data(session, db, taxon_condition, params):
+    """
+    Checks that the number of type 1 sightings of each source in the raw data files matches the database, so that data
+    imported since the files were last written by `tsx.preprocessing` is not silently ignored
+    """
+    expected = dict(session.execute(text("""SELECT source_id, COUNT(*)
+        FROM t1_sighting
+        JOIN t1_survey ON t1_survey.id = t1_sighting.survey_id
+        WHERE TRUE {taxon_condition}
+        GROUP BY source_id""".format(taxon_condition = taxon_condition)), params).fetchall())
+    actual = dict(db.execute("SELECT source_id, COUNT(*) FROM sighting GROUP BY source_id").fetchall())
+
+    out_of_date = sorted(source_id for source_id in set(expected) | set(actual) if expected.get(source_id) != actual.get(source_id))
+    if len(out_of_date) > 0:
+        raise ValueError("Preprocessed data is missing or out of date for sources: %s (run 'python -m tsx.preprocessing')" % out_of_date)
+
+def load_duckdb_table(session, db, table, target_table, database_config = None, batch_size = 10000):
+    """
+    Inserts the rows of an aggregated table computed by `aggregate_duckdb` into the database
+    """
+    if database_config and "sqlite:" in database_config:
+        point_expression = "MakePoint(:x, :y, -1)"
+    else:
+        point_expression = "Point(:x, :y)"
+
+    result = db.execute("SELECT * FROM %s" % table)
+    columns = [description[0] for description in result.description]
+    target_columns = [column for column in columns if column not in ('x', 'y')] + ['centroid_coords']
 
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        target_table,
+        ", ".join(target_columns),
+        ", ".join([":%s" % column for column in target_columns[:-1]] + [point_expression]))
+
+    log.info("Inserting %s rows" % target_table)
+    while True:
+        rows = result.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+        session.execute(text(sql), [dict(zip(columns, row)) for row in rows])
 
 def cleanup_region_lookup_table(session):
     session.execute(text("""DROP TABLE IF EXISTS tmp_region_lookup"""))
 
-def create_region_lookup_table(session):
+def create_region_lookup_table(session, engine = None, database_config = None):
     log.info("Pre-calculating region for each site")
 
     session.execute(text("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED"))
 
+    if region_lookup.get_engine(engine) == 'python':
+        region_lookup.create_site_region_table(session, 'tmp_region_lookup',
+            "SELECT DISTINCT site_id, ST_X(coords), ST_Y(coords) FROM t1_survey", 't1_aggregation', database_config)
+        return
+
     cleanup_region_lookup_table(session)
     session.execute(text("""CREATE TABLE tmp_region_lookup
         ( INDEX (site_id) )
@@ -2,15 +2,59 @@ import logging
 import time
 from tqdm import tqdm
 from tsx.db import get_session
-from tsx.util import run_parallel, sql_list_placeholder, sql_list_argument
+from tsx.util import run_parallel, sql_list_placeholder, sql_list_argument, order_by_cost
 from sqlalchemy import text
-from random import shuffle
+from tsx.processing.journal import record_task, record_tasks
+import tsx.config
+from tsx.processing import region_lookup, site_taxon_presence
+import numpy as np
+import pandas as pd
 
 log = logging.getLogger(__name__)
 
 print_sql_times = False
 
-def process_database(species = None, commit = False, database_config = None):
+# Name of this processing step in the run journal
+step_name = 't2_aggregation'
+
+# Aggregation engines:
+# - 'sql': monthly aggregation is performed in MySQL with temporary tables (see `process_task` and `process_batch`)
+# - 'pandas': the surveys and sightings are read by each worker, which performs monthly aggregation with pandas (see
+#   `process_batch_pandas`)
+engines = ['sql', 'pandas']
+
+# How often to check for newly computed site presence when streaming (see `process_database`)
+presence_poll_interval = 5
+
+def process_database(species = None, commit = False, database_config = None, journal = None, presence_ready = None, batch_size = None, engine = None):
+    """
+    Aggregates type 2 data
+
+    If a `Journal` is supplied, completed taxa are recorded in it, and taxa already completed are skipped.
+
+    The sites where each taxon is present are read from the t2_site_taxon_presence table (see
+    `tsx.processing.site_taxon_presence`). By default, site presence is computed first for the species being processed,
+    so that aggregation never uses missing or stale site presence. In a pipeline, aggregation can instead run at the
+    same time as the site_taxon_presence step: `presence_ready` is then a function returning the set of species numbers
+    whose site presence has been committed so far, or None once the step is complete, and each taxon is processed as
+    soon as its site presence is available.
+
+    If `batch_size` (default: the `batch_size` option in the `processing.t2_aggregation` config section) is greater than 1,
+    taxa are processed in batches of that size (see `process_batch`), except when processing a list of species.
+
+    `engine` selects how monthly aggregation is performed (see `engines`), and defaults to the `engine` option in the
+    `processing.t2_aggregation` config section. The 'pandas' engine always processes taxa in batches (of one taxon if
+    `batch_size` is 1).
+    """
+    if engine is None:
+        engine = tsx.config.get('processing.t2_aggregation', 'engine', 'sql').strip()
+    if engine not in engines:
+        raise ValueError("Unknown engine: %s" % engine)
+    if batch_size is None:
+        batch_size = int(tsx.config.get('processing.t2_aggregation', 'batch_size', 1))
+    if species is not None:
+        batch_size = 1
+    batched = batch_size > 1 or engine == 'pandas'
     session = get_session(database_config)
     if species is None:
         taxa = [taxon_id for (taxon_id,) in session.execute(text("SELECT DISTINCT taxon_id FROM processing_method")).fetchall()]
@@ -19,8 +63,10 @@ def process_database(species = None, commit = False, database_config = None):
             text("SELECT DISTINCT taxon_id FROM t2_sighting, taxon WHERE taxon.id = taxon_id AND spno IN (%s)" % sql_list_placeholder('species', species)),
             sql_list_argument('species', species)).fetchall()]
 
+    resuming = journal is not None and journal.started(step_name)
+
     # Refuse to continue if aggregated data already exists
-    if species is None:
+    if species is None and not resuming:
         for table in ["aggregated_by_month", "aggregated_by_year"]:
             sql = "SELECT 1 FROM %s WHERE data_type = 2 LIMIT 1" % table
             data_exists = len(session.execute(text(sql)).fetchall()) > 0
@@ -28,7 +74,12 @@ def process_database(species = None, commit = False, database_config = None):
                 log.error("Type 2 data already exists in %s table" % table)
                 exit(1)
 
-    shuffle(taxa)
+    if presence_ready is None:
+        if commit:
+            site_taxon_presence.process_database(species = species, commit = True, database_config = database_config)
+        else:
+            # Site presence would have to be committed to be seen by the workers
+            log.warning("Dry-run: using the existing site presence, which may be out of date")
 
     sql = """
         SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED;
@@ -47,11 +98,6 @@ def process_database(species = None, commit = False, database_config = None):
 
         ALTER TABLE tmp_site_centroid CHANGE COLUMN centroid centroid POINT SRID 0 NOT NULL;
 
-        UPDATE /*+ JOIN_ORDER(tmp_site_centroid, region_subdiv) */
-        tmp_site_centroid, region_subdiv
-        SET region_id = region_subdiv.id
-        WHERE ST_Intersects(centroid, geometry);
-
         ALTER TABLE tmp_site_centroid ADD SPATIAL INDEX centroid (centroid);
 
         ALTER TABLE tmp_site_centroid ADD INDEX site_id (site_id)
@@ -61,14 +107,38 @@ def process_database(species = None, commit = False, database_config = None):
     for stmt in tqdm(sql.split(";")):
         run_sql(session, stmt)
 
-    # Process taxa in parallel
-    tasks = [(taxon_id, commit, database_config) for taxon_id in taxa]
+    update_site_centroid_regions(session, database_config = database_config)
+
+    # Process taxa in parallel - tasks are just taxon ids, the other arguments are shared by all tasks
+    shared_kwargs = { 'commit': commit, 'database_config': database_config }
+
+    if journal is not None:
+        taxa = journal.remaining_tasks(step_name, taxa)
+        shared_kwargs['journal_step'] = step_name
+
+    # Process the taxa with the most sightings first, so that large taxa don't hold up the end of the run
+    cost = get_taxon_costs(session)
+
+    if presence_ready is None:
+        tasks = order_by_cost(taxa, cost)
+        if batched:
+            tasks = batches(tasks, batch_size)
+    else:
+        taxon_spno = dict(session.execute(text("SELECT id, spno FROM taxon")).fetchall())
+        tasks = stream_ready_taxa(taxa, taxon_spno, presence_ready, cost, batch_size if batched else None)
 
     session.close() # Important to close session before spawning multiple processes
 
     log.info("Performing aggregation")
 
-    for result, error in tqdm(run_parallel(process_task, tasks), total=len(tasks)):
+    if engine == 'pandas':
+        target = process_batch_pandas
+    elif batched:
+        target = process_batch
+    else:
+        target = process_task
+    total = (len(taxa) + batch_size - 1) // batch_size
+    for result, error in tqdm(run_parallel(target, tasks, shared_kwargs = shared_kwargs), total=total):
         if error:
             print(error)
             print("Shutting down due to error")
@@ -78,6 +148,56 @@ def process_database(species = None, commit = False, database_config = None):
     session = get_session(database_config)
     run_sql(session, "DROP TABLE tmp_site_centroid")
 
+def update_site_centroid_regions(session, engine = None, database_config = None):
+    """
+    Sets the region of each site in tmp_site_centroid (the region that the centroid of the site's surveys falls in)
+    """
+    log.info("Calculating region for each site")
+    if region_lookup.get_engine(engine) == 'python':
+        region_lookup.create_site_region_table(session, 'tmp_site_region',
+            "SELECT site_id, ST_X(centroid), ST_Y(centroid) FROM tmp_site_centroid", 't2_aggregation', database_config)
+        # There is one region per site (centroids on the boundary between regions are assigned the lowest region id)
+        run_sql(session, """UPDATE tmp_site_centroid
+            SET region_id = (SELECT MIN(region_id) FROM tmp_site_region WHERE tmp_site_region.site_id = tmp_site_centroid.site_id)""")
+        run_sql(session, "DROP TABLE tmp_site_region")
+    else:
+        run_sql(session, """UPDATE /*+ JOIN_ORDER(tmp_site_centroid, region_subdiv) */
+            tmp_site_centroid, region_subdiv
+            SET region_id = region_subdiv.id
+            WHERE ST_Intersects(centroid, geometry)""")
+    session.commit()
+
+def stream_ready_taxa(taxa, taxon_spno, presence_ready, cost, batch_size = None):
+    """
+    Yields taxa as their site presence becomes available (see `process_database`), largest first within each batch
+
+    If batch_size is given, lists of up to batch_size taxa (whose site presence is all available) are yielded instead
+    """
+    pending = list(taxa)
+    while len(pending) > 0:
+        ready_species = presence_ready()
+        if ready_species is None:
+            ready = pending
+        else:
+            ready = [taxon_id for taxon_id in pending if taxon_spno.get(taxon_id) in ready_species]
+
+        if len(ready) == 0:
+            time.sleep(presence_poll_interval)
+            continue
+
+        ready_set = set(ready)
+        pending = [taxon_id for taxon_id in pending if taxon_id not in ready_set]
+        if batch_size is not None:
+            yield from batches(order_by_cost(ready, cost), batch_size)
+        else:
+            yield from order_by_cost(ready, cost)
+
+def get_taxon_costs(session):
+    """
+    Estimated processing cost of each taxon (number of sightings), for scheduling
+    """
+    return dict(session.execute(text("SELECT taxon_id, COUNT(*) FROM t2_sighting GROUP BY taxon_id")).fetchall())
+
 def run_sql(session, sql, *args, **kwargs):
     if print_sql_times:
         short_sql = sql.replace("\n", " ")[:100]
@@ -91,8 +211,108 @@ def run_sql(session, sql, *args, **kwargs):
         print("%s took %s sec" % (short_sql, t1 - t0))
 
 
+# Inserts the monthly aggregated data for the taxa in tmp_survey_agg
+insert_monthly_sql = """
+    -- Insert results into permanent table
+    INSERT INTO aggregated_by_month (
+        start_date_y,
+        start_date_m,
+        site_id,
+        search_type_id,
+        taxon_id,
+        response_variable_type_id,
+        value,
+        data_type,
+        source_id,
+        region_id,
+        unit_id,
+        positional_accuracy_in_m,
+        centroid_coords,
+        survey_count
+    )
+    SELECT
+        year,
+        month,
+        site_id,
+        search_type_id,
+        taxon_id,
+        response_variable_type.id,
+        CASE response_variable_type.id
+            WHEN 1 THEN mean_abundance -- avg count
+            WHEN 2 THEN max_count -- max count
+            WHEN 3 THEN rr -- reporting rate
+            ELSE NULL
+        END AS value,
+        2,
+        source_id,
+        (SELECT region_id FROM tmp_site_centroid WHERE tmp_site_centroid.site_id = tmp_survey_agg.site_id),
+        CASE response_variable_type.id
+            WHEN 1 THEN 2 -- avg count => abundance
+            WHEN 2 THEN 2 -- max count => abundance
+            WHEN 3 THEN 1 -- reporting rate => occupancy
+            ELSE NULL
+        END,
+        positional_accuracy_in_m,
+        Point(centroid_x, centroid_y),
+        num_surveys
+    FROM tmp_survey_agg, response_variable_type
+    -- Comment out following to ignore processing_method table
+    WHERE (taxon_id, source_id, 2, response_variable_type.id) IN
+    (SELECT taxon_id, source_id, data_type, response_variable_type_id FROM processing_method)
+
+    HAVING value IS NOT NULL
+"""
+
+# Aggregates the monthly data of the taxa by year - {taxa} is replaced with the list of taxa
+insert_yearly_sql = """
+    INSERT INTO aggregated_by_year (
+            start_date_y,
+            source_id,
+            search_type_id,
+            site_id,
+            taxon_id,
+            response_variable_type_id,
+            value,
+            data_type,
+            region_id,
+            unit_id,
+            positional_accuracy_in_m,
+            centroid_coords,
+            survey_count)
+        SELECT
+            start_date_y,
+            source_id,
+            search_type_id,
+            site_id,
+            taxon_id,
+            response_variable_type_id,
+            AVG(value),
+            data_type,
+            region_id,
+            unit_id,
+            MAX(positional_accuracy_in_m) AS positional_accuracy_in_m,
+            Point(AVG(ST_X(centroid_coords)), AVG(ST_Y(centroid_coords))),
+            SUM(survey_count)
+        FROM aggregated_by_month
+        WHERE taxon_id IN ({taxa})
+        AND data_type = 2
+        GROUP BY
+            start_date_y,
+            source_id,
+            search_type_id,
+            site_id,
+            taxon_id,
+            response_variable_type_id,
+            data_type,
+            region_id,
+            unit_id
+"""
+
+# Both of the above, as used by `process_task` and `process_batch`
+insert_aggregated_sql = insert_monthly_sql + ";" + insert_yearly_sql
+
 # Assumption: the raw data does not contain ultrataxa and non-ultrataxa for the same species
-def process_task(taxon_id, commit=False, database_config=None):
+def process_task(taxon_id, commit=False, database_config=None, journal_step=None):
     session = get_session(database_config)
 
     sql = """
@@ -107,15 +327,13 @@ def process_task(taxon_id, commit=False, database_config=None):
             WHERE spno = (SELECT spno FROM taxon WHERE taxon.id = @taxon_id)
             AND taxon_level_id = (SELECT id FROM taxon_level WHERE description = 'sp'));
 
-        -- Find sites where this taxon is present
+        -- Find sites where this taxon is present (precomputed by the site_taxon_presence step)
         CREATE TEMPORARY TABLE tmp_site_taxon AS
-        SELECT DISTINCT
+        SELECT
             site_id,
             taxon_id
-        FROM taxon_presence_alpha_hull_subdiv alpha, t2_survey
-        WHERE ST_Contains(alpha.geometry, t2_survey.coords)
-        AND alpha.range_id = 1
-        AND alpha.taxon_id = @taxon_id;
+        FROM t2_site_taxon_presence
+        WHERE taxon_id = @taxon_id;
 
         -- Find all sightings and pseudo-absences
         CREATE TEMPORARY TABLE tmp_sighting AS
@@ -167,107 +385,308 @@ def process_task(taxon_id, commit=False, database_config=None):
             FROM t;
 
 
-        -- Insert results into permanent table
-        INSERT INTO aggregated_by_month (
-            start_date_y,
-            start_date_m,
-            site_id,
-            search_type_id,
-            taxon_id,
-            response_variable_type_id,
-            value,
-            data_type,
-            source_id,
-            region_id,
-            unit_id,
-            positional_accuracy_in_m,
-            centroid_coords,
-            survey_count
-        )
+        {insert_aggregated}
+    """.format(insert_aggregated = insert_aggregated_sql.format(taxa = ':taxon_id'))
+
+    for stmt in sql.split(";"):
+        run_sql(session, stmt, { 'taxon_id': taxon_id })
+
+    # Note: dropping the temporary tables below implicitly commits the transaction, so the journal entry must be recorded
+    # first so that it is committed along with the aggregated data
+    if commit and journal_step:
+        record_task(session, journal_step, taxon_id)
+
+    sql = """
+        DROP TABLE tmp_sighting;
+        DROP TABLE tmp_survey_agg;
+        DROP TABLE tmp_site_taxon
+    """
+
+    for stmt in sql.split(";"):
+        run_sql(session, stmt)
+
+    if commit:
+        session.commit()
+
+    session.close()
+
+def process_batch(taxa, commit=False, database_config=None, journal_step=None):
+    """
+    Equivalent to `process_task` for a batch of taxa, with one set of statements for the whole batch (using taxon_id as a
+    grouping column throughout)
+    """
+    session = get_session(database_config)
+
+    params = sql_list_argument('taxon', taxa)
+    taxa_placeholder = sql_list_placeholder('taxon', taxa)
+
+    sql = """
+        -- Go faster
+        SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED;
+
+        -- Taxa in the batch and their species
+        CREATE TEMPORARY TABLE tmp_batch_taxon
+        ( PRIMARY KEY (taxon_id) )
+        SELECT
+            taxon.id AS taxon_id,
+            (
+                SELECT species.id FROM taxon species
+                WHERE species.spno = taxon.spno
+                AND species.taxon_level_id = (SELECT id FROM taxon_level WHERE description = 'sp')
+            ) AS species_id
+        FROM taxon
+        WHERE taxon.id IN ({taxa});
+
+        -- Find sites where each taxon is present (precomputed by the site_taxon_presence step)
+        CREATE TEMPORARY TABLE tmp_site_taxon
+        ( INDEX (site_id) )
         SELECT
-            year,
-            month,
             site_id,
-            search_type_id,
-            taxon_id,
-            response_variable_type.id,
-            CASE response_variable_type.id
-                WHEN 1 THEN mean_abundance -- avg count
-                WHEN 2 THEN max_count -- max count
-                WHEN 3 THEN rr -- reporting rate
-                ELSE NULL
-            END AS value,
-            2,
-            source_id,
-            (SELECT region_id FROM tmp_site_centroid WHERE tmp_site_centroid.site_id = tmp_survey_agg.site_id),
-            CASE response_variable_type.id
-                WHEN 1 THEN 2 -- avg count => abundance
-                WHEN 2 THEN 2 -- max count => abundance
-                WHEN 3 THEN 1 -- reporting rate => occupancy
-                ELSE NULL
-            END,
-            positional_accuracy_in_m,
-            Point(centroid_x, centroid_y),
-            num_surveys
-        FROM tmp_survey_agg, response_variable_type
-        -- Comment out following to ignore processing_method table
-        WHERE (taxon_id, source_id, 2, response_variable_type.id) IN
-        (SELECT taxon_id, source_id, data_type, response_variable_type_id FROM processing_method)
-
-        HAVING value IS NOT NULL;
-
-        -- Yearly aggregation
-        INSERT INTO aggregated_by_year (
-                start_date_y,
-                source_id,
-                search_type_id,
-                site_id,
-                taxon_id,
-                response_variable_type_id,
-                value,
-                data_type,
-                region_id,
-                unit_id,
-                positional_accuracy_in_m,
-                centroid_coords,
-                survey_count)
+            taxon_id
+        FROM t2_site_taxon_presence
+        WHERE taxon_id IN ({taxa});
+
+        -- Find all sightings and pseudo-absences
+        CREATE TEMPORARY TABLE tmp_sighting AS
+            -- Pseudo-absences and presences based on spno or taxon_id match
+            SELECT tmp_site_taxon.taxon_id, t2_survey.id AS survey_id, t2_sighting.id AS sighting_id
+            FROM t2_survey
+            JOIN tmp_site_taxon ON tmp_site_taxon.site_id = t2_survey.site_id
+            JOIN tmp_batch_taxon ON tmp_batch_taxon.taxon_id = tmp_site_taxon.taxon_id
+            LEFT JOIN t2_sighting ON t2_sighting.survey_id = t2_survey.id AND t2_sighting.taxon_id IN (tmp_batch_taxon.taxon_id, tmp_batch_taxon.species_id)
+            ;
+
+        -- Aggregate to monthly time series
+        CREATE TEMPORARY TABLE tmp_survey_agg AS
+            WITH t AS (
+                SELECT
+                    t2_survey.start_date_y AS year,
+                    t2_survey.start_date_m AS month,
+                    t2_survey.site_id,
+                    t2_survey.search_type_id,
+                    t2_survey.source_id,
+                    tmp_sighting.taxon_id AS taxon_id,
+                    MAX(t2_survey.positional_accuracy_in_m) AS positional_accuracy_in_m,
+                    AVG(ST_X(t2_survey.coords)) AS centroid_x,
+                    AVG(ST_Y(t2_survey.coords)) AS centroid_y,
+                    COUNT(DISTINCT t2_survey.id) AS num_surveys,
+                    COUNT(t2_sighting.id) AS num_sightings,
+                    COALESCE(SUM(t2_sighting.unit_id = 1), 0) AS num_po_sightings,
+                    COALESCE(SUM(t2_sighting.unit_id != 1), 0) AS num_count_sightings,
+                    COALESCE(SUM(t2_sighting.count * (t2_sighting.unit_id != 1)), 0) AS sum_of_counts,
+                    COALESCE(MAX(t2_sighting.count * (t2_sighting.unit_id != 1)), 0) AS max_count
+                FROM tmp_sighting
+                JOIN t2_survey ON t2_survey.id = tmp_sighting.survey_id
+                LEFT JOIN t2_sighting ON tmp_sighting.sighting_id = t2_sighting.id
+
+                -- Extra conditions as per old workflow (see process_task)
+                WHERE t2_survey.search_type_id != 6
+
+                GROUP BY
+                    tmp_sighting.taxon_id, year, month, site_id, search_type_id, source_id
+            )
             SELECT
-                start_date_y,
-                source_id,
-                search_type_id,
-                site_id,
-                taxon_id,
-                response_variable_type_id,
-                AVG(value),
-                data_type,
-                region_id,
-                unit_id,
-                MAX(positional_accuracy_in_m) AS positional_accuracy_in_m,
-                Point(AVG(ST_X(centroid_coords)), AVG(ST_Y(centroid_coords))),
-                SUM(survey_count)
-            FROM aggregated_by_month
-            WHERE taxon_id = :taxon_id
-            AND data_type = 2
-            GROUP BY
-                start_date_y,
-                source_id,
-                search_type_id,
-                site_id,
-                taxon_id,
-                response_variable_type_id,
-                data_type,
-                region_id,
-                unit_id;
+                *,
+                ROUND(1.0 * num_sightings / num_surveys, 2) AS rr,
+                1.0 * sum_of_counts / NULLIF(num_surveys - num_po_sightings, 0) AS mean_abundance -- including absences as 0s [Will be null if there are no count sightings]
+            FROM t;
+
+        {insert_aggregated}
+    """.format(taxa = taxa_placeholder, insert_aggregated = insert_aggregated_sql.format(taxa = taxa_placeholder))
+
+    for stmt in sql.split(";"):
+        run_sql(session, stmt, params)
 
+    # As in process_task, the journal entries must be recorded before the temporary tables are dropped
+    if commit and journal_step:
+        record_tasks(session, journal_step, taxa)
+
+    sql = """
         DROP TABLE tmp_sighting;
         DROP TABLE tmp_survey_agg;
-        DROP TABLE tmp_site_taxon
+        DROP TABLE tmp_site_taxon;
+        DROP TABLE tmp_batch_taxon
     """
 
     for stmt in sql.split(";"):
-        run_sql(session, stmt, { 'taxon_id': taxon_id })
+        run_sql(session, stmt)
 
     if commit:
         session.commit()
 
     session.close()
+
+def batches(tasks, batch_size):
+    """
+    Splits a sequence of tasks into lists of up to batch_size tasks
+    """
+    tasks = list(tasks)
+    return [tasks[i:i + batch_size] for i in range(0, len(tasks), batch_size)]
+
+def process_batch_pandas(taxa, commit=False, database_config=None, journal_step=None):
+    """
+    Equivalent to `process_batch`, but with the monthly aggregation performed in the worker with pandas (the 'pandas'
+    engine) rather than in MySQL
+
+    The surveys at the sites where each taxon is present, and the matching sightings, are read as data frames; the monthly
+    metrics are calculated with grouped operations, expanded to a row per response variable type configured in the
+    processing_method table and inserted with `executemany`. Yearly aggregation is still performed in SQL.
+    """
+    session = get_session(database_config)
+    run_sql(session, "SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+
+    params = sql_list_argument('taxon', taxa)
+    taxa_placeholder = sql_list_placeholder('taxon', taxa)
+
+    # Sightings of each taxon, or of its species, count as presences
+    sighting_taxa = pd.DataFrame(session.execute(text("""
+        SELECT taxon.id, taxon.id FROM taxon WHERE taxon.id IN ({taxa})
+        UNION
+        SELECT taxon.id, species.id
+        FROM taxon, taxon species
+        WHERE taxon.id IN ({taxa})
+        AND species.spno = taxon.spno
+        AND species.taxon_level_id = (SELECT id FROM taxon_level WHERE description = 'sp')
+        """.format(taxa = taxa_placeholder)), params).fetchall(), columns = ['taxon_id', 'sighting_taxon_id'])
+
+    # Extra conditions as per old workflow (see process_task)
+    surveys = pd.DataFrame(session.execute(text("""
+        SELECT
+            presence.taxon_id,
+            t2_survey.id,
+            t2_survey.start_date_y,
+            t2_survey.start_date_m,
+            t2_survey.site_id,
+            t2_survey.search_type_id,
+            t2_survey.source_id,
+            t2_survey.positional_accuracy_in_m,
+            ST_X(t2_survey.coords),
+            ST_Y(t2_survey.coords),
+            tmp_site_centroid.region_id
+        FROM t2_site_taxon_presence presence
+        JOIN t2_survey ON t2_survey.site_id = presence.site_id
+        LEFT JOIN tmp_site_centroid ON tmp_site_centroid.site_id = t2_survey.site_id
+        WHERE presence.taxon_id IN ({taxa})
+        AND t2_survey.search_type_id != 6
+        """.format(taxa = taxa_placeholder)), params).fetchall(), columns = [
+            'taxon_id', 'survey_id', 'year', 'month', 'site_id', 'search_type_id', 'source_id', 'positional_accuracy_in_m',
+            'x', 'y', 'region_id'])
+
+    sighting_taxa_ids = sorted(set(sighting_taxa['sighting_taxon_id']))
+    sightings = pd.DataFrame(session.execute(text("""
+        SELECT DISTINCT
+            t2_sighting.survey_id,
+            t2_sighting.taxon_id,
+            t2_sighting.id,
+            t2_sighting.unit_id,
+            t2_sighting.count
+        FROM t2_site_taxon_presence presence
+        JOIN t2_survey ON t2_survey.site_id = presence.site_id
+        JOIN t2_sighting ON t2_sighting.survey_id = t2_survey.id
+        WHERE presence.taxon_id IN ({taxa})
+        AND t2_sighting.taxon_id IN ({sighting_taxa})
+        """.format(taxa = taxa_placeholder, sighting_taxa = sql_list_placeholder('sighting_taxon', sighting_taxa_ids))),
+        { **params, **sql_list_argument('sighting_taxon', sighting_taxa_ids) }).fetchall(), columns = ['survey_id', 'sighting_taxon_id', 'sighting_id', 'unit_id', 'count'])
+
+    processing_methods = pd.DataFrame(session.execute(text("""
+        SELECT DISTINCT taxon_id, source_id, response_variable_type_id
+        FROM processing_method
+        WHERE data_type = 2
+        AND response_variable_type_id IN (SELECT id FROM response_variable_type)
+        AND taxon_id IN ({taxa})
+        """.format(taxa = taxa_placeholder)), params).fetchall(), columns = ['taxon_id', 'source_id', 'response_variable_type_id'])
+
+    rows = aggregate_monthly_pandas(surveys, sightings.merge(sighting_taxa, on = 'sighting_taxon_id'), processing_methods)
+
+    if len(rows) > 0:
+        session.execute(text("""INSERT INTO aggregated_by_month (
+                start_date_y, start_date_m, site_id, search_type_id, taxon_id, response_variable_type_id, value, data_type,
+                source_id, region_id, unit_id, positional_accuracy_in_m, centroid_coords, survey_count)
+            VALUES (
+                :year, :month, :site_id, :search_type_id, :taxon_id, :response_variable_type_id, :value, 2,
+                :source_id, :region_id, :unit_id, :positional_accuracy_in_m, Point(:x, :y), :num_surveys)"""), rows)
+
+    run_sql(session, insert_yearly_sql.format(taxa = taxa_placeholder), params)
+
+    if commit and journal_step:
+        record_tasks(session, journal_step, taxa)
+
+    if commit:
+        session.commit()
+
+    session.close()
+
+def aggregate_monthly_pandas(surveys, sightings, processing_methods):
+    """
+    Calculates the monthly aggregated data for the 'pandas' engine (see `process_batch_pandas`), as the SQL in
+    `process_task` does, returning a list of dicts with the parameters of insert statements
+
+    `sightings` must contain a row for each sighting that counts as a presence of each taxon (taxon_id, survey_id,
+    sighting_id, unit_id, count).
+    """
+    # Each survey is repeated for each of its sightings, or has a single row with no sighting (like the LEFT JOIN in SQL)
+    df = surveys.merge(sightings[['taxon_id', 'survey_id', 'sighting_id', 'unit_id', 'count']], on = ['taxon_id', 'survey_id'], how = 'left')
+
+    # Comparisons with a null unit_id are null (i.e. ignored by the aggregates) as in SQL
+    unit_id = df['unit_id'].astype(float)
+    df['po_sighting'] = (unit_id == 1).astype(float).where(unit_id.notna())
+    df['count_sighting'] = (unit_id != 1).astype(float).where(unit_id.notna())
+    df['count_value'] = df['count'].astype(float) * df['count_sighting']
+
+    keys = ['taxon_id', 'year', 'month', 'site_id', 'search_type_id', 'source_id']
+    agg = df.groupby(keys, dropna = False, sort = False).agg(
+        positional_accuracy_in_m = ('positional_accuracy_in_m', 'max'),
+        x = ('x', 'mean'),
+        y = ('y', 'mean'),
+        region_id = ('region_id', 'first'),
+        num_surveys = ('survey_id', 'nunique'),
+        num_sightings = ('sighting_id', 'count'),
+        num_po_sightings = ('po_sighting', 'sum'),
+        sum_of_counts = ('count_value', 'sum'),
+        max_count = ('count_value', 'max')).reset_index()
+
+    agg['max_count'] = agg['max_count'].fillna(0)
+
+    # ROUND(1.0 * num_sightings / num_surveys, 2): MySQL calculates the division as a DECIMAL with 5 decimal places, and
+    # both roundings are half up
+    num_sightings = agg['num_sightings'].to_numpy(dtype=np.int64)
+    num_surveys = agg['num_surveys'].to_numpy(dtype=np.int64)
+    rr = (num_sightings * 200000 + num_surveys) // (2 * num_surveys)
+    agg['rr'] = ((rr + 500) // 1000) / 100.0
+
+    # Including absences as 0s (null if there are no count sightings)
+    denominator = (agg['num_surveys'] - agg['num_po_sightings']).astype(float)
+    agg['mean_abundance'] = agg['sum_of_counts'] / denominator.where(denominator != 0)
+
+    # A row for each response variable type configured for the taxon and source (processing methods can also differ in
+    # other columns, but as in SQL, each monthly row is only inserted once for each response variable type)
+    processing_methods = processing_methods[['taxon_id', 'source_id', 'response_variable_type_id']].drop_duplicates()
+    agg = agg.merge(processing_methods, on = ['taxon_id', 'source_id'])
+    response_variable_type_id = agg['response_variable_type_id']
+    agg['value'] = np.select(
+        [response_variable_type_id == 1, response_variable_type_id == 2, response_variable_type_id == 3],
+        [agg['mean_abundance'], agg['max_count'], agg['rr']],
+        np.nan)
+    # Average count and maximum count => abundance, reporting rate => occupancy
+    agg['unit_id'] = np.where(response_variable_type_id == 3, 1, 2)
+    agg = agg[agg['value'].notna()]
+
+    # Integer columns containing nulls are read as floats
+    integer_columns = ['month', 'region_id']
+    agg[integer_columns] = agg[integer_columns].astype('Int64')
+
+    columns = keys + ['response_variable_type_id', 'value', 'region_id', 'unit_id', 'positional_accuracy_in_m', 'x', 'y', 'num_surveys']
+    return [
+        { column: to_sql_value(value) for column, value in zip(columns, row) }
+        for row in agg[columns].itertuples(index = False, name = None)
+    ]
+
+def to_sql_value(value):
+    """
+    Converts missing values and NumPy scalars to values accepted by the database driver
+    """
+    if value is None or value is pd.NA or (isinstance(value, (float, np.floating)) and np.isnan(value)):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
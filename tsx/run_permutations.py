@@ -6,7 +6,7 @@ import sys
 import argparse
 import re
 import os
-from tsx.util import run_parallel, get_resource
+from tsx.util import run_parallel, order_by_cost, get_resource
 import subprocess
 from tqdm import tqdm
 import shutil
@@ -200,6 +200,16 @@ def iterate_tasks(df, work_path, script_path):
 
                 yield perm, path, script_path
 
+def permutation_cost(task):
+    """
+    Estimated cost of running a permutation (size of its input file), or None if the input file is missing
+    """
+    perm, work_path = task[0:2]
+    if work_path is None:
+        return 0
+    path = os.path.join(work_path, 'input.csv')
+    return os.path.getsize(path) if os.path.exists(path) else None
+
 def run_task(perm, work_path, script_path, generate_plot_data, generate_plots, end_year):
     if work_path is None:
         return (perm, None, None)
@@ -292,12 +302,17 @@ def run_permutations(db, df, generate_plot_data, generate_plots, end_year):
 
     # This first generates all tasks (takes a few minutes), so that we can show a meaningful progress indicator for the next phase
     tasks = list(tqdm(iterate_tasks(df, work_path, script_path)))
-    # Randomise tasks to get a more consistent progress rate
-    shuffle(tasks)
+
+    # Run the permutations with the most input data first, so that large permutations don't hold up the end of the run. If
+    # the costs aren't known, randomise tasks instead to get a more consistent progress rate.
+    if any(permutation_cost(task) is None for task in tasks):
+        shuffle(tasks)
+    else:
+        tasks = order_by_cost(tasks, permutation_cost)
 
     tasks = [task + (generate_plot_data, generate_plots, end_year) for task in tasks]
 
-    for result, error in run_parallel(run_task, tqdm(tasks)):
+    for result, error in tqdm(run_parallel(run_task, tasks), total = len(tasks)):
         if result:
             perm, trend, stats = result
             perm['TrendData'] = trend
@@ -8,10 +8,13 @@ import collections
 import functools
 import importlib.resources
 import multiprocessing
-from threading import Thread
+from multiprocessing import shared_memory
+import pickle
+from threading import Thread, Lock
 from six.moves.queue import Queue, Empty
 import platform
 import sys
+import traceback
 
 from tsx.config import config
 
@@ -150,22 +153,373 @@ def next(q):
             log.exception("Exception getting item from queue")
             raise
 
-# Takes tasks from a work queue, processes them with 'target', and puts the results on to a result queu
+# Takes (channel, target, task) items from a work queue, processes them, and puts the results on to a result queue.
 # Terminates when it encounters 'None' on the work queue.
-def worker(target, work_q, result_q):
+# Before processing any work, the worker imports the `preload` modules, sets up a database engine (if requested) and then
+# puts a ('ready', seconds) message on the result queue.
+#
+# Each result is a (channel, result, error, stats) tuple, where channel identifies the `WorkerPool.map` call that submitted
+# the task and stats is a dictionary of task-level measurements.
+def worker(work_q, result_q, preload = (), init_db = False, worker_id = None):
     faulthandler.enable()
+    t1 = time.time()
+    try:
+        for module in preload:
+            importlib.import_module(module)
+        if init_db:
+            from tsx.db.connect import get_session
+            session = get_session()
+            session.connection()
+            session.close()
+    except Exception:
+        log.exception("Exception initialising worker")
+    result_q.put(('ready', time.time() - t1))
+
     while True:
-        task = next(work_q)
-        if task is None:
+        item = next(work_q)
+        if item is None:
             break
+        channel, target, task, shared, queued_at = item
+        t1 = time.time()
         try:
-            result_q.put((target(*task), None))
-        except Exception:
-            e = sys.exc_info()[0]
+            result = (target(*task, **load_shared_kwargs(shared)), None)
+        except Exception as e:
             log.exception("Exception in worker")
-            result_q.put((None, e))
+            result = (None, task_error(e))
+        t2 = time.time()
+        result_q.put((channel,) + result + ({
+            'key': task[0] if len(task) > 0 else None,
+            'worker': worker_id,
+            'wait_sec': t1 - queued_at,
+            'exec_sec': t2 - t1,
+            'peak_rss_mb': peak_rss_mb(),
+            'error': None if result[1] is None else repr(result[1])
+        },))
+
+def task_error(e):
+    """
+    Returns the exception raised by a task, in a form that can be passed back from a worker process
 
-def run_parallel(target, tasks, n_workers = default_num_workers, use_processes = True):
+    The formatted traceback is attached as `e.task_traceback` (tracebacks themselves can't be pickled). Exceptions that
+    can't be pickled are replaced by a RuntimeError with the same message.
+    """
+    e.task_traceback = traceback.format_exc()
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        error = RuntimeError("%s: %s" % (type(e).__name__, e))
+        error.task_traceback = e.task_traceback
+        return error
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the current process in MB (or None if not available on this platform)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on Mac, and kilobytes elsewhere
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / (1 << 10)
+
+# Shared keyword arguments are serialised once per run_parallel call and placed in shared memory, so that work items
+# only need to carry a reference to them. Each worker deserialises them the first time it sees a new reference, and keeps
+# the most recently used few (run_parallel calls running at the same time interleave their tasks - see `WorkerPool`).
+_shared_kwargs_cache = collections.OrderedDict()
+_shared_kwargs_cache_size = 4
+
+def load_shared_kwargs(ref):
+    if ref is None:
+        return {}
+
+    # Threads are passed the arguments directly
+    if isinstance(ref, dict):
+        return ref
+
+    if ref in _shared_kwargs_cache:
+        _shared_kwargs_cache.move_to_end(ref)
+    else:
+        name, size = ref
+        shm = shared_memory.SharedMemory(name = name)
+        try:
+            _shared_kwargs_cache[ref] = pickle.loads(shm.buf[:size])
+        finally:
+            # Note: spawned workers share the parent process's resource tracker, so there is no need to unregister
+            # the shared memory here - the parent unlinks it once all tasks are complete
+            shm.close()
+
+        while len(_shared_kwargs_cache) > _shared_kwargs_cache_size:
+            _shared_kwargs_cache.popitem(last = False)
+
+    return _shared_kwargs_cache[ref]
+
+class WorkerPool:
+    """
+    A pool of worker threads or processes that can be reused for several `run_parallel` calls
+
+    Starting worker processes is expensive, because each process has to import numpy, shapely, SQLAlchemy etc. When a
+    pool is active (i.e. inside a `with` block), `run_parallel` sends tasks to the pool's workers instead of starting new
+    ones::
+
+        with WorkerPool(preload = ['tsx.processing.alpha_hull'], init_db = True):
+            tsx.processing.alpha_hull.process_database(...)
+            tsx.processing.t1_aggregation.process_database(...)
+
+    `preload` is a list of modules imported by each worker on startup, and `init_db` opens a connection using the default
+    database config, so the workers are warm before the first task arrives. Workers are started (and their startup time
+    logged) on entering the `with` block, and stopped on exit.
+
+    Several `run_parallel` calls can use the pool at the same time (from different threads). Their tasks share the
+    workers, and are processed in the order they were submitted.
+    """
+    active = None
+
+    def __init__(self, n_workers = default_num_workers, use_processes = True, preload = (), init_db = False):
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+
+        # Multiprocessing has issues on Windows (TODO: check if this is still the case now that we are using the 'spawn' method, see below)
+        if platform.system() == 'Windows':
+            use_processes = False
+
+        self.n_workers = n_workers
+        self.use_processes = use_processes
+        self.preload = list(preload)
+        self.init_db = init_db
+        self.workers = []
+        self.startup_time = None
+        self.channels = {}
+        self.channel_count = 0
+        self.lock = Lock()
+
+    def start(self):
+        # I ran into major issues trying to use Python Multiprocessing, e.g.:
+        # - https://docs.python.org/3.7/library/multiprocessing.html#contexts-and-start-methods
+        # - https://bugs.python.org/issue37677
+        #
+        # In particular I could not get MySQL connections to work even though I was careful to create brand new connections after
+        # forking a new process.
+        #
+        # However, on Mac at least, switching from 'fork' to 'spawn' method seems to work very well. I had to refactor some code,
+        # but I think it is now more explicit what is being shared over process boundaries.
+        # TODO: Test on Windows and Linux
+
+        if self.use_processes:
+            mp = multiprocessing.get_context('spawn')
+
+        Q = mp.Queue if self.use_processes else Queue
+
+        # Setup queues
+        self.work_q = Q()
+        self.result_q = Q()
+
+        t1 = time.time()
+
+        for i in range(0, self.n_workers):
+            args = (self.work_q, self.result_q, self.preload, self.init_db, i)
+            if self.use_processes:
+                p = mp.Process(target = worker, args = args)
+                p.daemon = True # Kill process if parent terminates early
+                p.start()
+                self.workers.append(p)
+            else:
+                t = Thread(target = worker, args = args)
+                t.daemon = True
+                t.start()
+                self.workers.append(t)
+
+        # Wait for all workers to finish initialising
+        for i in range(0, self.n_workers):
+            next(self.result_q)
+
+        self.startup_time = time.time() - t1
+        log.info("Started %s worker %s in %0.2fs" % (self.n_workers, "processes" if self.use_processes else "threads", self.startup_time))
+
+        self.dispatcher = Thread(target = self.dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def dispatch(self):
+        # Routes each result to the queue of the map call that submitted the task
+        while True:
+            item = next(self.result_q)
+            if item is None:
+                break
+            self.channels[item[0]].put(item[1:])
+
+    def map(self, target, tasks, shared_kwargs = None):
+        """
+        Processes tasks using the pool's workers - see `run_parallel`
+        """
+        shm = None
+        shared = None
+        if shared_kwargs:
+            if self.use_processes:
+                data = pickle.dumps(shared_kwargs, protocol = pickle.HIGHEST_PROTOCOL)
+                shm = shared_memory.SharedMemory(create = True, size = max(len(data), 1))
+                shm.buf[:len(data)] = data
+                shared = (shm.name, len(data))
+                log.debug("Sharing %s bytes of arguments with workers" % len(data))
+            else:
+                shared = shared_kwargs
+
+        # Results for this call are routed to their own queue, so that other calls can use the pool at the same time
+        with self.lock:
+            self.channel_count += 1
+            channel = self.channel_count
+        result_q = Queue()
+        self.channels[channel] = result_q
+
+        # Task measurements, used to report how well the tasks were spread across the workers
+        stats = []
+        t1 = time.time()
+
+        i = 0
+        try:
+            # Feed in tasks and yield results
+            for task in tasks:
+                # Tasks must always be tuples
+                if type(task) is not tuple:
+                    task = (task,)
+                self.work_q.put((channel, target, task, shared, time.time()))
+                i += 1
+                # Start getting results once all workers have something to do
+                if i > self.n_workers:
+                    result, error, task_stats = next(result_q)
+                    i -= 1
+                    stats.append(task_stats)
+                    yield result, error
+
+            # Finish collecting results
+            while i > 0:
+                result, error, task_stats = next(result_q)
+                i -= 1
+                stats.append(task_stats)
+                yield result, error
+
+            report_tasks(getattr(target, '__name__', str(target)), time.time() - t1, stats, self.n_workers)
+        finally:
+            # If the caller stopped early, wait for outstanding results so that the workers are free for other calls
+            while i > 0:
+                next(result_q)
+                i -= 1
+
+            del self.channels[channel]
+
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    def close(self):
+        # Signal workers to stop
+        for w in self.workers:
+            self.work_q.put(None)
+
+        # Wait for workers to terminate
+        for w in self.workers:
+            w.join()
+
+        self.workers = []
+
+        # Stop the result dispatcher
+        self.result_q.put(None)
+        self.dispatcher.join()
+
+    def __enter__(self):
+        self.start()
+        WorkerPool.active = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        WorkerPool.active = None
+        self.close()
+
+# If set, a JSON and CSV report of task measurements is written to this directory for each run_parallel call
+profile_dir = None
+_profile_report_count = 0
+
+def report_tasks(name, makespan, stats, n_workers):
+    """
+    Logs the elapsed time of a run_parallel call (the makespan) against the best possible time for the same tasks, and
+    writes a task report to `profile_dir` if set.
+
+    `stats` is a list of per-task measurement dictionaries as produced by `worker`.
+    """
+    global _profile_report_count
+
+    if len(stats) == 0:
+        return
+
+    exec_times = [s['exec_sec'] for s in stats]
+    lower_bound = max(sum(exec_times) / n_workers, max(exec_times))
+    log.info("%s: %s tasks, makespan %0.1fs, lower bound %0.1fs (%0.0f%% efficiency), longest task %0.1fs" % (
+        name, len(exec_times), makespan, lower_bound, 100.0 * lower_bound / max(makespan, 1e-9), max(exec_times)))
+
+    if profile_dir is None:
+        return
+
+    import numpy as np
+    import json
+    import csv
+
+    def summary(field):
+        values = np.array([s[field] for s in stats if s[field] is not None], dtype=float)
+        if len(values) == 0:
+            return None
+        return {
+            'mean': values.mean(),
+            'p50': np.percentile(values, 50),
+            'p90': np.percentile(values, 90),
+            'p99': np.percentile(values, 99),
+            'max': values.max()
+        }
+
+    report = {
+        'name': name,
+        'tasks': len(stats),
+        'workers': n_workers,
+        'errors': sum(1 for s in stats if s['error']),
+        'makespan_sec': makespan,
+        'lower_bound_sec': lower_bound,
+        'exec_sec': summary('exec_sec'),
+        'wait_sec': summary('wait_sec'),
+        'peak_rss_mb': summary('peak_rss_mb'),
+        'slowest': sorted(stats, key = lambda s: s['exec_sec'], reverse = True)[:20]
+    }
+
+    _profile_report_count += 1
+    path = os.path.join(profile_dir, '%02d-%s' % (_profile_report_count, name))
+
+    with open(path + '.json', 'w') as f:
+        json.dump(report, f, indent = 2, default = str)
+
+    with open(path + '.csv', 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = ['key', 'worker', 'wait_sec', 'exec_sec', 'peak_rss_mb', 'error'])
+        writer.writeheader()
+        writer.writerows(stats)
+
+    log.info("Task report written to %s.json" % path)
+
+def order_by_cost(tasks, cost):
+    """
+    Sorts tasks by estimated cost, most expensive first
+
+    Scheduling the longest tasks first means that a few large tasks don't end up running on their own at the end while all
+    other workers are idle.
+
+    `cost` is either a function that takes a task and returns its estimated cost, or a dictionary mapping task keys to
+    costs, where the key of a task is its first element (or the task itself if it is not a tuple). Tasks with no entry in
+    the dictionary are given a cost of zero.
+    """
+    if not callable(cost):
+        costs = cost
+        cost = lambda task: costs.get(task[0] if type(task) is tuple else task, 0)
+
+    return sorted(tasks, key = cost, reverse = True)
+
+def run_parallel(target, tasks, n_workers = default_num_workers, use_processes = True, shared_kwargs = None, cost = None):
     """
     Runs tasks in parallel
 
@@ -174,7 +528,7 @@ def run_parallel(target, tasks, n_workers = default_num_workers, use_processes =
     be wrapped in a tuple.
 
     A generator yielding the result of each task is returned, in the form of a (result, error) tuple which allows errors to be
-    handled. The generator must be consumed in order to ensure all tasks are processed.
+    handled. `error` is None, or the exception raised by the task (see `task_error`). The generator must be consumed in order to ensure all tasks are processed.
     Results are yielded in the order they are completed, which is generally not the same as the order in which they are supplied.
 
     Example::
@@ -192,74 +546,35 @@ def run_parallel(target, tasks, n_workers = default_num_workers, use_processes =
     If using processes, be careful not to use shared global resources such as database connection pools in the target function.
     The number of workers defaults to the number of cpu cores as reported by `multiprocessing.cpu_count`, but can be set
     using the `n_workers` parameter.
-    """
-    if n_workers is None:
-        n_workers = multiprocessing.cpu_count()
 
-    # Multiprocessing has issues on Windows (TODO: check if this is still the case now that we are using the 'spawn' method, see below)
-    if platform.system() == 'Windows':
-        use_processes = False
+    `shared_kwargs` is an optional dictionary of keyword arguments passed to every call of `target`. It is serialised only
+    once (into shared memory) and loaded once by each worker, so large or repeated arguments (e.g. geometries, settings)
+    don't need to be copied into every task. Tasks can then consist of just a key such as a taxon id::
 
+        run_parallel(process_taxon, taxa, shared_kwargs = { 'commit': True, 'coastal_shape': coastal_shape })
 
-    # I ran into major issues trying to use Python Multiprocessing, e.g.:
-    # - https://docs.python.org/3.7/library/multiprocessing.html#contexts-and-start-methods
-    # - https://bugs.python.org/issue37677
-    #
-    # In particular I could not get MySQL connections to work even though I was careful to create brand new connections after
-    # forking a new process.
-    #
-    # However, on Mac at least, switching from 'fork' to 'spawn' method seems to work very well. I had to refactor some code,
-    # but I think it is now more explicit what is being shared over process boundaries.
-    # TODO: Test on Windows and Linux
+    If `cost` is supplied, tasks are processed in order of decreasing estimated cost - see `order_by_cost`. The elapsed
+    time, and the lower bound on elapsed time given the task durations, are logged once all tasks are complete. If
+    `profile_dir` is set, a report of each task's key, worker, queue wait and execution time, peak memory usage and error
+    status is also written - see `report_tasks`.
 
-    if use_processes:
-        mp = multiprocessing.get_context('spawn')
-
-    Q = mp.Queue if use_processes else Queue
-
-    # Setup queues
+    If a `WorkerPool` is active (and matches `n_workers` and `use_processes`), its workers are used, otherwise a new pool
+    is started for this call and stopped once all tasks are complete.
+    """
+    if cost is not None:
+        tasks = order_by_cost(tasks, cost)
 
-    work_q = Q()
-    result_q = Q()
-    workers = []
+    pool = WorkerPool.active
+    if pool is not None and pool.use_processes == use_processes and n_workers in (default_num_workers, pool.n_workers):
+        yield from pool.map(target, tasks, shared_kwargs)
+        return
 
-    for i in range(0, n_workers):
-            if use_processes:
-                p = mp.Process(target = worker, args = (target, work_q, result_q))
-                p.daemon = True # Kill process if parent terminates early
-                p.start()
-                workers.append(p)
-            else:
-                t = Thread(target = worker, args = (target, work_q, result_q))
-                t.daemon = True
-                t.start()
-                workers.append(t)
-
-    # Feed in tasks and yield results
-    i = 0
-    for task in tasks:
-        # Tasks must always be tuples
-        if type(task) is not tuple:
-            task = (task,)
-        work_q.put(task)
-        i += 1
-        # Start getting results once all threads have something to do
-        if i > n_workers:
-            yield next(result_q)
-            i -= 1
-
-    # Signal threads to stop
-    for j in range(0, n_workers):
-        work_q.put(None)
-
-    # Finish collecting results
-    while i > 0:
-        yield next(result_q)
-        i -= 1
-
-    # Wait for workers to terminate
-    for w in workers:
-        w.join()
+    pool = WorkerPool(n_workers = n_workers, use_processes = use_processes)
+    pool.start()
+    try:
+        yield from pool.map(target, tasks, shared_kwargs)
+    finally:
+        pool.close()
 
 # https://code.activestate.com/recipes/52308-the-simple-but-handy-collector-of-a-bunch-of-named
 class Bunch: